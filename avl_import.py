@@ -0,0 +1,227 @@
+# Call this file to load historical vehicle locations (AVL data) from another
+# source into the trips table, to be processed as though they had been
+# collected, e.g.:
+#	python3 avl_import.py avl/2018-01.csv avl/2018-02.csv
+#	python3 avl_import.py avl/*.parquet --prefix mbta_
+# Files need columns vehicle, route, direction, time (epoch seconds), lon and
+# lat; CSV files need a header naming them. Give the files in order of time,
+# e.g. one per day or month; trips still in progress at the end of one file
+# are continued in the next. Reports are split into trips by the same rules
+# as when collecting (see fleet.py): a trip ends when its vehicle hasn't been
+# heard from for fleet.trip_timeout seconds, or when it changes route or
+# direction, in which case the next trip continues its block. Each file is
+# sorted and split as a whole with numpy and its trips are loaded with COPY.
+# They can then be processed like any other, e.g. with process.py.
+# Reading files requires pyarrow.
+
+import argparse, io, time, numpy, track
+from fleet import trip_timeout
+# loading is done with COPY, whichever backend collected the data
+import db_postgres as db
+from conf import conf
+
+# columns needed from the input files
+columns = ['vehicle','route','direction','time','lon','lat']
+
+# trips sent to the database in one COPY
+copy_batch_size = 10000
+
+staging_query = """
+	CREATE TEMPORARY TABLE avl_import (
+		trip_id integer,
+		block_id integer,
+		route_id varchar,
+		direction_id varchar,
+		vehicle_id varchar,
+		track bytea,
+		start_time double precision,
+		end_time double precision,
+		num_points integer,
+		track_length real
+	) ON COMMIT DROP;
+"""
+
+# trips take the local day of their first report as start_day, as in
+# db_postgres.insert_trip()
+insert_query = """
+	INSERT INTO {trips} (
+		trip_id, block_id, route_id, direction_id, vehicle_id, track,
+		start_time, end_time, num_points, track_length, start_day
+	)
+	SELECT
+		trip_id, block_id, route_id, direction_id, vehicle_id, track,
+		start_time, end_time, num_points, track_length,
+		( to_timestamp(start_time) AT TIME ZONE %(tz)s )::date - 'epoch'::date
+	FROM avl_import;
+"""
+
+
+def get_tables(prefix=None):
+	"""table names to use in queries, from the prefix or from conf.py"""
+	if prefix is None:
+		return dict(conf['db']['tables'])
+	return { t: prefix+t for t in conf['db']['tables'] }
+
+
+def read_avl(filename,pa,pacsv,pq):
+	"""read the reports in a CSV or Parquet file as a pyarrow Table,
+		dropping any with a missing value"""
+	schema = pa.schema( [ (name, pa.float64() if name in ('time','lon','lat')
+		else pa.string()) for name in columns ] )
+	if filename.endswith('.parquet'):
+		table = pq.read_table(filename,columns=columns)
+		table = table.select(columns).cast(schema)
+	else:
+		table = pacsv.read_csv( filename, convert_options=pacsv.ConvertOptions(
+			include_columns=columns, column_types=schema ) ).select(columns)
+	return table.drop_null()
+
+
+def segment(vehicles,routes,directions,times,timeout):
+	"""Split reports into trips by the rules fleet.FleetTracker applies as
+		they arrive. Returns the order of the reports kept, the index in that
+		order of the first report of each trip and whether each trip starts
+		a new block. Vehicles, routes and directions are integer codes."""
+	order = numpy.lexsort( (times,vehicles) )
+	v, t = vehicles[order], times[order]
+	# a report no newer than the last from the same vehicle is a repeat
+	keep = numpy.ones( len(order), dtype=bool )
+	keep[1:] = ( v[1:] != v[:-1] ) | ( t[1:] > t[:-1] )
+	order, v, t = order[keep], v[keep], t[keep]
+	r, d = routes[order], directions[order]
+	# a new vehicle, or one not heard from lately, starts a new block
+	new_block = numpy.ones( len(order), dtype=bool )
+	new_block[1:] = ( v[1:] != v[:-1] ) | ( t[1:] - t[:-1] > timeout )
+	# while a change of route or direction only starts a new trip
+	new_trip = new_block.copy()
+	new_trip[1:] |= ( r[1:] != r[:-1] ) | ( d[1:] != d[:-1] )
+	starts = numpy.flatnonzero(new_trip)
+	return order, starts, new_block[starts]
+
+
+def copy_text(value):
+	"""a string escaped for COPY's text format"""
+	return value.replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n')
+
+
+def load(data,tables,timeout,last,pa):
+	"""Split the reports in a Table into trips and store the finished ones.
+		Unless this is the last file, the trips of vehicles which may still
+		be reporting are returned as a Table to be continued in the next,
+		with the block_id they were given. Returns the number of trips and
+		reports stored, and that Table."""
+	if len(data) == 0:
+		return 0, 0, None
+	codes = { name: data.column(name).combine_chunks().dictionary_encode()
+		for name in ('vehicle','route','direction') }
+	names = { name: codes[name].dictionary.to_pylist() for name in codes }
+	v, r, d = [ codes[name].indices.to_numpy() for name in ('vehicle','route','direction') ]
+	t = data.column('time').to_numpy()
+	order, starts, new_blocks = segment(v,r,d,t,timeout)
+	ends = numpy.append( starts[1:], len(order) )
+	t, lon, lat = t[order], data.column('lon').to_numpy()[order], data.column('lat').to_numpy()[order]
+	# blocks continued from the last file keep their block_id
+	carried = data.column('block').to_numpy()[order][ starts[new_blocks] ]
+	new = carried < 0
+	block_ids = carried.copy()
+	if new.any():
+		with db.using_tables(tables):
+			block_ids[new] = db.reserve_ids('block_id',int(new.sum())) + numpy.arange(new.sum())
+	trip_blocks = block_ids[ numpy.cumsum(new_blocks) - 1 ]
+	# the last trip of each vehicle may continue into the next file
+	open_trips = numpy.zeros( len(starts), dtype=bool )
+	if not last:
+		vs = v[order][starts]
+		last_of_vehicle = numpy.append( vs[1:] != vs[:-1], True )
+		open_trips = last_of_vehicle & ( t.max() - t[ends-1] <= timeout )
+	# trips of a single report aren't stored, as when collecting
+	stored = ~open_trips & ( ends - starts > 1 )
+	num_trips = int(stored.sum())
+	# reports as stored, their projected positions and distances along the trip
+	values = track.quantize(t,lon,lat)
+	x, y = conf['projection'](lon,lat)
+	along = numpy.append( 0, numpy.cumsum( numpy.hypot( numpy.diff(x), numpy.diff(y) ) ) )
+	conn = db.new_connection()
+	conn.autocommit = False
+	try:
+		c = conn.cursor()
+		c.execute(staging_query)
+		if num_trips > 0:
+			with db.using_tables(tables):
+				first_id = db.reserve_ids('trip_id',num_trips)
+		rows = io.StringIO()
+		for n, i in enumerate( numpy.flatnonzero(stored) ):
+			s, e = starts[i], ends[i]
+			row = order[s]
+			rows.write( '{}\t{}\t{}\t{}\t{}\t\\\\x{}\t{!r}\t{!r}\t{}\t{!r}\n'.format(
+				first_id + n,
+				trip_blocks[i],
+				copy_text( names['route'][ r[row] ] ),
+				copy_text( names['direction'][ d[row] ] ),
+				copy_text( names['vehicle'][ v[row] ] ),
+				track.pack( values[:,s:e] ).hex(),
+				float( values[0,s] / 10**track.time_digits ),
+				float( values[0,e-1] / 10**track.time_digits ),
+				e - s,
+				float( along[e-1] - along[s] )
+			) )
+			if (n+1) % copy_batch_size == 0 or n+1 == num_trips:
+				rows.seek(0)
+				c.copy_from( rows, 'avl_import' )
+				rows = io.StringIO()
+		c.execute( insert_query.format(**tables), { 'tz':conf['timezone'] } )
+		conn.commit()
+	finally:
+		conn.close()
+	num_reports = int( ( ends - starts )[stored].sum() )
+	if last or not open_trips.any():
+		return num_trips, num_reports, None
+	# the reports of open trips, with their block_ids, in their original rows
+	rows = numpy.concatenate( [ order[s:e] for s, e in zip(starts[open_trips],ends[open_trips]) ] )
+	blocks = numpy.repeat( trip_blocks[open_trips], (ends - starts)[open_trips] )
+	carry = data.take( pa.array(rows) )
+	carry = carry.set_column( carry.schema.get_field_index('block'), 'block', pa.array(blocks) )
+	return num_trips, num_reports, carry
+
+
+def import_files(filenames,prefix=None,timeout=trip_timeout):
+	"""Import AVL files, in order of time, into the trips table."""
+	try:
+		import pyarrow as pa
+		import pyarrow.csv as pacsv
+		import pyarrow.parquet as pq
+	except ImportError:
+		raise SystemExit('Importing AVL data requires pyarrow (pip install pyarrow)')
+	tables = get_tables(prefix)
+	carry = None
+	total_trips, total_reports = 0, 0
+	start = time.monotonic()
+	for i, filename in enumerate(filenames):
+		file_start = time.monotonic()
+		data = read_avl(filename,pa,pacsv,pq)
+		print( '{}: {} reports'.format(filename,len(data)) )
+		data = data.append_column( 'block',
+			pa.array( numpy.full(len(data),-1,dtype=numpy.int64) ) )
+		if carry is not None:
+			data = pa.concat_tables( [carry,data] )
+		num_trips, num_reports, carry = load( data, tables, timeout,
+			i == len(filenames) - 1, pa )
+		total_trips += num_trips
+		total_reports += num_reports
+		print( '\tstored {} trips of {} reports in {:.1f}s'.format(
+			num_trips, num_reports, time.monotonic() - file_start ) )
+	seconds = time.monotonic() - start
+	print( 'imported {} trips of {} reports in {:.1f}s, {:.0f} reports/s'.format(
+		total_trips, total_reports, seconds, total_reports/seconds ) )
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Import historical AVL data.')
+	parser.add_argument('files',nargs='+',
+		help='CSV or Parquet files of vehicle reports, in order of time')
+	parser.add_argument('--prefix',
+		help='table name prefix, if not the tables given in conf.py')
+	parser.add_argument('--timeout',type=float,default=trip_timeout,
+		help='seconds without a report after which a trip has ended')
+	args = parser.parse_args()
+	import_files(args.files,args.prefix,args.timeout)
@@ -0,0 +1,269 @@
+# benchmarks of the trip processing pipeline on synthetic vehicle traces,
+# which need neither the database nor an OSRM server. e.g.:
+#	python3 benchmark.py --label before
+#	python3 benchmark.py --label after --baseline before
+# Each run is appended to benchmark-results.jsonl and compared with the
+# last run of the baseline label, or with the last run if none is given.
+
+import argparse, json, time, random
+import pyproj
+from copy import copy
+from shapely.geometry import Point, LineString, MultiLineString
+from shapely.wkb import dumps as dumpWKB
+from conf import conf
+from trip import Trip
+from minor_objects import Stop
+from geom import cut
+import map_api, track
+
+# seconds between vehicle reports, and typical speed in meters per second
+report_interval = 20
+cruise_speed = 7
+# standard deviation of GPS noise in meters
+gps_noise = 5
+# chance at each report of a vehicle sitting still or of a wild position
+dwell_chance = 0.1
+teleport_chance = 0.01
+# meters between stops and between turns of the generated route
+stop_spacing = 300
+block_length = 200
+
+
+class SyntheticTrace(object):
+	"""A generated route with stops along it and a noisy vehicle trace
+		following it, all in the local projection. Loop routes come back
+		around to where they started, passing their first stops twice."""
+
+	def __init__(self,num_points,seed,center,loop=False):
+		rand = random.Random(seed)
+		self.proj = pyproj.Proj('+init=EPSG:'+str(conf['localEPSG']))
+		origin = self.proj(*center)
+		length = num_points * report_interval * cruise_speed
+		if loop:
+			self.route = make_loop_route(origin,length)
+		else:
+			self.route = make_route(origin,length,rand)
+		self.stops = make_stops(self.route,rand)
+		# a template trip with the vehicle reports, copied for each benchmark
+		self.template = Trip.new(1,1,'synthetic','synthetic',1,0)
+		for x, y, etime in make_reports(self.route,num_points,rand):
+			lon, lat = self.proj(x,y,inverse=True)
+			self.template.add_point(lon,lat,etime)
+		self.template.last_seen = etime
+
+	def trip(self):
+		"""a fresh trip following this trace, as though read from the DB"""
+		t = Trip.new(1,1,'synthetic','synthetic',1,self.template.last_seen)
+		t.vehicles = [ copy(v) for v in self.template.vehicles ]
+		t.stops = self.stops
+		return t
+
+
+def make_route(origin,length,rand):
+	"""a street-like route turning at random every block"""
+	x, y = origin
+	dx, dy = 1, 0
+	coords = [ (x,y) ]
+	for i in range( int(length/block_length)+1 ):
+		turn = rand.choice(['left','right','straight','straight'])
+		if turn == 'left':
+			dx, dy = -dy, dx
+		elif turn == 'right':
+			dx, dy = dy, -dx
+		x, y = x + dx*block_length, y + dy*block_length
+		coords.append( (x,y) )
+	return LineString(coords)
+
+
+def make_loop_route(origin,length):
+	"""a rectangular route ending where it started"""
+	x, y = origin
+	w, h = length*0.3, length*0.2
+	return LineString( [ (x,y), (x+w,y), (x+w,y+h), (x,y+h), (x,y) ] )
+
+
+def make_stops(route,rand):
+	"""stops at regular intervals a few meters off to the side of the route"""
+	stops = []
+	measure = stop_spacing/2
+	while measure < route.length:
+		p = route.interpolate(measure)
+		geom = Point( p.x+rand.uniform(-10,10), p.y+rand.uniform(-10,10) )
+		stops.append( Stop( len(stops)+1, dumpWKB(geom,hex=True) ) )
+		measure += stop_spacing
+	return stops
+
+
+def make_reports(route,num_points,rand):
+	"""Vehicle reports along a route, as (x,y,time) tuples. A dwelling
+		vehicle repeats its last report exactly as the real feed does."""
+	etime = 1500000000
+	measure = 0
+	x, y = None, None
+	reports = []
+	for i in range(num_points):
+		etime += report_interval
+		if x is not None and rand.random() < dwell_chance:
+			reports.append( (x,y,etime) )
+			continue
+		measure = min( route.length,
+			measure + cruise_speed * report_interval * rand.uniform(0.5,1.5) )
+		p = route.interpolate(measure)
+		x, y = p.x + rand.gauss(0,gps_noise), p.y + rand.gauss(0,gps_noise)
+		if rand.random() < teleport_chance:
+			# a wild position, not kept as the last good one
+			reports.append( (x+rand.uniform(2000,5000), y, etime) )
+		else:
+			reports.append( (x,y,etime) )
+	return reports
+
+
+def clean(t):
+	"""the error cleaning loop of Trip.process()"""
+	t.segment_speeds = t.get_segment_speeds()
+	while t.has_errors() and len(t.vehicles) >= 5:
+		t.fix_error()
+		t.segment_speeds = t.get_segment_speeds()
+
+
+def match_on(t,route,default):
+	"""a match object for the trip on the given geometry, made without
+		querying OSRM"""
+	m = map_api.match.__new__(map_api.match)
+	m.trip = t
+	m.geometry = MultiLineString([route])
+	m.default_route_used = default
+	m.confidence = 1
+	t.match = m
+	return m
+
+
+# Each benchmark sets up from a trace and returns the function to be timed.
+
+def setup_segment_speeds(trace):
+	return trace.trip().get_segment_speeds
+
+def setup_cleaning(trace):
+	t = trace.trip()
+	return lambda: clean(t)
+
+def setup_cut(trace):
+	geometry = MultiLineString([trace.route])
+	def run():
+		path = geometry
+		while path.length > 0:
+			subpath, path = cut(path,750)
+	return run
+
+def setup_locate_stops(trace):
+	t = trace.trip()
+	clean(t)
+	return match_on(t,trace.route,False).locate_stops_on_route
+
+def setup_locate_vehicles(trace):
+	t = trace.trip()
+	clean(t)
+	return match_on(t,trace.route,True).locate_vehicles_on_default_route
+
+def setup_interpolate(trace):
+	t = trace.trip()
+	clean(t)
+	m = match_on(t,trace.route,True)
+	m.locate_vehicles_on_default_route()
+	m.locate_stops_on_route()
+	measures = [ tp.measure for tp in t.timepoints ]
+	return lambda: [ t.interpolate_time(measure) for measure in measures ]
+
+def setup_encode_track(trace):
+	t = trace.trip()
+	return lambda: track.encode(t.vehicles)
+
+def setup_decode_track(trace):
+	encoded = track.encode(trace.trip().vehicles)
+	return lambda: track.decode(encoded)
+
+benchmarks = {
+	'segment speeds': setup_segment_speeds,
+	'cleaning': setup_cleaning,
+	'geom.cut': setup_cut,
+	'locate stops': setup_locate_stops,
+	'locate vehicles on default route': setup_locate_vehicles,
+	'interpolate': setup_interpolate,
+	'encode track': setup_encode_track,
+	'decode track': setup_decode_track
+}
+
+
+def best_time(setup,trace,repeat):
+	"""the fastest of several timings, each after a fresh setup"""
+	times = []
+	for i in range(repeat):
+		# cleaning uses the global random number generator
+		random.seed(i)
+		run = setup(trace)
+		start = time.perf_counter()
+		run()
+		times.append( time.perf_counter() - start )
+	return min(times)
+
+
+def last_run(results_file,label=None):
+	"""the most recent stored run, with the given label if any, or None"""
+	try:
+		with open(results_file) as f:
+			runs = [ json.loads(line) for line in f if line.strip() ]
+	except (IOError, ValueError):
+		return None
+	if label is not None:
+		runs = [ r for r in runs if r['label'] == label ]
+	return runs[-1] if len(runs) > 0 else None
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Benchmark trip processing.')
+	parser.add_argument('--sizes',type=int,nargs='+',default=[50,200,800,3200],
+		help='numbers of vehicle reports per trace')
+	parser.add_argument('--only',choices=sorted(benchmarks),action='append',
+		help='run only this benchmark; may be given more than once')
+	parser.add_argument('--repeat',type=int,default=5,
+		help='times to run each benchmark, keeping the fastest')
+	parser.add_argument('--seed',type=int,default=1)
+	parser.add_argument('--center',type=float,nargs=2,default=[-79.4,43.65],
+		metavar=('LON','LAT'),help='where to place the traces')
+	parser.add_argument('--label',default='',help='name for this run')
+	parser.add_argument('--baseline',default=None,
+		help='label of the run to compare with; the last run if not given')
+	parser.add_argument('--results',default='benchmark-results.jsonl',
+		help='file to which results are appended')
+	return parser.parse_args()
+
+
+def main():
+	args = parse_args()
+	baseline = last_run(args.results,args.baseline)
+	names = args.only or sorted(benchmarks)
+	timings = { name: {} for name in names }
+	for size in args.sizes:
+		for shape in ['line','loop']:
+			trace = SyntheticTrace(size,args.seed,args.center,loop=(shape=='loop'))
+			key = '{}-{}'.format(shape,size)
+			for name in names:
+				seconds = best_time(benchmarks[name],trace,args.repeat)
+				timings[name][key] = seconds
+				try:
+					before = baseline['timings'][name][key]
+					comparison = '{:>10.4f}s before {:>6.2f}x'.format(before,before/seconds)
+				except (TypeError, KeyError, ZeroDivisionError):
+					comparison = ''
+				print( '{:<34} {:>10} {:>10.4f}s {}'.format(name,key,seconds,comparison) )
+	with open(args.results,'a') as f:
+		f.write( json.dumps( {
+			'label': args.label,
+			'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+			'seed': args.seed,
+			'repeat': args.repeat,
+			'timings': timings
+		} )+'\n' )
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,34 @@
+# storage helpers shared by the backends in db_postgres.py and db_sqlite.py
+import threading
+from contextlib import contextmanager
+from conf import conf
+
+# Table names are those in conf.py unless a thread has set those of another 
+# agency, as the collector does when storing several agencies at once.
+local = threading.local()
+
+def tables():
+	"""the table names in use by this thread"""
+	return getattr(local,'tables',None) or conf['db']['tables']
+
+@contextmanager
+def using_tables(agency_tables):
+	"""use the given set of table names in this thread within the block"""
+	previous = getattr(local,'tables',None)
+	local.tables = agency_tables
+	try:
+		yield
+	finally:
+		local.tables = previous
+
+# Stop coverage (stops made / stops scheduled) is kept as a histogram in 
+# hundredths from 0 to 2, with the first bin counting trips that never got 
+# as far as looking for stops. Histograms can be added to each other, so 
+# quantiles for any set of routes and days can be read from the rollups.
+coverage_bins = 202
+
+def coverage_bin(stops_scheduled,stops_made,outcome):
+	"""the 1-based histogram bin for a trip's stop coverage"""
+	if outcome == 'ignored' or stops_scheduled == 0:
+		return 1
+	return 2 + min( int(round( 100 * stops_made / stops_scheduled )), 200 )
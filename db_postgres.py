@@ -0,0 +1,1010 @@
+# functions involving BD interaction, for PostgreSQL with PostGIS
+import psycopg2, json, math, os, track
+from conf import conf
+from db_common import coverage_bins, coverage_bin, tables, using_tables
+from shapely.wkb import loads as loadWKB
+from minor_objects import Stop, Vehicle
+
+# connection parameters, based on parameters in conf.py
+conn_string = (
+	"host='"+conf['db']['host']
+	+"' dbname='"+conf['db']['name']
+	+"' user='"+conf['db']['user']
+	+"' password='"+conf['db']['password']+"'"
+)
+# The connection is opened lazily, once per process, the first time a cursor 
+# is requested. Importing this module does not require a live database.
+connection = None
+connection_pid = None	# the process which opened the current connection
+
+# errors which indicate the connection itself has gone bad
+connection_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+def new_connection():
+	"""open a connection not shared with the rest of this module, e.g. 
+		for use by one of several threads working in parallel"""
+	conn = psycopg2.connect(conn_string)
+	conn.autocommit = True
+	return conn
+
+def connect():
+	"""open a new connection for this process"""
+	global connection, connection_pid
+	connection = new_connection()
+	connection_pid = os.getpid()
+	return connection
+
+def disconnect():
+	"""Close the connection if this process owns it. A connection inherited 
+		from a parent process is only forgotten; closing it here would also 
+		close it for the parent, which shares the same socket."""
+	global connection, connection_pid
+	if connection is not None and connection_pid == os.getpid():
+		try:
+			connection.close()
+		except connection_errors:
+			pass
+	connection = None
+	connection_pid = None
+
+def reconnect():
+	"""renew the connection inside a process, closing any old one"""
+	disconnect()
+	return connect()
+
+def is_healthy():
+	"""Check whether the current connection is open and responding."""
+	if connection is None or connection.closed or connection_pid != os.getpid():
+		return False
+	try:
+		c = connection.cursor()
+		c.execute('SELECT 1;')
+		c.close()
+		return True
+	except connection_errors:
+		return False
+
+def worker_init():
+	"""Initializer for multiprocessing.Pool workers. Drops any connection 
+		inherited from the parent and opens one for the life of the worker."""
+	disconnect()
+	connect()
+
+def cursor():
+	"""provide a cursor, (re)connecting first if necessary"""
+	if connection is None or connection.closed or connection_pid != os.getpid():
+		reconnect()
+	return connection.cursor()
+
+def get_trip_attributes(trip_id):
+	"""Return the attributes of a stored trip necessary 
+		for the construction of a new trip object.
+		This now includes the vehicle report times and positions."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT
+				block_id,
+				direction_id,
+				route_id,
+				vehicle_id,
+				track
+			FROM {trips}
+			WHERE trip_id = %(trip_id)s
+		""".format(**tables()),
+		{ 'trip_id':trip_id }
+	)
+	( bid, did, rid, vid, trip_track ) = c.fetchone()
+	# points are projected here rather than by PostGIS
+	vehicle_records = [ 
+		Vehicle( epoch_time, lon, lat ) 
+		for epoch_time, lon, lat in zip( *track.decode(trip_track) )
+	]
+	result = {
+		'block_id': bid,
+		'direction_id': did,
+		'route_id': rid,
+		'vehicle_id': vid,
+		'points': vehicle_records
+	}
+	return result
+
+
+def get_tracks(trip_ids):
+	"""Return ( trip_id, block_id, direction_id, route_id, vehicle_id, 
+		track ) for each of the given trips, in order of trip_id. Tracks are 
+		as encoded by track.encode()."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT trip_id, block_id, direction_id, route_id, vehicle_id, track
+			FROM {trips}
+			WHERE trip_id = ANY(%(trip_ids)s)
+			ORDER BY trip_id;
+		""".format(**tables()),
+		{ 'trip_ids':list(trip_ids) }
+	)
+	return [ row[:5] + (bytes(row[5]),) for row in c.fetchall() ]
+
+
+def reserve_ids(column,count):
+	"""Reserve a block of count trip_ids or block_ids, returning the first. 
+		Blocks are taken from a counter shared by all collectors of the same 
+		tables, so none of them assign the same id. The counter starts after 
+		the highest id already stored."""
+	assert column in ('trip_id','block_id')
+	c = cursor()
+	update = """
+		UPDATE {id_blocks} SET next_id = next_id + %(count)s 
+		WHERE name = %(column)s 
+		RETURNING next_id - %(count)s;
+	""".format(**tables())
+	c.execute( update, { 'column':column, 'count':count } )
+	if c.rowcount == 0:
+		# first use; any other collector starting now will do the same
+		c.execute(
+			"""
+				INSERT INTO {id_blocks} (name, next_id)
+				SELECT %(column)s, COALESCE(MAX({column}),0) + 1 FROM {trips}
+				ON CONFLICT (name) DO NOTHING;
+			""".format(column=column,**tables()),
+			{ 'column':column }
+		)
+		c.execute( update, { 'column':column, 'count':count } )
+	(first_id,) = c.fetchone()
+	return first_id
+
+
+def empty_tables():
+	"""clear the tables of any processing results
+		but NOT of original data from the API"""
+	c = cursor()
+	c.execute(
+		"""
+			TRUNCATE {stop_times};
+			UPDATE {trips} SET 
+				service_id = NULL,
+				match_confidence = NULL,
+				ignore = TRUE,
+				clean_geom = NULL,
+				problem = '',
+				match_geom = NULL,
+				version = NULL;
+		""".format(**tables())
+	)
+
+
+def ignore_trip(trip_id,reason=None):
+	"""mark a trip to be ignored"""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET ignore = TRUE WHERE trip_id = %(trip_id)s;
+			DELETE FROM {stop_times} WHERE trip_id = %(trip_id)s;
+		""".format(**tables()),
+		{ 'trip_id': trip_id } 
+	)
+	if reason:
+		flag_trip(trip_id,reason)
+	return
+
+
+def flag_trip(trip_id,problem_description_string):
+	"""Populate the 'problem' field of trip table: something must 
+		have gone wrong and this tells us what."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET problem = problem || %(description)s 
+			WHERE trip_id = %(trip_id)s;
+		""".format(**tables()),
+		{
+			'description':problem_description_string,
+			'trip_id':trip_id
+		}
+	)
+
+
+def add_trip_match(trip_id,confidence,wkb_geometry_match):
+	"""update the trip record with it's matched geometry"""
+	c = cursor()
+	# store the given values
+	c.execute(
+		"""
+			UPDATE {trips}
+			SET  
+				match_confidence = %(confidence)s,
+				match_geom = ST_SetSRID(%(match)s::geometry,%(localEPSG)s)
+			WHERE trip_id  = %(trip_id)s;
+		""".format(**tables()),
+		{
+			'localEPSG':conf['localEPSG'],
+			'confidence':confidence, 
+			'match':wkb_geometry_match, 
+			'trip_id':trip_id
+		}
+	)
+
+
+def insert_trip(trip_id,block_id,route_id,direction_id,vehicle_id,vehicles,
+	in_progress=False):
+	"""Store the basics of the trip in the database, with its vehicle 
+		reports encoded as one value by track.encode(). The local day of the 
+		first vehicle report is stored as start_day, by which the trips 
+		and stop_times tables may be partitioned. A trip stored while still 
+		in progress is marked as such, which keeps it from being selected 
+		for processing until it is accepted or processed."""
+	c = cursor()
+	# store the given values
+	c.execute(
+		"""
+			INSERT INTO {trips} 
+				( 
+					trip_id, 
+					block_id, 
+					route_id, 
+					direction_id, 
+					vehicle_id, 
+					track,
+					start_time,
+					end_time,
+					num_points,
+					track_length,
+					start_day,
+					problem
+			) 
+			VALUES 
+				( 
+					%(trip_id)s,
+					%(block_id)s,
+					%(route_id)s,
+					%(direction_id)s,
+					%(vehicle_id)s, 
+					%(track)s,
+					%(start_time)s,
+					%(end_time)s,
+					%(num_points)s,
+					%(track_length)s,
+					( to_timestamp(%(start_time)s) AT TIME ZONE %(tz)s )::date - 'epoch'::date,
+					%(problem)s
+				);
+		""".format(**tables()),
+		{
+			'trip_id':trip_id, 
+			'block_id':block_id, 
+			'route_id':route_id, 
+			'direction_id':direction_id, 
+			'vehicle_id':vehicle_id,
+			'track':psycopg2.Binary( track.encode(vehicles) ),
+			'start_time':vehicles[0].time,
+			'end_time':vehicles[-1].time,
+			'num_points':len(vehicles),
+			'track_length':track.length(vehicles),
+			'problem':'in progress' if in_progress else '',
+			'tz':conf['timezone']
+		}
+	)
+
+
+def update_trip_track(trip_id,vehicles):
+	"""Replace the vehicle reports of a trip stored while still in progress 
+		with those of the whole trip."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET
+				track = %(track)s,
+				end_time = %(end_time)s,
+				num_points = %(num_points)s,
+				track_length = %(track_length)s
+			WHERE trip_id = %(trip_id)s;
+		""".format(**tables()),
+		{
+			'trip_id':trip_id,
+			'track':psycopg2.Binary( track.encode(vehicles) ),
+			'end_time':vehicles[-1].time,
+			'num_points':len(vehicles),
+			'track_length':track.length(vehicles)
+		}
+	)
+
+
+def get_direction_uid(direction_id,trip_time):
+	"""Find the correct direction entry based on the direction_id and the time
+		of the trip. Trip_time is an epoch value, direction_id is a string."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT uid 
+			FROM {directions}
+			WHERE 
+				direction_id = %(direction_id)s AND 
+				report_time <= %(trip_time)s
+			ORDER BY report_time DESC
+			LIMIT 1
+		""".format(**tables()),
+		{ 'direction_id':direction_id, 'trip_time':trip_time }
+	)
+	uid, = c.fetchone()
+	return uid
+
+
+def get_stops(direction_id, trip_time):
+	"""Get an ordered list of Stop objects from the schedule data."""
+	c = cursor()
+	# get the uid of the relevant direction entry
+	direction_uid = get_direction_uid(direction_id,trip_time)
+	if not direction_uid: return None
+	c.execute(	
+		"""
+			SELECT uid, the_geom FROM (
+				SELECT 
+					DISTINCT ON (a.stop) a.stop AS stop_id,
+					s.uid,
+					a.seq,
+					s.the_geom
+				FROM {directions} AS d, unnest(d.stops) WITH ORDINALITY a(stop, seq)
+				JOIN {stops} AS s ON s.stop_id = a.stop
+				WHERE d.uid = %(direction_uid)s AND s.report_time <= %(trip_time)s
+				-- get uniques stops with the earliest report time and order by sequence
+				ORDER BY a.stop, s.report_time
+			) AS whatever ORDER BY seq
+		""".format(**tables()),
+		{ 'direction_uid':direction_uid, 'trip_time':trip_time }
+	)
+	# return a schedule-ordered list of stop objects
+	return [ Stop( stop_uid, geom ) for stop_uid, geom in c.fetchall() ]
+
+
+def get_route_geom(direction_id, trip_time):
+	"""Get the geometry of a direction or return None. This is meant to be a 
+		backup in case map-matching is going badly. Direction geometries must be 
+		supplied manually. If all goes well this returns a shapely geometry in
+		the local projection. Else, None."""
+	c = cursor()
+	# get the uid of the relevant direction entry
+	uid = get_direction_uid(direction_id,trip_time)
+	if not uid: return None
+	# now find the geometry
+	c.execute(
+		"""
+			SELECT 
+				route_geom
+			FROM {directions} 
+			WHERE uid = %(uid)s;
+		""".format(**tables()),
+		{ 'uid':uid }
+	)
+	geom, = c.fetchone()
+	if geom: return loadWKB(geom,hex=True)
+	else: return None
+
+
+def set_trip_clean_geom(trip_id,localWKBgeom):
+	"""Store a geometry of the input to the matching process"""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} 
+			SET clean_geom = ST_SetSRID( %(geom)s::geometry, %(EPSG)s )
+			WHERE trip_id = %(trip_id)s;
+		""".format(**tables()),
+		{
+			'trip_id':trip_id,
+			'geom':localWKBgeom,
+			'EPSG':conf['localEPSG']
+		}
+	)
+
+def get_trip_problem(trip_id):
+	"""What problem was associated with the processing of this trip?"""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT problem FROM {trips} WHERE trip_id = %(trip_id)s;
+		""".format(**tables()),
+		{ 'trip_id':trip_id }
+	)
+	problem, = c.fetchone()
+	return problem if problem != '' else None
+
+
+def store_timepoints(trip_id,timepoints,first_sequence=1):
+	"""Store the estimated stop times for a trip. Trips matched while in 
+		progress store them a few at a time, numbered on from first_sequence."""
+	assert len(timepoints) > 0
+	c = cursor()
+	# be sure the timepoints are in ascending temporal order
+	timepoints = sorted(timepoints,key=lambda tp: tp.arrival_time) 
+	# insert the stops
+	records = []
+	seq = first_sequence
+	for timepoint in timepoints:
+		# list of tuples
+		records.append( (trip_id,timepoint.stop_id,timepoint.arrival_time,seq) )
+		seq += 1
+	args_str = ','.join( [ "({},{},{},{})".format(*x) for x in records ] )
+	# stop times take the start_day of their trip
+	c.execute(
+		"""
+			INSERT INTO {stop_times} (trip_id, stop_uid, etime, stop_sequence, start_day) 
+			SELECT v.trip_id, v.stop_uid, v.etime, v.stop_sequence, t.start_day
+			FROM {trips} AS t, ( VALUES """.format(**tables()) + args_str + """ 
+			) AS v (trip_id, stop_uid, etime, stop_sequence)
+			WHERE t.trip_id = v.trip_id
+		"""
+	)
+
+
+def store_trip_quality(trip_id,route_id,start_time,outcome,
+	stops_scheduled,stops_made,confidence,default_route_used):
+	"""Record measures of the quality of a processed trip, and add them to 
+		the running totals for its route and day, first removing those of 
+		any earlier processing of the same trip."""
+	bin_index = coverage_bin(stops_scheduled,stops_made,outcome)
+	# the histogram of this trip alone, for a route and day not yet seen
+	coverage = [0] * coverage_bins
+	coverage[bin_index-1] = 1
+	c = cursor()
+	c.execute(
+		"""
+			-- back out any earlier record of this trip
+			WITH old AS (
+				DELETE FROM {trip_quality} WHERE trip_id = %(trip_id)s RETURNING *
+			)
+			UPDATE {route_quality} AS r SET
+				num_trips = r.num_trips - 1,
+				num_success = r.num_success - (old.outcome = 'success')::int,
+				num_match_problem = r.num_match_problem - (old.outcome = 'match problem')::int,
+				num_ignored = r.num_ignored - (old.outcome = 'ignored')::int,
+				num_default_route = r.num_default_route - old.default_route::int,
+				num_confidence = r.num_confidence - (old.confidence IS NOT NULL)::int,
+				sum_confidence = r.sum_confidence - COALESCE(old.confidence,0),
+				coverage[old.coverage_bin] = r.coverage[old.coverage_bin] - 1
+			FROM old
+			WHERE r.route_id = old.route_id AND r.day = old.day;
+
+			INSERT INTO {trip_quality} (
+				trip_id, route_id, day, outcome, 
+				stops_scheduled, stops_made, coverage_bin,
+				confidence, default_route
+			) VALUES (
+				%(trip_id)s, %(route_id)s, 
+				( to_timestamp(%(start_time)s) AT TIME ZONE %(tz)s )::date - 'epoch'::date,
+				%(outcome)s,
+				%(stops_scheduled)s, %(stops_made)s, %(bin)s,
+				%(confidence)s, %(default_route)s
+			);
+
+			-- add this trip to the totals
+			INSERT INTO {route_quality} AS r (
+				route_id, day, num_trips, 
+				num_success, num_match_problem, num_ignored, num_default_route,
+				num_confidence, sum_confidence, coverage
+			) 
+			SELECT
+				route_id, day, 1,
+				(outcome = 'success')::int,
+				(outcome = 'match problem')::int,
+				(outcome = 'ignored')::int,
+				default_route::int,
+				(confidence IS NOT NULL)::int,
+				COALESCE(confidence,0),
+				%(coverage)s
+			FROM {trip_quality} WHERE trip_id = %(trip_id)s
+			ON CONFLICT (route_id, day) DO UPDATE SET
+				num_trips = r.num_trips + 1,
+				num_success = r.num_success + EXCLUDED.num_success,
+				num_match_problem = r.num_match_problem + EXCLUDED.num_match_problem,
+				num_ignored = r.num_ignored + EXCLUDED.num_ignored,
+				num_default_route = r.num_default_route + EXCLUDED.num_default_route,
+				num_confidence = r.num_confidence + EXCLUDED.num_confidence,
+				sum_confidence = r.sum_confidence + EXCLUDED.sum_confidence,
+				coverage[%(bin)s] = r.coverage[%(bin)s] + 1;
+		""".format(**tables()),
+		{
+			'trip_id':trip_id,
+			'route_id':route_id,
+			'start_time':start_time,
+			'tz':conf['timezone'],
+			'outcome':outcome,
+			'stops_scheduled':stops_scheduled,
+			'stops_made':stops_made,
+			'bin':bin_index,
+			'coverage':coverage,
+			'confidence':confidence,
+			'default_route':default_route_used
+		}
+	)
+
+
+def get_timepoints(trip_id):
+	"""Essentially, this should be the inverse of the above function."""
+	c = cursor()
+	c.execute("""
+		SELECT stop_id, etime, stop_sequence
+		FROM {stop_times}
+		WHERE trip_id = %(trip_id)s
+		ORDER BY stop_sequence
+	""".format(**tables()),
+	{ 'trip_id':trip_id })
+	return c.fetchall()
+
+
+def try_storing_stop(stop_id,stop_name,stop_code,lon,lat):
+	"""we have received a report of a stop from the routeConfig
+		data. Is this a new stop? Have we already heard of it?
+		Decide whether to store it or ignore it. If absolutely
+		nothing has changed about the record, ignore it. If not,
+		store it with the current time."""
+	c = cursor()
+	# see if precisely this record already exists
+	c.execute(
+		"""
+			SELECT * 
+			FROM {stops}
+			WHERE 
+				stop_id = %(stop_id)s AND
+				stop_name = %(stop_name)s AND
+				stop_code = %(stop_code)s AND
+				ABS(lon - %(lon)s::numeric) <= 0.0001 AND
+				ABS(lat - %(lat)s::numeric) <= 0.0001;
+		""".format(**tables()),
+		{
+			'stop_id':stop_id,
+			'stop_name':stop_name,
+			'stop_code':stop_code,
+			'lon':lon,
+			'lat':lat
+		}
+	)
+	# if any result, we already have this stop
+	if c.rowcount > 0:
+		return
+	# store the stop
+	c.execute(
+		"""
+			INSERT INTO {stops} ( 
+				stop_id, stop_name, stop_code, 
+				the_geom, 
+				lon, lat, 
+				report_time 
+			) 
+			VALUES ( 
+				%(stop_id)s, %(stop_name)s, %(stop_code)s, 
+				ST_Transform( ST_SetSRID( ST_MakePoint(%(lon)s, %(lat)s),4326),%(localEPSG)s ),
+				%(lon)s, %(lat)s, 
+				EXTRACT(EPOCH FROM NOW())
+			)""".format(**tables()),
+			{ 
+				'stop_id':stop_id,
+				'stop_name':stop_name,
+				'stop_code':stop_code,
+				'lon':lon,
+				'lat':lat,
+				'localEPSG':conf['localEPSG']
+			} )
+
+
+def try_storing_direction(route_id,did,title,name,branch,useforui,stops):
+	"""we have recieved a report of a route direction from the 
+		routeConfig data. Is this a new direction? Have we already 
+		heard of it? Decide whether to store it or ignore it. If 
+		absolutely nothing has changed about the record, ignore it. 
+		If not, store it with the current time."""
+	c = cursor()
+	# see if exactly this record already exists
+	c.execute(
+		"""
+			SELECT * FROM {directions}
+			WHERE
+				route_id = %s AND
+				direction_id = %s AND
+				title = %s AND
+				name = %s AND
+				branch = %s AND
+				useforui = %s AND
+				stops = %s;
+		""".format(**tables()),
+		(
+			route_id,
+			did,
+			title,
+			name,
+			branch,
+			useforui,
+			stops
+		)
+	)
+	if c.rowcount > 0:
+		return # already have the record
+	# store the data
+	c.execute(
+		"""
+			INSERT INTO {directions} 
+				( 
+					route_id, direction_id, title, 
+					name, branch, useforui, 
+					stops, report_time
+				) 
+			VALUES 
+				( 
+					%s, %s, %s,
+					%s, %s, %s, 
+					%s, EXTRACT(EPOCH FROM NOW())
+				)""".format(**tables()),
+			(
+				route_id,did,title,
+				name,branch,useforui,
+				stops
+			)
+		)
+
+
+def scrub_trip(trip_id):
+	"""Un-mark any flag fields and leave the DB record 
+		as though newly collected and unprocessed. The processing version 
+		is cleared too, and set again only once the trip has an outcome."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET 
+				match_confidence = NULL,
+				match_geom = NULL,
+				clean_geom = NULL,
+				problem = '',
+				ignore = FALSE,
+				service_id = NULL,
+				version = NULL
+			WHERE trip_id = %(trip_id)s;
+
+			DELETE FROM {stop_times} 
+			WHERE trip_id = %(trip_id)s;
+		""".format(**tables()),
+		{ 'trip_id':trip_id }
+	)
+
+
+def accept_trip(trip_id,version=None):
+	"""Mark a trip matched while in progress as processed, which makes the 
+		stop times stored along the way part of the results."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET 
+				problem = '',
+				ignore = FALSE,
+				version = %(version)s
+			WHERE trip_id = %(trip_id)s;
+		""".format(**tables()),
+		{ 'trip_id':trip_id, 'version':version }
+	)
+
+
+def set_trip_version(trip_id,version):
+	"""Record the processing version that gave a trip its outcome."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET version = %(version)s 
+			WHERE trip_id = %(trip_id)s;
+		""".format(**tables()),
+		{ 'trip_id':trip_id, 'version':version }
+	)
+
+
+def scrub_trips(trip_ids):
+	"""Set-based version of scrub_trip() for many trips at once, leaving 
+		them as though newly collected and unprocessed."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET 
+				match_confidence = NULL,
+				match_geom = NULL,
+				clean_geom = NULL,
+				problem = '',
+				ignore = FALSE,
+				service_id = NULL,
+				version = NULL
+			WHERE trip_id = ANY(%(trip_ids)s);
+
+			DELETE FROM {stop_times} 
+			WHERE trip_id = ANY(%(trip_ids)s);
+		""".format(**tables()),
+		{ 'trip_ids':list(trip_ids) }
+	)
+
+
+def trip_filter(min_id=None,max_id=None,route_id=None,
+	start_date=None,end_date=None,unfinished=False,version=None,new_since=None):
+	"""Build a WHERE clause and parameters selecting trips from the trips 
+		table. Any argument left as None places no limit on the selection. 
+		Dates are local 'YYYY-MM-DD' strings compared against the time of 
+		the first vehicle report; the end date is inclusive. Given a 
+		processing version, only trips not processed with it are selected. 
+		If new_since is also given, the trips up to then are known to have 
+		that version unless never processed at all, so only those and trips 
+		with a greater trip_id need to be considered, avoiding a full scan. 
+		Trips still in progress are never selected."""
+	conditions = ["problem <> 'in progress'"]
+	if min_id is not None:
+		conditions.append('trip_id >= %(min_id)s')
+	if max_id is not None:
+		conditions.append('trip_id <= %(max_id)s')
+	if route_id is not None:
+		conditions.append('route_id = %(route_id)s')
+	if start_date is not None:
+		conditions.append(
+			"start_time >= EXTRACT(EPOCH FROM %(start_date)s::date::timestamp AT TIME ZONE %(tz)s)"
+		)
+	if end_date is not None:
+		conditions.append(
+			"start_time < EXTRACT(EPOCH FROM (%(end_date)s::date + 1)::timestamp AT TIME ZONE %(tz)s)"
+		)
+	if unfinished:
+		conditions.append("problem IN ('','connection issue','match problem') AND ignore")
+	if version is not None and new_since is not None:
+		conditions.append(
+			'(trip_id > %(new_since)s OR version IS NULL) '
+			'AND version IS DISTINCT FROM %(version)s'
+		)
+	elif version is not None:
+		conditions.append('version IS DISTINCT FROM %(version)s')
+	params = {
+		'min_id':min_id,
+		'max_id':max_id,
+		'route_id':route_id,
+		'start_date':start_date,
+		'end_date':end_date,
+		'version':version,
+		'new_since':new_since,
+		'tz':conf['timezone']
+	}
+	return ' AND '.join(conditions), params
+
+
+def get_trip_ids(**filters):
+	"""return a list of all trip ids matching the filters of trip_filter()"""
+	where, params = trip_filter(**filters)
+	c = cursor()
+	c.execute(
+		"""
+			SELECT trip_id 
+			FROM {trips}
+			WHERE """.format(**tables()) + where + """
+			ORDER BY trip_id ASC;
+		""",
+		params
+	)
+	return [ result for (result,) in c.fetchall() ]
+
+
+def get_trip_ids_by_range(min_id,max_id):
+	"""return a list of all trip ids in the specified range"""
+	return get_trip_ids(min_id=min_id,max_id=max_id)
+
+
+def get_trip_ids_by_route(route_id):
+	"""return a list of all trip ids operating a given route"""
+	return get_trip_ids(route_id=route_id)
+
+
+def get_trips_in_progress():
+	"""return ( trip_id, route_id ) of each trip still marked as in progress"""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT trip_id, route_id FROM {trips}
+			WHERE problem = 'in progress' ORDER BY trip_id ASC;
+		""".format(**tables())
+	)
+	return c.fetchall()
+
+
+def get_trip_ids_unfinished():
+	"""return a list of trip ids not yet processed sucessfully"""
+	return get_trip_ids(unfinished=True)
+
+
+def get_trip_set_size(**filters):
+	"""Count the trips and vehicle reports matching the filters of 
+		trip_filter(), for estimating the cost of processing them."""
+	where, params = trip_filter(**filters)
+	c = cursor()
+	c.execute(
+		"""
+			SELECT 
+				COUNT(*), 
+				COALESCE(SUM(num_points),0)
+			FROM {trips}
+			WHERE """.format(**tables()) + where + ";",
+		params
+	)
+	num_trips, num_points = c.fetchone()
+	return num_trips, num_points
+
+
+def get_trip_sizes(**filters):
+	"""Return (trip_id, number of vehicle reports, track length in meters) 
+		for trips matching the filters of trip_filter(). These are used to 
+		estimate the cost of processing each trip."""
+	where, params = trip_filter(**filters)
+	c = cursor()
+	c.execute(
+		"""
+			SELECT 
+				trip_id, 
+				COALESCE(num_points,0),
+				COALESCE(track_length,0)
+			FROM {trips}
+			WHERE """.format(**tables()) + where + """
+			ORDER BY trip_id ASC;
+		""",
+		params
+	)
+	return c.fetchall()
+
+
+def enqueue_trips(weights,**filters):
+	"""Add the trips matching the filters of trip_filter() to the shared 
+		work queue (the claims table), where they can be claimed by workers 
+		on any host. Trips already in the queue are reset to be done again. 
+		weights are the (point, squared point, km) terms of the cost estimate 
+		used to hand out the most costly trips first. Returns the number of 
+		trips queued."""
+	where, params = trip_filter(**filters)
+	params['point_cost'], params['squared_point_cost'], params['km_cost'] = weights
+	c = cursor()
+	c.execute(
+		"""
+			INSERT INTO {claims} (trip_id, cost)
+			SELECT 
+				trip_id,
+				%(point_cost)s * COALESCE(num_points,0) + 
+				%(squared_point_cost)s * COALESCE(num_points,0)^2 + 
+				%(km_cost)s * COALESCE(track_length,0) / 1000
+			FROM {trips}
+			WHERE """.format(**tables()) + where + """
+			ON CONFLICT (trip_id) DO UPDATE SET
+				cost = EXCLUDED.cost,
+				worker = NULL,
+				lease_expires = NULL,
+				attempts = 0,
+				done = FALSE;
+		""",
+		params
+	)
+	return c.rowcount
+
+
+def claim_trips(worker,lease_seconds,limit,max_attempts):
+	"""Lease up to limit unfinished trips from the work queue to the named 
+		worker, most costly first. Trips whose lease has expired, e.g. because 
+		their worker crashed, may be claimed again. Concurrent workers skip 
+		rows locked by each other rather than waiting on them. Returns a list 
+		of (trip_id, cost) tuples."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {claims} AS c SET
+				worker = %(worker)s,
+				lease_expires = EXTRACT(EPOCH FROM clock_timestamp()) + %(lease)s,
+				attempts = c.attempts + 1
+			WHERE c.trip_id IN (
+				SELECT trip_id 
+				FROM {claims}
+				WHERE 
+					NOT done AND 
+					attempts < %(max_attempts)s AND
+					( 
+						worker IS NULL OR 
+						lease_expires < EXTRACT(EPOCH FROM clock_timestamp()) 
+					)
+				ORDER BY cost DESC
+				LIMIT %(limit)s
+				FOR UPDATE SKIP LOCKED
+			)
+			RETURNING c.trip_id, c.cost;
+		""".format(**tables()),
+		{
+			'worker':worker,
+			'lease':lease_seconds,
+			'limit':limit,
+			'max_attempts':max_attempts
+		}
+	)
+	return c.fetchall()
+
+
+def renew_claims(worker,lease_seconds):
+	"""Heartbeat: extend the leases on all trips held by a worker."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {claims} SET 
+				lease_expires = EXTRACT(EPOCH FROM clock_timestamp()) + %(lease)s
+			WHERE worker = %(worker)s AND NOT done;
+		""".format(**tables()),
+		{ 'worker':worker, 'lease':lease_seconds }
+	)
+
+
+def release_claims(worker,trip_ids,done=True):
+	"""Give up a worker's leases on the given trips, marking them done or 
+		leaving them to be claimed again."""
+	if len(trip_ids) == 0:
+		return
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {claims} SET 
+				worker = NULL,
+				lease_expires = NULL,
+				done = %(done)s
+			WHERE worker = %(worker)s AND trip_id = ANY(%(trip_ids)s);
+		""".format(**tables()),
+		{ 'worker':worker, 'trip_ids':list(trip_ids), 'done':done }
+	)
+
+
+def count_open_claims(max_attempts):
+	"""Count queued trips which are not done and may still be attempted, 
+		whether or not they are currently leased."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT COUNT(*) FROM {claims}
+			WHERE NOT done AND attempts < %(max_attempts)s;
+		""".format(**tables()),
+		{ 'max_attempts':max_attempts }
+	)
+	(count,) = c.fetchone()
+	return count
+
+
+def get_watermark(name):
+	"""Return the (trip_id, processing version) recorded by the last 
+		completed run of the given name, or (None, None)."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT trip_id, version FROM {watermarks} WHERE name = %(name)s;
+		""".format(**tables()),
+		{ 'name':name }
+	)
+	if c.rowcount > 0:
+		return c.fetchone()
+	return None, None
+
+
+def set_watermark(name,trip_id,version):
+	"""Record the highest trip_id and the processing version of a 
+		completed run."""
+	c = cursor()
+	c.execute(
+		"""
+			INSERT INTO {watermarks} (name, trip_id, version, report_time)
+			VALUES ( %(name)s, %(trip_id)s, %(version)s, EXTRACT(EPOCH FROM NOW()) )
+			ON CONFLICT (name) DO UPDATE SET
+				trip_id = EXCLUDED.trip_id,
+				version = EXCLUDED.version,
+				report_time = EXCLUDED.report_time;
+		""".format(**tables()),
+		{ 'name':name, 'trip_id':trip_id, 'version':version }
+	)
+
+
+def trip_exists(trip_id):
+	"""Check whether a trip exists in the database, 
+		returning boolean."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT EXISTS (SELECT * FROM {trips} WHERE trip_id = %(trip_id)s)
+		""".format(**tables()),
+		{ 'trip_id':trip_id }
+	)
+	(existence,) = c.fetchone()
+	return existence
+
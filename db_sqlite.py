@@ -0,0 +1,1035 @@
+# functions involving DB interaction, for a local SQLite database
+# These mirror the functions of db_postgres.py. Geometries are held as WKB in
+# the local projection and projected here rather than by PostGIS; arrays are
+# held as JSON. Missing tables are created when first used.
+import sqlite3, json, os, time, threading, track
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo
+from conf import conf
+from shapely.wkb import loads as loadWKB
+from shapely.geometry import Point
+from shapely.ops import transform as reproject
+from minor_objects import Stop, Vehicle
+from db_common import coverage_bins, coverage_bin, tables, using_tables
+
+local_timezone = ZoneInfo(conf['timezone'])
+
+schema = """
+	CREATE TABLE IF NOT EXISTS {stops} (
+		uid INTEGER PRIMARY KEY,
+		stop_id TEXT,
+		stop_name TEXT,
+		stop_code INTEGER,
+		lon REAL,
+		lat REAL,
+		the_geom BLOB, -- WKB point
+		report_time REAL
+	);
+	CREATE INDEX IF NOT EXISTS {stops}_stop_id ON {stops} (stop_id, report_time);
+
+	CREATE TABLE IF NOT EXISTS {directions} (
+		uid INTEGER PRIMARY KEY,
+		route_id TEXT,
+		direction_id TEXT,
+		title TEXT,
+		name TEXT,
+		branch TEXT,
+		useforui INTEGER,
+		stops TEXT, -- JSON array of stop_ids
+		report_time REAL,
+		route_geom BLOB -- optional default route geometry, WKB linestring
+	);
+	CREATE INDEX IF NOT EXISTS {directions}_direction_id
+		ON {directions} (direction_id, report_time);
+
+	CREATE TABLE IF NOT EXISTS {trips} (
+		trip_id INTEGER PRIMARY KEY,
+		track BLOB, -- vehicle reports, as encoded by track.py
+		start_time REAL,
+		end_time REAL,
+		num_points INTEGER,
+		track_length REAL,
+		route_id TEXT,
+		direction_id TEXT,
+		service_id INTEGER,
+		start_day INTEGER,
+		vehicle_id TEXT,
+		block_id INTEGER,
+		match_confidence REAL,
+		ignore INTEGER DEFAULT 1,
+		match_geom BLOB,
+		clean_geom BLOB,
+		problem TEXT DEFAULT '',
+		version TEXT
+	);
+	CREATE INDEX IF NOT EXISTS {trips}_route_id ON {trips} (route_id, trip_id);
+
+	CREATE TABLE IF NOT EXISTS {stop_times} (
+		trip_id INTEGER,
+		stop_uid INTEGER,
+		stop_sequence INTEGER,
+		etime REAL,
+		fake_stop_id TEXT,
+		start_day INTEGER
+	);
+	CREATE INDEX IF NOT EXISTS {stop_times}_trip_id
+		ON {stop_times} (trip_id, stop_sequence);
+
+	CREATE TABLE IF NOT EXISTS {claims} (
+		trip_id INTEGER PRIMARY KEY,
+		cost REAL,
+		worker TEXT,
+		lease_expires REAL,
+		attempts INTEGER DEFAULT 0,
+		done INTEGER DEFAULT 0
+	);
+
+	CREATE TABLE IF NOT EXISTS {id_blocks} (
+		name TEXT PRIMARY KEY,
+		next_id INTEGER
+	);
+
+	CREATE TABLE IF NOT EXISTS {watermarks} (
+		name TEXT PRIMARY KEY,
+		trip_id INTEGER,
+		version TEXT,
+		report_time REAL
+	);
+
+	CREATE TABLE IF NOT EXISTS {trip_quality} (
+		trip_id INTEGER PRIMARY KEY,
+		route_id TEXT,
+		day INTEGER,
+		outcome TEXT,
+		stops_scheduled INTEGER,
+		stops_made INTEGER,
+		coverage_bin INTEGER,
+		confidence REAL,
+		default_route INTEGER
+	);
+
+	CREATE TABLE IF NOT EXISTS {route_quality} (
+		route_id TEXT,
+		day INTEGER,
+		num_trips INTEGER,
+		num_success INTEGER,
+		num_match_problem INTEGER,
+		num_ignored INTEGER,
+		num_default_route INTEGER,
+		num_confidence INTEGER,
+		sum_confidence REAL,
+		coverage TEXT, -- JSON array, as in the postgres table
+		PRIMARY KEY (route_id, day)
+	);
+"""
+
+# Connections are opened lazily, as for PostgreSQL, but one per thread: the
+# collector's threads write concurrently, and on a shared connection one
+# thread's writes would become part of another's transaction. SQLite's own
+# file locking queues up their writes.
+local = threading.local()
+
+# errors which indicate the connection has gone bad or the file is locked
+connection_errors = (sqlite3.OperationalError, sqlite3.InterfaceError)
+
+def new_connection():
+	"""Open a connection not shared with the rest of this module. Writes
+		commit as they are made unless inside a transaction(), and the
+		write-ahead log lets workers read while another writes."""
+	conn = sqlite3.connect(conf['db']['path'],timeout=60,isolation_level=None)
+	conn.execute('PRAGMA journal_mode=WAL')
+	conn.execute('PRAGMA synchronous=NORMAL')
+	return conn
+
+def current_connection():
+	"""this thread's connection, if it has one opened in this process"""
+	if getattr(local,'pid',None) != os.getpid():
+		return None
+	return local.connection
+
+def connect():
+	"""open a new connection for this thread"""
+	local.connection = new_connection()
+	local.pid = os.getpid()
+	# names of the trips tables whose set of tables is known to exist
+	local.created = set()
+	return local.connection
+
+def disconnect():
+	"""close this thread's connection if this process owns it"""
+	if current_connection() is not None:
+		local.connection.close()
+	local.connection = None
+	local.pid = None
+
+def reconnect():
+	"""renew the connection inside a thread, closing any old one"""
+	disconnect()
+	return connect()
+
+def is_healthy():
+	"""Check whether the current connection is open and responding."""
+	connection = current_connection()
+	if connection is None:
+		return False
+	try:
+		connection.execute('SELECT 1;')
+		return True
+	except connection_errors:
+		return False
+
+def worker_init():
+	"""Initializer for multiprocessing.Pool workers, which each open their
+		own connection."""
+	disconnect()
+	connect()
+
+def cursor():
+	"""provide a cursor, (re)connecting first if necessary"""
+	connection = current_connection()
+	if connection is None:
+		connection = reconnect()
+	# create the tables in use by this thread if this is their first use
+	if tables()['trips'] not in local.created:
+		connection.executescript(schema.format(**tables()))
+		local.created.add(tables()['trips'])
+	return connection.cursor()
+
+@contextmanager
+def transaction():
+	"""A cursor for several statements made together. The write lock is
+		taken at the start so that concurrent workers queue up rather
+		than fail partway through."""
+	c = cursor()
+	c.execute('BEGIN IMMEDIATE')
+	try:
+		yield c
+	except:
+		c.execute('ROLLBACK')
+		raise
+	c.execute('COMMIT')
+
+def wkb(hex_geom):
+	"""WKB bytes for storing a hex-encoded geometry"""
+	return bytes.fromhex(hex_geom) if hex_geom else None
+
+def local_day(epoch_time):
+	"""local days since the epoch of the given time, i.e. the start_day"""
+	return ( datetime.fromtimestamp(epoch_time,local_timezone).date() - date(1970,1,1) ).days
+
+def local_midnight(date_string,days_after=0):
+	"""epoch time of the start of a local 'YYYY-MM-DD' date, or of a day after it"""
+	day = datetime.strptime(date_string,'%Y-%m-%d') + timedelta(days=days_after)
+	return day.replace(tzinfo=local_timezone).timestamp()
+
+
+def get_trip_attributes(trip_id):
+	"""Return the attributes of a stored trip necessary
+		for the construction of a new trip object.
+		This now includes the vehicle report times and positions."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT block_id, direction_id, route_id, vehicle_id, track
+			FROM {trips}
+			WHERE trip_id = :trip_id
+		""".format(**tables()),
+		{ 'trip_id':trip_id }
+	)
+	bid, did, rid, vid, trip_track = c.fetchone()
+	times, lons, lats = track.decode(trip_track)
+	return {
+		'block_id': bid,
+		'direction_id': did,
+		'route_id': rid,
+		'vehicle_id': vid,
+		'points': [ Vehicle(t,lon,lat) for t, lon, lat in zip(times,lons,lats) ]
+	}
+
+
+def get_tracks(trip_ids):
+	"""Return the encoded tracks of the given trips with their attributes,
+		as db_postgres.get_tracks() does."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT trip_id, block_id, direction_id, route_id, vehicle_id, track
+			FROM {trips}
+			WHERE trip_id IN (SELECT value FROM json_each(:trip_ids))
+			ORDER BY trip_id;
+		""".format(**tables()),
+		{ 'trip_ids':json.dumps(list(trip_ids)) }
+	)
+	return c.fetchall()
+
+
+def reserve_ids(column,count):
+	"""Reserve a block of count trip_ids or block_ids, returning the first, 
+		as db_postgres.reserve_ids() does."""
+	assert column in ('trip_id','block_id')
+	with transaction() as c:
+		c.execute(
+			"SELECT next_id FROM {id_blocks} WHERE name = :column".format(**tables()),
+			{ 'column':column }
+		)
+		row = c.fetchone()
+		if row:
+			first_id = row[0]
+		else: # first use; start after the highest id stored
+			c.execute( "SELECT COALESCE(MAX({column}),0) + 1 FROM {trips}".format(
+				column=column,**tables()) )
+			(first_id,) = c.fetchone()
+		c.execute(
+			"""
+				INSERT INTO {id_blocks} (name, next_id) VALUES (:column, :next_id)
+				ON CONFLICT (name) DO UPDATE SET next_id = excluded.next_id;
+			""".format(**tables()),
+			{ 'column':column, 'next_id':first_id + count }
+		)
+	return first_id
+
+
+def empty_tables():
+	"""clear the tables of any processing results
+		but NOT of original data from the API"""
+	with transaction() as c:
+		c.execute( "DELETE FROM {stop_times};".format(**tables()) )
+		c.execute(
+			"""
+				UPDATE {trips} SET
+					service_id = NULL,
+					match_confidence = NULL,
+					ignore = 1,
+					clean_geom = NULL,
+					problem = '',
+					match_geom = NULL,
+					version = NULL;
+			""".format(**tables())
+		)
+
+
+def ignore_trip(trip_id,reason=None):
+	"""mark a trip to be ignored"""
+	with transaction() as c:
+		c.execute(
+			"UPDATE {trips} SET ignore = 1 WHERE trip_id = :trip_id;".format(**tables()),
+			{ 'trip_id': trip_id }
+		)
+		c.execute(
+			"DELETE FROM {stop_times} WHERE trip_id = :trip_id;".format(**tables()),
+			{ 'trip_id': trip_id }
+		)
+	if reason:
+		flag_trip(trip_id,reason)
+
+
+def flag_trip(trip_id,problem_description_string):
+	"""Populate the 'problem' field of trip table: something must
+		have gone wrong and this tells us what."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET problem = problem || :description
+			WHERE trip_id = :trip_id;
+		""".format(**tables()),
+		{ 'description':problem_description_string, 'trip_id':trip_id }
+	)
+
+
+def add_trip_match(trip_id,confidence,wkb_geometry_match):
+	"""update the trip record with it's matched geometry"""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips}
+			SET match_confidence = :confidence, match_geom = :match
+			WHERE trip_id = :trip_id;
+		""".format(**tables()),
+		{
+			'confidence':float(confidence),
+			'match':wkb(wkb_geometry_match),
+			'trip_id':trip_id
+		}
+	)
+
+
+def insert_trip(trip_id,block_id,route_id,direction_id,vehicle_id,vehicles,
+	in_progress=False):
+	"""Store the basics of the trip in the database, with its vehicle reports
+		encoded by track.encode() and the local day of the first vehicle
+		report as its start_day, marking it if it is still in progress, as
+		db_postgres.insert_trip() does."""
+	c = cursor()
+	c.execute(
+		"""
+			INSERT INTO {trips}
+				( trip_id, block_id, route_id, direction_id, vehicle_id,
+				track, start_time, end_time, num_points, track_length, start_day,
+				problem )
+			VALUES
+				( :trip_id, :block_id, :route_id, :direction_id, :vehicle_id,
+				:track, :start_time, :end_time, :num_points, :track_length,
+				:start_day, :problem );
+		""".format(**tables()),
+		{
+			'trip_id':trip_id,
+			'block_id':block_id,
+			'route_id':route_id,
+			'direction_id':direction_id,
+			'vehicle_id':vehicle_id,
+			'track':track.encode(vehicles),
+			'start_time':vehicles[0].time,
+			'end_time':vehicles[-1].time,
+			'num_points':len(vehicles),
+			'track_length':track.length(vehicles),
+			'start_day':local_day(vehicles[0].time),
+			'problem':'in progress' if in_progress else ''
+		}
+	)
+
+
+def update_trip_track(trip_id,vehicles):
+	"""Replace the vehicle reports of a trip stored while still in progress
+		with those of the whole trip."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET track = :track, end_time = :end_time,
+				num_points = :num_points, track_length = :track_length
+			WHERE trip_id = :trip_id;
+		""".format(**tables()),
+		{
+			'trip_id':trip_id,
+			'track':track.encode(vehicles),
+			'end_time':vehicles[-1].time,
+			'num_points':len(vehicles),
+			'track_length':track.length(vehicles)
+		}
+	)
+
+
+def get_direction_uid(direction_id,trip_time):
+	"""Find the correct direction entry based on the direction_id and the time
+		of the trip, or None. Trip_time is an epoch value, direction_id is a
+		string."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT uid
+			FROM {directions}
+			WHERE direction_id = :direction_id AND report_time <= :trip_time
+			ORDER BY report_time DESC
+			LIMIT 1
+		""".format(**tables()),
+		{ 'direction_id':direction_id, 'trip_time':trip_time }
+	)
+	result = c.fetchone()
+	return result[0] if result else None
+
+
+def get_stops(direction_id, trip_time):
+	"""Get an ordered list of Stop objects from the schedule data."""
+	c = cursor()
+	# get the uid of the relevant direction entry
+	direction_uid = get_direction_uid(direction_id,trip_time)
+	if not direction_uid: return None
+	c.execute(
+		"SELECT stops FROM {directions} WHERE uid = :uid".format(**tables()),
+		{ 'uid':direction_uid }
+	)
+	(stop_ids,) = c.fetchone()
+	stop_ids = json.loads(stop_ids)
+	# the earliest report of each stop, later reports being overwritten
+	c.execute(
+		"""
+			SELECT stop_id, uid, the_geom
+			FROM {stops}
+			WHERE
+				stop_id IN (SELECT value FROM json_each(:stop_ids)) AND
+				report_time <= :trip_time
+			ORDER BY report_time DESC
+		""".format(**tables()),
+		{ 'stop_ids':json.dumps(stop_ids), 'trip_time':trip_time }
+	)
+	earliest = { stop_id: (uid, geom) for stop_id, uid, geom in c.fetchall() }
+	# return a schedule-ordered list of unique stop objects
+	stops = []
+	for stop_id in stop_ids:
+		if stop_id in earliest:
+			uid, geom = earliest.pop(stop_id)
+			stops.append( Stop( uid, geom.hex() ) )
+	return stops
+
+
+def get_route_geom(direction_id, trip_time):
+	"""Get the geometry of a direction or return None. This is meant to be a
+		backup in case map-matching is going badly. Direction geometries must be
+		supplied manually."""
+	uid = get_direction_uid(direction_id,trip_time)
+	if not uid: return None
+	c = cursor()
+	c.execute(
+		"SELECT route_geom FROM {directions} WHERE uid = :uid;".format(**tables()),
+		{ 'uid':uid }
+	)
+	geom, = c.fetchone()
+	return loadWKB(geom) if geom else None
+
+
+def set_trip_clean_geom(trip_id,localWKBgeom):
+	"""Store a geometry of the input to the matching process"""
+	c = cursor()
+	c.execute(
+		"UPDATE {trips} SET clean_geom = :geom WHERE trip_id = :trip_id;".format(**tables()),
+		{ 'trip_id':trip_id, 'geom':wkb(localWKBgeom) }
+	)
+
+
+def get_trip_problem(trip_id):
+	"""What problem was associated with the processing of this trip?"""
+	c = cursor()
+	c.execute(
+		"SELECT problem FROM {trips} WHERE trip_id = :trip_id;".format(**tables()),
+		{ 'trip_id':trip_id }
+	)
+	problem, = c.fetchone()
+	return problem if problem != '' else None
+
+
+def store_timepoints(trip_id,timepoints,first_sequence=1):
+	"""Store the estimated stop times for a trip, numbered on from
+		first_sequence as db_postgres.store_timepoints() does."""
+	assert len(timepoints) > 0
+	# be sure the timepoints are in ascending temporal order
+	timepoints = sorted(timepoints,key=lambda tp: tp.arrival_time)
+	with transaction() as c:
+		# stop times take the start_day of their trip
+		c.execute(
+			"SELECT start_day FROM {trips} WHERE trip_id = :trip_id;".format(**tables()),
+			{ 'trip_id':trip_id }
+		)
+		(start_day,) = c.fetchone()
+		c.executemany(
+			"""
+				INSERT INTO {stop_times} (trip_id, stop_uid, etime, stop_sequence, start_day)
+				VALUES (?, ?, ?, ?, ?)
+			""".format(**tables()),
+			[ (trip_id,tp.stop_id,tp.arrival_time,seq,start_day)
+				for seq, tp in enumerate(timepoints,first_sequence) ]
+		)
+
+
+def store_trip_quality(trip_id,route_id,start_time,outcome,
+	stops_scheduled,stops_made,confidence,default_route_used):
+	"""Record measures of the quality of a processed trip, and add them to
+		the running totals for its route and day, first removing those of
+		any earlier processing of the same trip."""
+	bin_index = coverage_bin(stops_scheduled,stops_made,outcome)
+	if confidence is not None:
+		confidence = float(confidence)
+	with transaction() as c:
+		# back out any earlier record of this trip
+		c.execute(
+			"""
+				SELECT route_id, day, outcome, coverage_bin, confidence, default_route
+				FROM {trip_quality} WHERE trip_id = :trip_id
+			""".format(**tables()),
+			{ 'trip_id':trip_id }
+		)
+		old = c.fetchone()
+		if old:
+			add_route_quality(c,-1,*old)
+			c.execute(
+				"DELETE FROM {trip_quality} WHERE trip_id = :trip_id".format(**tables()),
+				{ 'trip_id':trip_id }
+			)
+		day = local_day(start_time)
+		c.execute(
+			"""
+				INSERT INTO {trip_quality} (
+					trip_id, route_id, day, outcome,
+					stops_scheduled, stops_made, coverage_bin,
+					confidence, default_route
+				) VALUES (
+					:trip_id, :route_id, :day, :outcome,
+					:stops_scheduled, :stops_made, :bin,
+					:confidence, :default_route
+				)
+			""".format(**tables()),
+			{
+				'trip_id':trip_id,
+				'route_id':route_id,
+				'day':day,
+				'outcome':outcome,
+				'stops_scheduled':stops_scheduled,
+				'stops_made':stops_made,
+				'bin':bin_index,
+				'confidence':confidence,
+				'default_route':default_route_used
+			}
+		)
+		add_route_quality(c,1,route_id,day,outcome,bin_index,confidence,default_route_used)
+
+
+def add_route_quality(c,n,route_id,day,outcome,bin_index,confidence,default_route):
+	"""Add (n=1) or remove (n=-1) a trip from the totals for its route and
+		day. The coverage histogram is updated here rather than in SQL."""
+	c.execute(
+		"""
+			SELECT coverage FROM {route_quality}
+			WHERE route_id = :route_id AND day = :day
+		""".format(**tables()),
+		{ 'route_id':route_id, 'day':day }
+	)
+	row = c.fetchone()
+	coverage = json.loads(row[0]) if row else [0] * coverage_bins
+	coverage[bin_index-1] += n
+	c.execute(
+		"""
+			INSERT INTO {route_quality} (
+				route_id, day, num_trips,
+				num_success, num_match_problem, num_ignored, num_default_route,
+				num_confidence, sum_confidence, coverage
+			) VALUES (
+				:route_id, :day, :n,
+				:success, :match_problem, :ignored, :default_route,
+				:num_confidence, :confidence, :coverage
+			)
+			ON CONFLICT (route_id, day) DO UPDATE SET
+				num_trips = num_trips + excluded.num_trips,
+				num_success = num_success + excluded.num_success,
+				num_match_problem = num_match_problem + excluded.num_match_problem,
+				num_ignored = num_ignored + excluded.num_ignored,
+				num_default_route = num_default_route + excluded.num_default_route,
+				num_confidence = num_confidence + excluded.num_confidence,
+				sum_confidence = sum_confidence + excluded.sum_confidence,
+				coverage = excluded.coverage;
+		""".format(**tables()),
+		{
+			'route_id':route_id,
+			'day':day,
+			'n':n,
+			'success':n * (outcome == 'success'),
+			'match_problem':n * (outcome == 'match problem'),
+			'ignored':n * (outcome == 'ignored'),
+			'default_route':n * bool(default_route),
+			'num_confidence':n * (confidence is not None),
+			'confidence':n * (confidence or 0),
+			'coverage':json.dumps(coverage)
+		}
+	)
+
+
+def get_timepoints(trip_id):
+	"""Essentially, this should be the inverse of the above function."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT stop_uid, etime, stop_sequence
+			FROM {stop_times}
+			WHERE trip_id = :trip_id
+			ORDER BY stop_sequence
+		""".format(**tables()),
+		{ 'trip_id':trip_id }
+	)
+	return c.fetchall()
+
+
+def try_storing_stop(stop_id,stop_name,stop_code,lon,lat):
+	"""we have received a report of a stop from the routeConfig
+		data. Is this a new stop? Have we already heard of it?
+		Store it with the current time unless nothing about it
+		has changed."""
+	lon, lat = float(lon), float(lat)
+	c = cursor()
+	c.execute(
+		"""
+			SELECT 1
+			FROM {stops}
+			WHERE
+				stop_id = :stop_id AND
+				stop_name = :stop_name AND
+				stop_code = :stop_code AND
+				ABS(lon - :lon) <= 0.0001 AND
+				ABS(lat - :lat) <= 0.0001;
+		""".format(**tables()),
+		{
+			'stop_id':stop_id,
+			'stop_name':stop_name,
+			'stop_code':stop_code,
+			'lon':lon,
+			'lat':lat
+		}
+	)
+	# if any result, we already have this stop
+	if c.fetchone():
+		return
+	c.execute(
+		"""
+			INSERT INTO {stops} (
+				stop_id, stop_name, stop_code, the_geom, lon, lat, report_time
+			) VALUES (
+				:stop_id, :stop_name, :stop_code, :geom, :lon, :lat, :report_time
+			)
+		""".format(**tables()),
+		{
+			'stop_id':stop_id,
+			'stop_name':stop_name,
+			'stop_code':stop_code,
+			'geom':reproject( conf['projection'], Point(lon,lat) ).wkb,
+			'lon':lon,
+			'lat':lat,
+			'report_time':time.time()
+		}
+	)
+
+
+def try_storing_direction(route_id,did,title,name,branch,useforui,stops):
+	"""we have recieved a report of a route direction from the
+		routeConfig data. Store it with the current time unless
+		absolutely nothing about it has changed."""
+	params = {
+		'route_id':route_id,
+		'did':did,
+		'title':title,
+		'name':name,
+		'branch':branch,
+		'useforui':str(useforui).lower() == 'true',
+		'stops':json.dumps(stops),
+		'report_time':time.time()
+	}
+	c = cursor()
+	c.execute(
+		"""
+			SELECT 1 FROM {directions}
+			WHERE
+				route_id = :route_id AND
+				direction_id = :did AND
+				title = :title AND
+				name = :name AND
+				branch = :branch AND
+				useforui = :useforui AND
+				stops = :stops;
+		""".format(**tables()),
+		params
+	)
+	if c.fetchone():
+		return # already have the record
+	c.execute(
+		"""
+			INSERT INTO {directions}
+				( route_id, direction_id, title, name, branch, useforui,
+				stops, report_time )
+			VALUES
+				( :route_id, :did, :title, :name, :branch, :useforui,
+				:stops, :report_time )
+		""".format(**tables()),
+		params
+	)
+
+
+def scrub_trip(trip_id):
+	"""Un-mark any flag fields and leave the DB record
+		as though newly collected and unprocessed. The processing version
+		is cleared too, and set again only once the trip has an outcome."""
+	scrub_trips([trip_id])
+
+
+def accept_trip(trip_id,version=None):
+	"""Mark a trip matched while in progress as processed, making the stop
+		times stored along the way part of the results."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {trips} SET problem = '', ignore = 0, version = :version
+			WHERE trip_id = :trip_id;
+		""".format(**tables()),
+		{ 'trip_id':trip_id, 'version':version }
+	)
+
+
+def set_trip_version(trip_id,version):
+	"""Record the processing version that gave a trip its outcome."""
+	c = cursor()
+	c.execute(
+		"UPDATE {trips} SET version = :version WHERE trip_id = :trip_id;".format(**tables()),
+		{ 'trip_id':trip_id, 'version':version }
+	)
+
+
+def scrub_trips(trip_ids):
+	"""Set-based version of scrub_trip() for many trips at once, leaving
+		them as though newly collected and unprocessed."""
+	params = { 'trip_ids':json.dumps(list(trip_ids)) }
+	with transaction() as c:
+		c.execute(
+			"""
+				UPDATE {trips} SET
+					match_confidence = NULL,
+					match_geom = NULL,
+					clean_geom = NULL,
+					problem = '',
+					ignore = 0,
+					service_id = NULL,
+					version = NULL
+				WHERE trip_id IN (SELECT value FROM json_each(:trip_ids));
+			""".format(**tables()),
+			params
+		)
+		c.execute(
+			"""
+				DELETE FROM {stop_times}
+				WHERE trip_id IN (SELECT value FROM json_each(:trip_ids));
+			""".format(**tables()),
+			params
+		)
+
+
+def trip_filter(min_id=None,max_id=None,route_id=None,
+	start_date=None,end_date=None,unfinished=False,version=None,new_since=None):
+	"""Build a WHERE clause and parameters selecting trips from the trips
+		table, as db_postgres.trip_filter() does."""
+	conditions = ["problem <> 'in progress'"]
+	if min_id is not None:
+		conditions.append('trip_id >= :min_id')
+	if max_id is not None:
+		conditions.append('trip_id <= :max_id')
+	if route_id is not None:
+		conditions.append('route_id = :route_id')
+	if start_date is not None:
+		conditions.append("start_time >= :start_time")
+	if end_date is not None:
+		conditions.append("start_time < :end_time")
+	if unfinished:
+		conditions.append("problem IN ('','connection issue','match problem') AND ignore")
+	if version is not None and new_since is not None:
+		conditions.append('(trip_id > :new_since OR version IS NULL) AND version IS NOT :version')
+	elif version is not None:
+		conditions.append('version IS NOT :version')
+	params = {
+		'min_id':min_id,
+		'max_id':max_id,
+		'route_id':route_id,
+		'start_time':local_midnight(start_date) if start_date else None,
+		'end_time':local_midnight(end_date,1) if end_date else None,
+		'version':version,
+		'new_since':new_since
+	}
+	return ' AND '.join(conditions), params
+
+
+def get_trip_ids(**filters):
+	"""return a list of all trip ids matching the filters of trip_filter()"""
+	where, params = trip_filter(**filters)
+	c = cursor()
+	c.execute(
+		"SELECT trip_id FROM {trips} WHERE ".format(**tables())
+		+ where + " ORDER BY trip_id ASC;",
+		params
+	)
+	return [ result for (result,) in c.fetchall() ]
+
+
+def get_trip_ids_by_range(min_id,max_id):
+	"""return a list of all trip ids in the specified range"""
+	return get_trip_ids(min_id=min_id,max_id=max_id)
+
+
+def get_trip_ids_by_route(route_id):
+	"""return a list of all trip ids operating a given route"""
+	return get_trip_ids(route_id=route_id)
+
+
+def get_trips_in_progress():
+	"""return ( trip_id, route_id ) of each trip still marked as in progress"""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT trip_id, route_id FROM {trips}
+			WHERE problem = 'in progress' ORDER BY trip_id ASC;
+		""".format(**tables())
+	)
+	return c.fetchall()
+
+
+def get_trip_ids_unfinished():
+	"""return a list of trip ids not yet processed sucessfully"""
+	return get_trip_ids(unfinished=True)
+
+
+def get_trip_set_size(**filters):
+	"""Count the trips and vehicle reports matching the filters of
+		trip_filter(), for estimating the cost of processing them."""
+	where, params = trip_filter(**filters)
+	c = cursor()
+	c.execute(
+		"""
+			SELECT COUNT(*), COALESCE(SUM(num_points),0)
+			FROM {trips} WHERE """.format(**tables()) + where + ";",
+		params
+	)
+	num_trips, num_points = c.fetchone()
+	return num_trips, num_points
+
+
+def get_trip_sizes(**filters):
+	"""Return (trip_id, number of vehicle reports, track length in meters)
+		for trips matching the filters of trip_filter()."""
+	where, params = trip_filter(**filters)
+	c = cursor()
+	c.execute(
+		"""
+			SELECT trip_id, COALESCE(num_points,0), COALESCE(track_length,0)
+			FROM {trips} WHERE """.format(**tables()) + where + """
+			ORDER BY trip_id ASC;
+		""",
+		params
+	)
+	return c.fetchall()
+
+
+def enqueue_trips(weights,**filters):
+	"""Add the trips matching the filters of trip_filter() to the work
+		queue, resetting any already there. weights are the (point, squared
+		point, km) terms of the cost estimate. Returns the number of trips
+		queued. With SQLite, the queue is shared only by workers on this
+		host."""
+	point_cost, squared_point_cost, km_cost = weights
+	sizes = get_trip_sizes(**filters)
+	with transaction() as c:
+		c.executemany(
+			"""
+				INSERT INTO {claims} (trip_id, cost) VALUES (?, ?)
+				ON CONFLICT (trip_id) DO UPDATE SET
+					cost = excluded.cost,
+					worker = NULL,
+					lease_expires = NULL,
+					attempts = 0,
+					done = 0;
+			""".format(**tables()),
+			[ (trip_id, point_cost*n + squared_point_cost*n**2 + km_cost*length/1000)
+				for trip_id, n, length in sizes ]
+		)
+	return len(sizes)
+
+
+def claim_trips(worker,lease_seconds,limit,max_attempts):
+	"""Lease up to limit unfinished trips from the work queue to the named
+		worker, most costly first, as db_postgres.claim_trips() does. The
+		write lock keeps concurrent workers from claiming the same trips.
+		Returns a list of (trip_id, cost) tuples."""
+	now = time.time()
+	with transaction() as c:
+		c.execute(
+			"""
+				SELECT trip_id, cost
+				FROM {claims}
+				WHERE
+					NOT done AND
+					attempts < :max_attempts AND
+					( worker IS NULL OR lease_expires < :now )
+				ORDER BY cost DESC
+				LIMIT :limit
+			""".format(**tables()),
+			{ 'max_attempts':max_attempts, 'now':now, 'limit':limit }
+		)
+		claimed = c.fetchall()
+		c.executemany(
+			"""
+				UPDATE {claims} SET
+					worker = ?,
+					lease_expires = ?,
+					attempts = attempts + 1
+				WHERE trip_id = ?
+			""".format(**tables()),
+			[ (worker, now+lease_seconds, trip_id) for trip_id, cost in claimed ]
+		)
+	return claimed
+
+
+def renew_claims(worker,lease_seconds):
+	"""Heartbeat: extend the leases on all trips held by a worker."""
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {claims} SET lease_expires = :expires
+			WHERE worker = :worker AND NOT done;
+		""".format(**tables()),
+		{ 'worker':worker, 'expires':time.time()+lease_seconds }
+	)
+
+
+def release_claims(worker,trip_ids,done=True):
+	"""Give up a worker's leases on the given trips, marking them done or
+		leaving them to be claimed again."""
+	if len(trip_ids) == 0:
+		return
+	c = cursor()
+	c.execute(
+		"""
+			UPDATE {claims} SET
+				worker = NULL,
+				lease_expires = NULL,
+				done = :done
+			WHERE
+				worker = :worker AND
+				trip_id IN (SELECT value FROM json_each(:trip_ids));
+		""".format(**tables()),
+		{ 'worker':worker, 'trip_ids':json.dumps(list(trip_ids)), 'done':done }
+	)
+
+
+def count_open_claims(max_attempts):
+	"""Count queued trips which are not done and may still be attempted,
+		whether or not they are currently leased."""
+	c = cursor()
+	c.execute(
+		"""
+			SELECT COUNT(*) FROM {claims}
+			WHERE NOT done AND attempts < :max_attempts;
+		""".format(**tables()),
+		{ 'max_attempts':max_attempts }
+	)
+	(count,) = c.fetchone()
+	return count
+
+
+def get_watermark(name):
+	"""Return the (trip_id, processing version) recorded by the last
+		completed run of the given name, or (None, None)."""
+	c = cursor()
+	c.execute(
+		"SELECT trip_id, version FROM {watermarks} WHERE name = :name;".format(**tables()),
+		{ 'name':name }
+	)
+	return c.fetchone() or (None, None)
+
+
+def set_watermark(name,trip_id,version):
+	"""Record the highest trip_id and the processing version of a
+		completed run."""
+	c = cursor()
+	c.execute(
+		"""
+			INSERT INTO {watermarks} (name, trip_id, version, report_time)
+			VALUES ( :name, :trip_id, :version, :report_time )
+			ON CONFLICT (name) DO UPDATE SET
+				trip_id = excluded.trip_id,
+				version = excluded.version,
+				report_time = excluded.report_time;
+		""".format(**tables()),
+		{ 'name':name, 'trip_id':trip_id, 'version':version, 'report_time':time.time() }
+	)
+
+
+def trip_exists(trip_id):
+	"""Check whether a trip exists in the database,
+		returning boolean."""
+	c = cursor()
+	c.execute(
+		"SELECT EXISTS (SELECT 1 FROM {trips} WHERE trip_id = :trip_id)".format(**tables()),
+		{ 'trip_id':trip_id }
+	)
+	(existence,) = c.fetchone()
+	return bool(existence)
@@ -35,7 +35,7 @@ WITH stops_made AS (
 	FROM :trips_table AS t
 	JOIN :directions_table AS d 
 		ON t.direction_id = d.direction_id AND
-		d.report_time <= t.times[array_upper(t.times,1)]
+		d.report_time <= t.end_time
 	ORDER BY t.trip_id, d.report_time ASC
 )
 SELECT 
@@ -0,0 +1,66 @@
+/*
+	Reads the route quality measures accumulated while trips are processed, 
+	giving much the same results as route-quality-measures.sql without 
+	re-aggregating the stop_times table. Set the table prefix and the range 
+	of local dates to summarize.
+*/
+
+-- set your table names here
+\set prefix					ttc_
+\set first_date			'2018-01-01'
+\set last_date				'2018-01-31'
+
+\set route_quality_table	:prefix'route_quality'
+
+
+WITH days AS (
+	SELECT * FROM :route_quality_table
+	WHERE day BETWEEN 
+		:'first_date'::date - 'epoch'::date AND 
+		:'last_date'::date - 'epoch'::date
+), totals AS (
+	SELECT
+		route_id,
+		SUM(num_trips) AS num_trips,
+		SUM(num_success) AS num_success,
+		SUM(num_match_problem) AS num_match_problem,
+		SUM(num_ignored) AS num_ignored,
+		SUM(num_default_route) AS num_default_route,
+		SUM(sum_confidence) / NULLIF(SUM(num_confidence),0) AS avg_confidence
+	FROM days
+	GROUP BY route_id
+), bins AS (
+	-- add up the coverage histograms, skipping the first bin of trips 
+	-- which never had stops located
+	SELECT route_id, b.i AS bin, SUM(b.n) AS n
+	FROM days, unnest(coverage) WITH ORDINALITY AS b(n,i)
+	WHERE b.i > 1
+	GROUP BY route_id, b.i
+), cumulative AS (
+	SELECT 
+		route_id, 
+		bin,
+		SUM(n) OVER (PARTITION BY route_id ORDER BY bin) AS below,
+		SUM(n) OVER (PARTITION BY route_id) AS total
+	FROM bins
+), quantiles AS (
+	SELECT route_id, q, MIN(bin) AS bin
+	FROM cumulative, unnest(array[.05,.25,.5,.75,.95]) AS q
+	WHERE total > 0 AND below >= q * total
+	GROUP BY route_id, q
+)
+SELECT 
+	t.route_id,
+	t.num_trips,
+	t.num_success,
+	t.num_match_problem,
+	t.num_ignored,
+	t.num_default_route,
+	-- stops made / stops scheduled; bin 2 holds zero
+	array_agg( (q.bin - 2) / 100.0 ORDER BY q.q ) AS stop_quintiles,
+	round( t.avg_confidence::numeric, 4 ) AS avg_confidence
+FROM totals AS t
+LEFT JOIN quantiles AS q ON q.route_id = t.route_id
+GROUP BY t.route_id, t.num_trips, t.num_success, t.num_match_problem, 
+	t.num_ignored, t.num_default_route, t.avg_confidence
+ORDER BY avg_confidence ASC;
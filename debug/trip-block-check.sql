@@ -3,13 +3,13 @@
 		trip_id,
 		block_id,
 		direction_id,
-		times[1]::int AS first_time,
-		times[array_upper(times,1)]::int AS last_time,
-		timestamp 'epoch' + times[1]::int * INTERVAL '1s' AS day,
-		row_number() OVER (ORDER BY times[1]) AS seq
+		start_time::int AS first_time,
+		end_time::int AS last_time,
+		timestamp 'epoch' + start_time::int * INTERVAL '1s' AS day,
+		row_number() OVER (ORDER BY start_time) AS seq
 	FROM ttc_trips
 	WHERE vehicle_id = '4202' 
-	ORDER BY times[1]
+	ORDER BY start_time
 )
 SELECT 
 	s1.trip_id,
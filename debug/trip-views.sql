@@ -48,8 +48,8 @@ SELECT DISTINCT ON (t.trip_id, s.stop_id)
 FROM :trips_table AS t
 JOIN :directions_table AS d ON 
 	t.direction_id = d.direction_id AND
-	d.report_time <= t.times[array_upper(t.times,1)]
+	d.report_time <= t.end_time
 JOIN :stops_table AS s ON 
 	s.stop_id = ANY(d.stops) AND
-	s.report_time <= t.times[array_upper(t.times,1)]
+	s.report_time <= t.end_time
 ORDER BY t.trip_id, s.stop_id, d.report_time, s.report_time ASC
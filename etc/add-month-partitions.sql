@@ -0,0 +1,85 @@
+/*
+	Adds monthly partitions to the tables created by 
+	create-partitioned-tables.sql, e.g. for the coming months. It is included 
+	by that script, or can be run on its own with psql after setting the 
+	variables below. Partitions are named like ttc_trips_2018_01.
+
+	An old month can be removed from the live tables without rewriting 
+	anything, e.g.:
+		ALTER TABLE ttc_trips DETACH PARTITION ttc_trips_2018_01;
+		ALTER TABLE ttc_stop_times DETACH PARTITION ttc_stop_times_2018_01;
+
+	PostgreSQL won't create a partition for a month while the default 
+	partition holds rows for it, as it does once a month is collected before 
+	its partition was added. In that case the default partition is detached, 
+	the month's partition created, its rows moved there from the default 
+	and the default attached again, all in one transaction. The tables are 
+	locked meanwhile, so stop collecting first if the default holds many 
+	rows. Months that already have a partition are left alone.
+*/
+
+\if :{?month_table_prefix}
+	-- included from create-partitioned-tables.sql
+\else
+	\set prefix					ttc_
+	\set first_month			'2018-01-01'
+	\set num_months			3
+	\set month_table_prefix	:prefix
+\endif
+
+SELECT set_config('retro.prefix', :'month_table_prefix', FALSE);
+SELECT set_config('retro.first_month', :'first_month', FALSE);
+SELECT set_config('retro.num_months', :'num_months', FALSE);
+
+DO $$
+DECLARE
+	prefix text := current_setting('retro.prefix');
+	month date;
+	first_day integer;
+	last_day integer;
+	tbl text;
+	parent text;
+	part text;
+	dflt text;
+	stranded boolean;
+BEGIN
+	FOR i IN 0 .. current_setting('retro.num_months')::integer - 1 LOOP
+		month := date_trunc('month', current_setting('retro.first_month')::date) 
+			+ i * INTERVAL '1 month';
+		-- partition bounds in days since the epoch, as start_day
+		first_day := month - 'epoch'::date;
+		last_day := (month + INTERVAL '1 month')::date - 'epoch'::date;
+		FOREACH tbl IN ARRAY ARRAY['trips','stop_times'] LOOP
+			parent := prefix || tbl;
+			part := parent || '_' || to_char(month,'YYYY_MM');
+			dflt := parent || '_default';
+			CONTINUE WHEN to_regclass(quote_ident(part)) IS NOT NULL;
+			-- are there rows for this month in the default partition?
+			stranded := FALSE;
+			IF to_regclass(quote_ident(dflt)) IS NOT NULL THEN
+				EXECUTE format(
+					'SELECT EXISTS (SELECT 1 FROM %I WHERE start_day >= %s AND start_day < %s)',
+					dflt, first_day, last_day
+				) INTO stranded;
+			END IF;
+			IF stranded THEN
+				EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, dflt);
+			END IF;
+			EXECUTE format(
+				'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%s) TO (%s)',
+				part, parent, first_day, last_day
+			);
+			IF stranded THEN
+				-- with the default detached, the rows are routed to the new partition
+				EXECUTE format(
+					'WITH moved AS ( DELETE FROM %I WHERE start_day >= %s AND start_day < %s RETURNING * ) '
+					'INSERT INTO %I SELECT * FROM moved',
+					dflt, first_day, last_day, parent
+				);
+				EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I DEFAULT', parent, dflt);
+				RAISE NOTICE 'moved rows for % from % to %', to_char(month,'YYYY-MM'), dflt, part;
+			END IF;
+		END LOOP;
+	END LOOP;
+END
+$$;
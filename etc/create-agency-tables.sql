@@ -15,6 +15,11 @@
 \set directions_table	:prefix'directions'
 \set trips_table			:prefix'trips'
 \set stop_times_table	:prefix'stop_times'
+\set claims_table			:prefix'claims'
+\set watermarks_table		:prefix'watermarks'
+\set id_blocks_table		:prefix'id_blocks'
+\set trip_quality_table	:prefix'trip_quality'
+\set route_quality_table	:prefix'route_quality'
 
 /*
 	equivalent to GTFS stops table
@@ -30,7 +35,7 @@ CREATE TABLE :stops_table (
 	the_geom geometry( POINT, :EPSG ),
 	report_time double precision -- epoch time
 );
-CREATE INDEX ON :stops_table (stop_id);
+CREATE INDEX ON :stops_table (stop_id, report_time) INCLUDE (uid);
 
 
 /*
@@ -51,7 +56,8 @@ CREATE TABLE :directions_table (
 	report_time double precision, -- epoch time
 	route_geom geometry( LINESTRING, :EPSG ) -- optional default route geometry
 );
-CREATE INDEX ON :directions_table (direction_id);
+-- covers finding the latest version of a direction at a given time
+CREATE INDEX ON :directions_table (direction_id, report_time DESC) INCLUDE (uid);
 
 /*
 	Data on vehilce locations fetched from the API gets stored here along 
@@ -61,16 +67,22 @@ CREATE INDEX ON :directions_table (direction_id);
 DROP TABLE IF EXISTS :trips_table;
 CREATE TABLE :trips_table (
 	trip_id integer PRIMARY KEY,
-	-- linestring geometry with a point corresponding to each reported location
-	-- correspends to "times", below
-	orig_geom geometry( LINESTRING, :EPSG ),	
-	-- sequential vehicle report times, corresponding to points on orig_geom
-	-- times are in UNIX epoch
-	times double precision[],
+	-- sequential vehicle report times and locations, compactly encoded by 
+	-- track.py: delta-encoded integer times and WGS84 coordinates
+	track bytea,
+	-- first and last report times, in UNIX epoch
+	start_time double precision,
+	end_time double precision,
+	-- number of vehicle reports and their length in meters, for estimating 
+	-- the cost of processing
+	num_points integer,
+	track_length real,
 	route_id varchar,
 	direction_id varchar,
 	-- service_id is a local variant on the number of days since the UNIX epoch
 	service_id smallint,
+	-- the same for the first vehicle report, known as soon as the trip is stored
+	start_day smallint,
 	vehicle_id varchar,
 	block_id integer,
 	match_confidence real,
@@ -79,9 +91,24 @@ CREATE TABLE :trips_table (
 	-- debugging fields
 	match_geom geometry( MULTILINESTRING, :EPSG ), -- map-matched route geometry
 	clean_geom geometry( LINESTRING, :EPSG ), -- geometry of points used in map matching
-	problem varchar DEFAULT '' -- description of any problems that arise
+	problem varchar DEFAULT '', -- description of any problems that arise
+	-- code and configuration version the trip was last processed with
+	-- NULL if never processed
+	version varchar
 );
-CREATE INDEX ON :trips_table (trip_id);
+-- finds trips not yet processed, for incremental runs
+CREATE INDEX ON :trips_table (trip_id) WHERE version IS NULL;
+-- trips by route, for processing a route
+CREATE INDEX ON :trips_table (route_id, trip_id);
+-- trips which haven't been processed sucessfully yet
+CREATE INDEX ON :trips_table (trip_id) 
+	WHERE ignore AND problem IN ('','connection issue','match problem');
+-- trips to be exported for a set of service days
+CREATE INDEX ON :trips_table (service_id) WHERE NOT ignore;
+-- trips by the time of their first vehicle report, for processing by date
+CREATE INDEX ON :trips_table (start_time);
+-- tracks are already compressed, so don't try again
+ALTER TABLE :trips_table ALTER COLUMN track SET STORAGE EXTERNAL;
 
 /*
 	Where interpolated stop times are stored for each trip. 
@@ -92,6 +119,85 @@ CREATE TABLE :stop_times_table (
 	stop_uid integer,
 	stop_sequence integer,
 	etime double precision, -- non-localized epoch time in seconds
-	fake_stop_id varchar -- allows for repeated visits of the same stop
+	fake_stop_id varchar, -- allows for repeated visits of the same stop
+	start_day smallint -- start_day of the trip
+);
+-- covers the stop times of a trip in order, e.g. for finding the first stop
+CREATE INDEX ON :stop_times_table (trip_id, stop_sequence) INCLUDE (stop_uid, etime);
+-- first stops by time, for selecting the trips of service days to export
+CREATE INDEX ON :stop_times_table (etime) INCLUDE (trip_id) WHERE stop_sequence = 1;
+
+/*
+	Shared work queue for processing. Trips are queued by process.py and 
+	leased to workers, possibly on many hosts, which keep their leases alive 
+	while they work. The leases of a crashed worker expire and the trips 
+	are handed out again.
+*/
+DROP TABLE IF EXISTS :claims_table;
+CREATE TABLE :claims_table (
+	trip_id integer PRIMARY KEY,
+	cost real, -- estimated cost of processing; costly trips are leased first
+	worker varchar, -- host:pid of the worker holding the lease, if any
+	lease_expires double precision, -- epoch time
+	attempts integer DEFAULT 0, -- times the trip has been leased
+	done boolean DEFAULT FALSE
+);
+CREATE INDEX ON :claims_table (cost DESC) WHERE NOT done;
+CREATE INDEX ON :claims_table (worker) WHERE NOT done;
+
+/*
+	The next trip_id and block_id to be reserved by a collector. Collectors 
+	take ids in blocks from here so that several can run at once.
+*/
+DROP TABLE IF EXISTS :id_blocks_table;
+CREATE TABLE :id_blocks_table (
+	name varchar PRIMARY KEY, -- 'trip_id' or 'block_id'
+	next_id integer
+);
+
+/*
+	The highest trip_id and the processing version of the last completed 
+	incremental processing run.
+*/
+DROP TABLE IF EXISTS :watermarks_table;
+CREATE TABLE :watermarks_table (
+	name varchar PRIMARY KEY,
+	trip_id integer,
+	version varchar,
+	report_time double precision -- epoch time
+);
+
+/*
+	Measures of the quality of each processed trip, written as it is 
+	processed, and running totals of the same by route and local day. See 
+	debug/route-quality-rollup.sql for reading them.
+*/
+DROP TABLE IF EXISTS :trip_quality_table;
+CREATE TABLE :trip_quality_table (
+	trip_id integer PRIMARY KEY,
+	route_id varchar,
+	day smallint, -- local days since the epoch of the first vehicle report
+	outcome varchar, -- 'success', 'match problem' or 'ignored'
+	stops_scheduled integer,
+	stops_made integer,
+	coverage_bin smallint, -- bin of the route_quality coverage histogram
+	confidence real,
+	default_route boolean
+);
+
+DROP TABLE IF EXISTS :route_quality_table;
+CREATE TABLE :route_quality_table (
+	route_id varchar,
+	day smallint,
+	num_trips integer,
+	num_success integer,
+	num_match_problem integer,
+	num_ignored integer,
+	num_default_route integer,
+	num_confidence integer, -- trips with a match confidence
+	sum_confidence double precision,
+	-- histogram of stops made / stops scheduled in hundredths from 0 to 2, 
+	-- preceded by a count of trips not matched against stops
+	coverage integer[],
+	PRIMARY KEY (route_id, day)
 );
-CREATE INDEX ON :stop_times_table (trip_id);
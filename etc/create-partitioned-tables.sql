@@ -0,0 +1,82 @@
+/*
+	Optional alternative to the trips and stop_times tables created by 
+	create-agency-tables.sql, for archives expected to grow large. Run that 
+	script first, then this one, which replaces the two tables with versions 
+	partitioned by month on start_day, the local day of a trip's first 
+	vehicle report. Old months can then be detached or dropped cheaply and 
+	each month's indexes stay small. 
+	
+	Partitions are created for the months given below. Rows falling outside 
+	them go to a default partition, so create the partitions for upcoming 
+	months ahead of time with add-month-partitions.sql.
+
+	Queries on one trip, as made while collecting and processing, select it 
+	by trip_id alone and so can't be pruned to its month: each probes the 
+	trip_id index of every attached partition. Their cost grows with the 
+	number of months attached rather than staying flat, so detach months 
+	that are no longer being processed. Queries by time, such as exports, 
+	are pruned as expected.
+*/
+
+-- set your table names here, as in create-agency-tables.sql
+\set EPSG 26917
+\set prefix					ttc_
+-- first month to create partitions for, and how many months
+\set first_month			'2018-01-01'
+\set num_months			24
+
+\set trips_table			:prefix'trips'
+\set stop_times_table	:prefix'stop_times'
+\set trips_default		:prefix'trips_default'
+\set stop_times_default	:prefix'stop_times_default'
+
+DROP TABLE IF EXISTS :trips_table;
+CREATE TABLE :trips_table (
+	trip_id integer,
+	track bytea,
+	start_time double precision,
+	end_time double precision,
+	num_points integer,
+	track_length real,
+	route_id varchar,
+	direction_id varchar,
+	service_id smallint,
+	start_day smallint NOT NULL, -- partition key
+	vehicle_id varchar,
+	block_id integer,
+	match_confidence real,
+	ignore boolean DEFAULT TRUE,
+	match_geom geometry( MULTILINESTRING, :EPSG ),
+	clean_geom geometry( LINESTRING, :EPSG ),
+	problem varchar DEFAULT '',
+	version varchar,
+	-- the partition key must be part of the primary key
+	PRIMARY KEY (trip_id, start_day)
+) PARTITION BY RANGE (start_day);
+-- the same indexes as the unpartitioned table; each partition gets its own
+CREATE INDEX ON :trips_table (trip_id) WHERE version IS NULL;
+CREATE INDEX ON :trips_table (route_id, trip_id);
+CREATE INDEX ON :trips_table (trip_id) 
+	WHERE ignore AND problem IN ('','connection issue','match problem');
+CREATE INDEX ON :trips_table (service_id) WHERE NOT ignore;
+CREATE INDEX ON :trips_table (start_time);
+
+DROP TABLE IF EXISTS :stop_times_table;
+CREATE TABLE :stop_times_table (
+	trip_id integer,
+	stop_uid integer,
+	stop_sequence integer,
+	etime double precision,
+	fake_stop_id varchar,
+	start_day smallint NOT NULL -- partition key, from the trip
+) PARTITION BY RANGE (start_day);
+CREATE INDEX ON :stop_times_table (trip_id, stop_sequence) INCLUDE (stop_uid, etime);
+CREATE INDEX ON :stop_times_table (etime) INCLUDE (trip_id) WHERE stop_sequence = 1;
+
+-- catch anything outside the monthly partitions
+CREATE TABLE :trips_default PARTITION OF :trips_table DEFAULT;
+CREATE TABLE :stop_times_default PARTITION OF :stop_times_table DEFAULT;
+
+-- monthly partitions
+\set month_table_prefix	:prefix
+\ir add-month-partitions.sql
@@ -0,0 +1,659 @@
+# Call this file to export processed trips from the database as a zipped
+# GTFS feed. This replaces running etc/pull-data.sql by hand, e.g.:
+#	python3 export.py 2018-01-01 2018-01-31 output/ttc.zip
+#	python3 export.py 2018-01-01 2018-01-07 output/mbta.zip --prefix mbta_
+#	python3 export.py 2018-01-01 2018-03-31 output/ttc.zip --cache output/cache/ttc
+# Service days are local dates, and the end date is included. Each GTFS
+# file is streamed out of the database on its own connection in parallel.
+# With a cache directory, each service day is kept there as a partition of
+# the feed and exported again only if that day's trips have changed.
+# The same trips can instead be written as Parquet datasets of trips, stop
+# times and track points partitioned by service day, which requires pyarrow:
+#	python3 export.py 2018-01-01 2018-01-31 output/ttc-parquet --parquet
+
+import argparse, io, os, shutil, tempfile, time, zipfile
+from concurrent.futures import ThreadPoolExecutor
+from math import floor
+from itertools import product, islice
+from shapely.wkb import loads as loadWKB
+from minor_objects import Vehicle
+import track
+# exporting is done in PostGIS, whichever backend collected the data
+import db_postgres as db
+from conf import conf
+
+# Trips to be exported, along with their service day, are selected once into
+# a staging table shared by the parallel connections. The service_id is the
+# number of days since the epoch of the local date of the first stop.
+staging_query = """
+	CREATE UNLOGGED TABLE {export_trips} AS
+	SELECT
+		t.trip_id,
+		t.route_id,
+		t.block_id,
+		( to_timestamp(st.etime) AT TIME ZONE %(tz)s )::date - 'epoch'::date AS service_id
+	FROM {trips} AS t
+	JOIN {stop_times} AS st ON
+		t.trip_id = st.trip_id AND st.stop_sequence = 1
+	WHERE
+		NOT t.ignore AND
+		st.etime >= EXTRACT(EPOCH FROM %(start)s::date::timestamp AT TIME ZONE %(tz)s) AND
+		st.etime < EXTRACT(EPOCH FROM (%(end)s::date + 1)::timestamp AT TIME ZONE %(tz)s);
+	CREATE INDEX ON {export_trips} (trip_id);
+	CREATE INDEX ON {export_trips} (service_id);
+	ANALYZE {export_trips};
+"""
+
+# the trips of a single service day, from those selected for the whole range
+day_staging_query = """
+	CREATE UNLOGGED TABLE {export_trips} AS
+	SELECT * FROM {range_trips} WHERE service_id = %(service_id)s;
+	CREATE INDEX ON {export_trips} (trip_id);
+	ANALYZE {export_trips};
+"""
+
+shapes_staging_query = """
+	CREATE UNLOGGED TABLE {export_shapes} (
+		trip_id integer PRIMARY KEY,
+		shape_id varchar,
+		canonical boolean -- this trip's geometry is used for the shape
+	);
+"""
+
+# A fingerprint of everything exported for each service day, including the 
+# stops visited. If it has not changed, neither has that day's partition of 
+# the feed.
+fingerprint_query = """
+	SELECT
+		d.service_id,
+		md5( d.trips || ';' || COALESCE(s.stops,'') )
+	FROM (
+		SELECT
+			et.service_id,
+			string_agg( 
+				concat_ws( ',', et.trip_id, t.route_id, t.block_id, t.version, 
+					t.match_confidence, st.num_stops, st.sum_uid, st.sum_etime ),
+				';' ORDER BY et.trip_id
+			) AS trips
+		FROM {export_trips} AS et
+		JOIN {trips} AS t ON t.trip_id = et.trip_id
+		LEFT JOIN (
+			SELECT
+				st.trip_id,
+				COUNT(*) AS num_stops,
+				SUM(st.stop_uid) AS sum_uid,
+				SUM(st.etime) AS sum_etime
+			FROM {stop_times} AS st
+			JOIN {export_trips} AS et ON st.trip_id = et.trip_id
+			GROUP BY st.trip_id
+		) AS st ON st.trip_id = et.trip_id
+		GROUP BY et.service_id
+	) AS d
+	LEFT JOIN (
+		SELECT
+			used.service_id,
+			md5( string_agg(
+				concat_ws( ',', s.uid, s.report_time, s.stop_code, s.stop_name, 
+					s.lon, s.lat ),
+				';' ORDER BY s.uid
+			) ) AS stops
+		FROM (
+			SELECT DISTINCT et.service_id, st.stop_uid
+			FROM {stop_times} AS st
+			JOIN {export_trips} AS et ON st.trip_id = et.trip_id
+		) AS used
+		JOIN {stops} AS s ON s.uid = used.stop_uid
+		GROUP BY used.service_id
+	) AS s ON s.service_id = d.service_id
+	ORDER BY d.service_id
+"""
+
+# Matched geometries of the exported trips, simplified as they will be in 
+# shapes.txt and grouped by direction
+shape_geometry_query = """
+	SELECT 
+		t.trip_id,
+		t.route_id,
+		t.direction_id,
+		ST_AsBinary(ST_Simplify(t.match_geom,10))
+	FROM {trips} AS t
+	JOIN {export_trips} AS et ON t.trip_id = et.trip_id
+	WHERE t.match_geom IS NOT NULL
+	ORDER BY t.route_id, t.direction_id, t.trip_id
+"""
+
+# Stop times with a fake_stop_id which distinguishes repeated visits to the
+# same stop by the same trip, e.g. '1234', '1234_', '1234__'
+stop_times_subquery = """
+	SELECT
+		st.trip_id,
+		st.stop_uid,
+		st.stop_sequence,
+		st.etime,
+		et.service_id,
+		st.stop_uid || repeat(
+			'_'::text,
+			(row_number() OVER (PARTITION BY st.trip_id, st.stop_uid ORDER BY st.etime ASC))::int - 1
+		) AS fake_stop_id
+	FROM {stop_times} AS st
+	JOIN {export_trips} AS et ON st.trip_id = et.trip_id
+"""
+
+# queries for each file in the feed, in the same form as etc/pull-data.sql
+file_queries = {
+	'calendar_dates.txt': """
+		SELECT DISTINCT
+			service_id,
+			to_char(TIMESTAMP 'EPOCH' + (service_id * INTERVAL '1 day'),'YYYYMMDD') AS date,
+			1 AS exception_type
+		FROM {export_trips}
+		ORDER BY service_id ASC
+	""",
+	'stops.txt': """
+		SELECT
+			DISTINCT
+			st.fake_stop_id AS stop_id,
+			s.stop_code::varchar,
+			s.stop_name,
+			s.lat AS stop_lat,
+			s.lon AS stop_lon
+		FROM ( """ + stop_times_subquery + """ ) AS st
+		JOIN {stops} AS s ON s.uid = st.stop_uid
+	""",
+	'routes.txt': """
+		SELECT
+			DISTINCT
+				route_id,
+				1 AS agency_id, -- all the same agency
+				route_id::varchar AS route_short_name,
+				'' AS route_long_name,
+				3 AS route_type -- LET THEM RIDE BUSES
+		FROM {export_trips}
+	""",
+	'trips.txt': """
+		SELECT
+			route_id::varchar,
+			service_id,
+			trip_id,
+			block_id,
+			es.shape_id
+		FROM {export_trips}
+		LEFT JOIN {export_shapes} AS es USING (trip_id)
+	""",
+	'stop_times.txt': """
+		SELECT
+			trip_id,
+			-- times are based on the service day, so they can extend
+			-- beyond midnight
+			EXTRACT( EPOCH FROM
+				-- local time of stop minus local service date
+				to_timestamp(round(etime)) AT TIME ZONE %(tz)s -
+				('1970-01-01'::date + service_id * INTERVAL '1 day')::date
+			) * INTERVAL '1 second' AS arrival_time,
+			EXTRACT( EPOCH FROM
+				to_timestamp(round(etime)) AT TIME ZONE %(tz)s -
+				('1970-01-01'::date + service_id * INTERVAL '1 day')::date
+			) * INTERVAL '1 second' AS departure_time,
+			stop_sequence,
+			fake_stop_id AS stop_id,
+			0 AS pickup_type,
+			0 AS drop_off_type,
+			NULL::int AS timepoint
+		FROM ( """ + stop_times_subquery + """ ) AS st
+		ORDER BY trip_id, stop_sequence ASC
+	""",
+	'shapes.txt': """
+		SELECT
+			shape_id,
+			-- path is an array of [line number, point number]
+			row_number() OVER (PARTITION BY shape_id ORDER BY path ASC) AS shape_pt_sequence,
+			ST_X(ST_Transform(geom,4326))::real AS shape_pt_lon,
+			ST_Y(ST_Transform(geom,4326))::real AS shape_pt_lat
+		FROM (
+			SELECT
+				es.shape_id,
+				(ST_DumpPoints(ST_Simplify(t.match_geom,10))).*
+			FROM {trips} AS t
+			JOIN {export_shapes} AS es ON t.trip_id = es.trip_id
+			WHERE es.canonical
+		) AS sub
+	"""
+}
+
+
+# Queries for the Parquet datasets, one service day at a time. Rows are 
+# ordered by route so that row group statistics let readers skip routes.
+parquet_queries = {
+	'trips': """
+		SELECT
+			t.trip_id,
+			et.service_id,
+			t.route_id,
+			t.direction_id,
+			t.block_id,
+			t.vehicle_id,
+			t.match_confidence
+		FROM {trips} AS t
+		JOIN {export_trips} AS et ON t.trip_id = et.trip_id
+		WHERE et.service_id = %(service_id)s
+		ORDER BY t.route_id, t.trip_id
+	""",
+	'stop_times': """
+		SELECT
+			st.trip_id,
+			et.route_id,
+			st.stop_sequence,
+			st.fake_stop_id,
+			st.stop_uid,
+			st.etime,
+			-- seconds since the start of the service day, as in stop_times.txt
+			EXTRACT( EPOCH FROM
+				to_timestamp(round(st.etime)) AT TIME ZONE %(tz)s -
+				('1970-01-01'::date + st.service_id * INTERVAL '1 day')::date
+			)::integer
+		FROM ( """ + stop_times_subquery + """ 
+			WHERE et.service_id = %(service_id)s ) AS st
+		JOIN {export_trips} AS et ON st.trip_id = et.trip_id
+		ORDER BY et.route_id, st.trip_id, st.stop_sequence
+	""",
+	# one row per trip, exploded into points in python
+	'points': """
+		SELECT
+			t.trip_id,
+			t.route_id,
+			t.track,
+			ST_AsBinary(t.clean_geom)
+		FROM {trips} AS t
+		JOIN {export_trips} AS et ON t.trip_id = et.trip_id
+		WHERE et.service_id = %(service_id)s
+		ORDER BY t.route_id, t.trip_id
+	"""
+}
+
+# rows per row group in the Parquet files
+parquet_row_group_size = 100000
+
+# files whose rows may be repeated between service days
+distinct_files = ['stops.txt','routes.txt']
+
+
+class ShapeIndex(object):
+	"""Canonical shapes of one direction, indexed so that shapes within a 
+		tolerance of a new geometry can be found quickly. If the Hausdorff 
+		distance between two lines is within the tolerance, so is the 
+		difference between each of the coordinates of their bounding boxes. 
+		Shapes are therefore kept in a grid keyed by their bounds in cells 
+		the size of the tolerance, and only shapes in the 3^4 neighbouring 
+		cells need to be compared."""
+
+	def __init__(self,tolerance):
+		self.tolerance = tolerance	# meters
+		self.cells = {}				# bounds cell -> [ (shape_id, geom) ]
+
+	def cell(self,geom):
+		return tuple( [ floor(c/self.tolerance) for c in geom.bounds ] )
+
+	def find(self,geom):
+		"""return the shape_id of a shape within tolerance of geom, or None"""
+		cell = self.cell(geom)
+		for offset in product((-1,0,1),repeat=4):
+			key = tuple( [ k+o for k,o in zip(cell,offset) ] )
+			for shape_id, shape in self.cells.get(key,[]):
+				if geom.hausdorff_distance(shape) <= self.tolerance:
+					return shape_id
+		return None
+
+	def add(self,shape_id,geom):
+		self.cells.setdefault(self.cell(geom),[]).append( (shape_id,geom) )
+
+
+def assign_shapes(tables,tolerance):
+	"""Assign each exported trip a shape_id, sharing the shape of an earlier 
+		trip in the same direction where their matched geometries are within 
+		the tolerance of each other. A tolerance of zero gives every trip its 
+		own shape. Returns the number of trips and of distinct shapes."""
+	conn = db.new_connection()
+	# a server-side cursor streams the geometries one direction after another
+	conn.autocommit = False
+	try:
+		c = conn.cursor('shape_geometries')
+		c.itersize = 2000
+		c.execute( shape_geometry_query.format(**tables) )
+		rows = io.StringIO()
+		num_trips, num_shapes = 0, 0
+		direction, index = None, None
+		for trip_id, route_id, direction_id, wkb in c:
+			if (route_id,direction_id) != direction:
+				direction = (route_id,direction_id)
+				index = ShapeIndex(tolerance) if tolerance > 0 else None
+			shape_id = None
+			if index is not None:
+				geom = loadWKB(bytes(wkb))
+				shape_id = index.find(geom)
+			canonical = shape_id is None
+			if canonical:
+				shape_id = 'shp_'+str(trip_id)
+				num_shapes += 1
+				if index is not None:
+					index.add(shape_id,geom)
+			num_trips += 1
+			rows.write( '{}\t{}\t{}\n'.format(trip_id,shape_id,canonical) )
+		c.close()
+		conn.commit()
+		# store the assignments for the export queries
+		rows.seek(0)
+		c = conn.cursor()
+		c.copy_from( rows, tables['export_shapes'], 
+			columns=('trip_id','shape_id','canonical') )
+		conn.commit()
+	finally:
+		conn.close()
+	return num_trips, num_shapes
+
+
+class LineCounter(object):
+	"""File wrapper counting the lines written through it."""
+
+	def __init__(self,f):
+		self.f = f
+		self.lines = 0
+
+	def write(self,data):
+		self.lines += data.count(b'\n')
+		return self.f.write(data)
+
+
+def get_tables(prefix=None):
+	"""table names to use in queries, from the prefix or from conf.py"""
+	if prefix is None:
+		tables = dict(conf['db']['tables'])
+	else:
+		tables = { t: prefix+t for t in ['trips','stops','stop_times','directions'] }
+	# staging tables unique to this export
+	tables['export_trips'] = tables['trips']+'_export_'+str(os.getpid())
+	tables['export_shapes'] = tables['trips']+'_export_shapes_'+str(os.getpid())
+	return tables
+
+
+def export_file(filename,tables,params,directory):
+	"""Stream one file of the feed into the given directory, returning the
+		number of rows and the seconds taken."""
+	start = time.monotonic()
+	conn = db.new_connection()
+	try:
+		c = conn.cursor()
+		query = c.mogrify( file_queries[filename].format(**tables), params ).decode()
+		with open(os.path.join(directory,filename),'wb') as f:
+			counter = LineCounter(f)
+			c.copy_expert( 'COPY ( '+query+' ) TO STDOUT CSV HEADER', counter )
+	finally:
+		conn.close()
+	seconds = time.monotonic() - start
+	rows = max(counter.lines - 1, 0)
+	print( '\t{} rows in {}, {:.0f} rows/s'.format(rows,filename,rows/seconds) )
+	return rows, seconds
+
+
+def export_files(tables,params,directory,procs=None,shape_tolerance=20):
+	"""Assign shapes to the staged trips and stream every file of the feed 
+		for them into a directory. Returns the number of rows written."""
+	c = db.cursor()
+	c.execute( shapes_staging_query.format(**tables) )
+	num_trips, num_shapes = assign_shapes(tables,shape_tolerance)
+	print( '\t{} shapes for {} trips'.format(num_shapes,num_trips) )
+	with ThreadPoolExecutor(procs or len(file_queries)) as executor:
+		futures = [
+			executor.submit(export_file,filename,tables,params,directory)
+			for filename in file_queries
+		]
+		results = [ future.result() for future in futures ]
+	return sum( [ r for r, s in results ] )
+
+
+def day_tables(tables,service_id):
+	"""table names for exporting a single service day"""
+	day = dict(tables)
+	day['range_trips'] = tables['export_trips']
+	day['export_trips'] = tables['export_trips']+'_'+str(service_id)
+	day['export_shapes'] = tables['export_shapes']+'_'+str(service_id)
+	return day
+
+
+def export_partitions(tables,params,cache_dir,procs=None,shape_tolerance=20):
+	"""Bring the cached partition of each staged service day up to date. 
+		Returns the partition directories in order and the number of rows 
+		written."""
+	c = db.cursor()
+	c.execute( fingerprint_query.format(**tables) )
+	directories, rows, num_exported = [], 0, 0
+	for service_id, fingerprint in c.fetchall():
+		fingerprint = '{} {}'.format(fingerprint,shape_tolerance)
+		directory = os.path.join(cache_dir,str(service_id))
+		directories.append(directory)
+		fingerprint_file = os.path.join(directory,'fingerprint')
+		if os.path.exists(fingerprint_file):
+			with open(fingerprint_file) as f:
+				if f.read() == fingerprint:
+					continue
+			# the partition is about to be incomplete
+			os.remove(fingerprint_file)
+		print( 'exporting service day',service_id )
+		num_exported += 1
+		os.makedirs(directory,exist_ok=True)
+		day = day_tables(tables,service_id)
+		c.execute( day_staging_query.format(**day), { 'service_id':service_id } )
+		try:
+			rows += export_files(day,params,directory,procs,shape_tolerance)
+		finally:
+			c.execute( 
+				'DROP TABLE IF EXISTS {export_trips}, {export_shapes};'.format(**day) 
+			)
+		with open(fingerprint_file,'w') as f:
+			f.write(fingerprint)
+	print( '\t{} of {} service days exported'.format(num_exported,len(directories)) )
+	return directories, rows
+
+
+def write_feed(outfile,directories,agency_file=None):
+	"""Zip the files in the given directories into a feed, concatenating 
+		the files of several directories in order. Rows repeated between 
+		directories are written only once for stops and routes."""
+	with zipfile.ZipFile(outfile,'w',zipfile.ZIP_DEFLATED) as feed:
+		if agency_file:
+			feed.write(agency_file,'agency.txt')
+		for filename in file_queries:
+			if len(directories) == 1:
+				feed.write(os.path.join(directories[0],filename),filename)
+				continue
+			seen = set()
+			with feed.open(filename,'w',force_zip64=True) as out:
+				for i, directory in enumerate(directories):
+					with open(os.path.join(directory,filename),'rb') as f:
+						header = f.readline()
+						if i == 0:
+							out.write(header)
+						if filename not in distinct_files:
+							shutil.copyfileobj(f,out)
+							continue
+						for line in f:
+							if line not in seen:
+								seen.add(line)
+								out.write(line)
+
+
+def export(start_date,end_date,outfile,prefix=None,agency_file=None,procs=None,
+	shape_tolerance=20,cache_dir=None):
+	"""Export the service days between two local dates, inclusive, as
+		a zipped GTFS feed. Trips of a direction share a shape if their 
+		matched geometries are within shape_tolerance meters. Given a 
+		cache_dir, the feed is assembled from cached partitions by service 
+		day, and only those days which have changed are exported again."""
+	start = time.monotonic()
+	tables = get_tables(prefix)
+	params = { 'start':start_date, 'end':end_date, 'tz':conf['timezone'] }
+	c = db.cursor()
+	print( 'selecting trips' )
+	c.execute( staging_query.format(**tables), params )
+	try:
+		if cache_dir:
+			directories, rows = export_partitions(
+				tables,params,cache_dir,procs,shape_tolerance)
+			write_feed(outfile,directories,agency_file)
+		else:
+			with tempfile.TemporaryDirectory() as directory:
+				rows = export_files(tables,params,directory,procs,shape_tolerance)
+				write_feed(outfile,[directory],agency_file)
+	finally:
+		c.execute( 
+			'DROP TABLE IF EXISTS {export_trips}, {export_shapes};'.format(**tables) 
+		)
+	seconds = time.monotonic() - start
+	print( 'exported {} rows to {} in {:.1f}s, {:.0f} rows/s'.format(
+		rows, outfile, seconds, rows/seconds ) )
+
+
+def parquet_schemas(pa):
+	"""typed columns of each Parquet dataset"""
+	return {
+		'trips': pa.schema( [
+			('trip_id', pa.int32()),
+			('service_id', pa.int16()),
+			('route_id', pa.string()),
+			('direction_id', pa.string()),
+			('block_id', pa.int32()),
+			('vehicle_id', pa.string()),
+			('match_confidence', pa.float32())
+		] ),
+		'stop_times': pa.schema( [
+			('trip_id', pa.int32()),
+			('route_id', pa.string()),
+			('stop_sequence', pa.int32()),
+			('stop_id', pa.string()),			# as in stop_times.txt
+			('stop_uid', pa.int32()),
+			('etime', pa.float64()),			# epoch time
+			('arrival_time', pa.int32())		# seconds into the service day
+		] ),
+		'points': pa.schema( [
+			('trip_id', pa.int32()),
+			('route_id', pa.string()),
+			('sequence', pa.int32()),
+			('time', pa.float64()),				# epoch time
+			('lon', pa.float64()),
+			('lat', pa.float64()),
+			('clean', pa.bool_())				# point was kept for map matching
+		] )
+	}
+
+
+def track_points(rows):
+	"""Explode (trip_id, route_id, track, clean WKB) rows into one tuple per 
+		vehicle report, noting which survived error cleaning. Reports are 
+		projected as when processed to compare them with the clean geometry."""
+	for trip_id, route_id, trip_track, clean_wkb in rows:
+		clean = set(loadWKB(bytes(clean_wkb)).coords) if clean_wkb else set()
+		for i, (etime, lon, lat) in enumerate(zip( *track.decode(trip_track) )):
+			point = Vehicle(etime,lon,lat).geom.coords[0]
+			yield ( trip_id, route_id, i+1, etime, lon, lat, point in clean )
+
+
+def export_parquet_day(dataset,service_id,tables,params,outdir,pa,pq):
+	"""Write one service day of one dataset as a Parquet file, returning 
+		the number of rows."""
+	schema = parquet_schemas(pa)[dataset]
+	directory = os.path.join(outdir,dataset,'service_id='+str(service_id))
+	os.makedirs(directory,exist_ok=True)
+	conn = db.new_connection()
+	# stream the rows through a server-side cursor
+	conn.autocommit = False
+	rows = 0
+	try:
+		c = conn.cursor(dataset+'_'+str(service_id))
+		c.itersize = parquet_row_group_size
+		c.execute( parquet_queries[dataset].format(**tables), 
+			dict(params,service_id=service_id) )
+		records = track_points(c) if dataset == 'points' else iter(c)
+		with pq.ParquetWriter(os.path.join(directory,'part-0.parquet'),schema) as writer:
+			while True:
+				batch = list(islice(records,parquet_row_group_size))
+				if len(batch) == 0:
+					break
+				columns = list(zip(*batch))
+				writer.write_table( pa.Table.from_arrays( [ 
+					pa.array(column,type=field.type) 
+					for column, field in zip(columns,schema) 
+				], schema=schema ) )
+				rows += len(batch)
+		conn.commit()
+	finally:
+		conn.close()
+	return rows
+
+
+def export_parquet(start_date,end_date,outdir,prefix=None,procs=None):
+	"""Export the service days between two local dates, inclusive, as 
+		Parquet datasets of trips, stop times and track points, each 
+		partitioned by service day. The trips selected are the same as for 
+		the GTFS feed."""
+	try:
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+	except ImportError:
+		raise SystemExit('Parquet export requires pyarrow (pip install pyarrow)')
+	start = time.monotonic()
+	tables = get_tables(prefix)
+	params = { 'start':start_date, 'end':end_date, 'tz':conf['timezone'] }
+	c = db.cursor()
+	print( 'selecting trips' )
+	c.execute( staging_query.format(**tables), params )
+	try:
+		c.execute( 
+			'SELECT DISTINCT service_id FROM {export_trips} ORDER BY service_id;'
+			.format(**tables)
+		)
+		service_ids = [ service_id for (service_id,) in c.fetchall() ]
+		with ThreadPoolExecutor(procs or len(parquet_queries)) as executor:
+			futures = {
+				(dataset,service_id): executor.submit( export_parquet_day, 
+					dataset, service_id, tables, params, outdir, pa, pq )
+				for service_id in service_ids for dataset in parquet_queries
+			}
+			rows = { dataset: 0 for dataset in parquet_queries }
+			for (dataset, service_id), future in futures.items():
+				rows[dataset] += future.result()
+	finally:
+		c.execute( 'DROP TABLE IF EXISTS {export_trips};'.format(**tables) )
+	seconds = time.monotonic() - start
+	for dataset in parquet_queries:
+		print( '\t{} rows of {}'.format(rows[dataset],dataset) )
+	total = sum(rows.values())
+	print( 'exported {} rows to {} in {:.1f}s, {:.0f} rows/s'.format(
+		total, outdir, seconds, total/seconds ) )
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Export a GTFS feed.')
+	parser.add_argument('start_date',help='first local service day, YYYY-MM-DD')
+	parser.add_argument('end_date',help='last local service day, YYYY-MM-DD')
+	parser.add_argument('outfile',
+		help='path of the .zip feed to write, or a directory for Parquet output')
+	parser.add_argument('--prefix',
+		help='table name prefix, if not the tables given in conf.py')
+	parser.add_argument('--agency-file',dest='agency_file',
+		default=os.path.join('output','agency','agency.txt'),
+		help='agency.txt to include in the feed as is')
+	parser.add_argument('--procs',type=int,default=None,
+		help='number of files to export at once')
+	parser.add_argument('--shape-tolerance',type=float,default=20,
+		dest='shape_tolerance',
+		help='meters within which trips of a direction share a shape; 0 for none')
+	parser.add_argument('--cache',dest='cache_dir',
+		help='directory in which to keep a partition of the feed for each service day')
+	parser.add_argument('--parquet',action='store_true',
+		help='write Parquet datasets instead of a GTFS feed')
+	args = parser.parse_args()
+	if args.parquet:
+		export_parquet(args.start_date,args.end_date,args.outfile,
+			args.prefix,args.procs)
+	else:
+		export(args.start_date,args.end_date,args.outfile,
+			args.prefix,args.agency_file,args.procs,args.shape_tolerance,args.cache_dir)
@@ -0,0 +1,264 @@
+# tracking of the vehicles operating for each agency and of the trips they
+# make, shared by the vehicle location feeds in nb_api.py and gtfsrt_api.py
+
+import requests, time, db, sys, timing
+from requests.adapters import HTTPAdapter
+import threading, heapq, zlib
+from trip import Trip
+from stream import StreamingMatch
+from minor_objects import Vehicle
+from conf import conf # configuration
+
+# should we process trips (or simply store the vehicles)? default False
+doMatching = True if 'doMatching' in sys.argv else False
+# should reports of a stationary vehicle be collapsed to the first and last 
+# as they arrive, rather than when the trip is cleaned? default False
+compactDwells = True if 'compactDwells' in sys.argv else False
+# should trips be matched in windows while still in progress, storing stop 
+# times as they go? Trips are then processed when they end. default False
+streamMatching = True if 'streamMatching' in sys.argv else False
+
+# a vehicle not heard from in this many seconds has ended its trip
+trip_timeout = 180
+
+# ids reserved from the database at a time by each collector
+id_block_size = 100
+
+# A large agency's routes may be split among several collectors, each 
+# started with e.g. 'shard=2/4' to collect the second quarter of them. 
+shard, num_shards = 1, 1
+for arg in sys.argv:
+	if arg.startswith('shard='):
+		shard, num_shards = [ int(n) for n in arg[len('shard='):].split('/') ]
+assert 1 <= shard <= num_shards
+
+def in_shard(route_id):
+	"""Is the route collected by this collector? Routes are assigned by a 
+		hash which is the same in every process."""
+	return zlib.crc32( str(route_id).encode() ) % num_shards == shard - 1
+
+# HTTP connections shared by all agencies for polling vehicle locations
+session = requests.Session()
+session.mount( 'http://', HTTPAdapter(pool_maxsize=20) )
+session.mount( 'https://', HTTPAdapter(pool_maxsize=20) )
+
+class IdBlock(object):
+	"""Assigns trip_ids or block_ids from blocks reserved in the database, so 
+		that collectors running at once or restarting never repeat an id."""
+
+	def __init__(self,column,tables,size=id_block_size):
+		self.column = column		# 'trip_id' or 'block_id'
+		self.tables = tables		# table names of the agency
+		self.size = size
+		self.next_id = 0
+		self.end = 0				# first id past the reserved block
+
+	def take(self):
+		"""the next id, reserving a new block if this one is used up"""
+		if self.next_id >= self.end:
+			with db.using_tables(self.tables):
+				self.next_id = db.reserve_ids(self.column,self.size)
+			self.end = self.next_id + self.size
+		self.next_id += 1
+		return self.next_id - 1
+
+
+class FleetTracker(object):
+	"""The trips being made by operating vehicles, keyed by vehicle_id. 
+		Vehicles which have gone quiet are found from a heap of ( last_seen, 
+		vehicle_id ) entries rather than by checking every vehicle; entries 
+		left behind by later reports are discarded as they reach the top."""
+
+	def __init__(self,trip_ids,block_ids,timeout=trip_timeout,compact=compactDwells,
+		stream=streamMatching):
+		self.trips = {}				# vehicle_id -> Trip
+		self.expiry = []				# heap of ( last_seen, vehicle_id )
+		self.trip_ids = trip_ids	# IdBlocks assigning trip_ids and block_ids
+		self.block_ids = block_ids
+		self.timeout = timeout
+		self.compact = compact		# collapse dwells as reports arrive?
+		self.compacted = 0			# reports replaced by a later one in a dwell
+		self.stream = stream			# match trips while in progress?
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.trips)
+
+	def update(self,reports,now):
+		"""Apply a batch of vehicle reports, ( vehicle_id, route_id, 
+			direction_id, lon, lat, report_time ) tuples, returning the trips 
+			which have ended, the number of reports skipped for being no 
+			newer than the last one from the same vehicle or for being on 
+			another collector's route, and the number which replaced the last 
+			report of a dwell. Points are projected before taking the lock, 
+			which is held only to change the fleet."""
+		vehicles = [ 
+			( vid, rid, did, Vehicle(report_time,lon,lat) ) 
+			for vid, rid, did, lon, lat, report_time in reports 
+		]
+		with self.lock, timing.stage('fleet lock held'):
+			ending_trips = self.expire(now)
+			skipped = 0
+			compacted = self.compacted
+			for vid, rid, did, vehicle in vehicles:
+				if not in_shard(rid):
+					# the vehicle has gone to another collector's route
+					if vid in self.trips:
+						ending_trips.append( self.trips.pop(vid) )
+					skipped += 1
+				elif not self.report(vid,rid,did,vehicle,ending_trips):
+					skipped += 1
+			compacted = self.compacted - compacted
+		return ending_trips, skipped, compacted
+
+	def expire(self,now):
+		"""remove and return the trips of vehicles not heard from lately"""
+		ended = []
+		while len(self.expiry) > 0 and now - self.expiry[0][0] > self.timeout:
+			last_seen, vid = heapq.heappop(self.expiry)
+			# the vehicle may have been heard from since this entry was made
+			trip = self.trips.get(vid)
+			if trip is not None and trip.last_seen == last_seen:
+				ended.append( self.trips.pop(vid) )
+		return ended
+
+	def report(self,vid,rid,did,vehicle,ending_trips):
+		"""Add one vehicle report to its trip, starting a new trip if the 
+			vehicle is new or has changed route or direction, in which case 
+			the old trip is added to ending_trips. Returns False if the report 
+			was skipped."""
+		trip = self.trips.get(vid)
+		if trip is None:
+			# haven't seen it! create a new trip in a new block
+			trip = self.start_trip(vid,rid,did,vehicle,self.block_ids.take())
+		elif vehicle.time <= trip.last_seen:
+			# a repeat of a report we already have
+			return False
+		elif trip.route_id != rid or trip.direction_id != did:
+			# this trip is ending; the new one continues its block
+			ending_trips.append(trip)
+			trip = self.start_trip(vid,rid,did,vehicle,trip.block_id)
+		else: # not a new trip, just add the vehicle
+			if trip.add_vehicle(vehicle,self.compact):
+				self.compacted += 1
+			# then update the time and sequence
+			trip.last_seen = vehicle.time
+			trip.seq += 1
+		heapq.heappush( self.expiry, (trip.last_seen,vid) )
+		return True
+
+	def start_trip(self,vid,rid,did,vehicle,block_id):
+		"""start a vehicle on a new trip with its first report"""
+		trip = Trip.new(self.trip_ids.take(),block_id,did,rid,vid,vehicle.time)
+		trip.add_vehicle(vehicle)
+		if self.stream:
+			trip.stream = StreamingMatch(trip,self.lock)
+		self.trips[vid] = trip
+		return trip
+
+	def due_windows(self):
+		"""Trips in progress with enough new reports to match another window, 
+			which are marked as scheduled"""
+		with self.lock:
+			due = [ t for t in self.trips.values() if t.stream and t.stream.is_due ]
+			for trip in due:
+				trip.stream.scheduled = True
+		return due
+
+
+class Agency(object):
+	"""The state of collection for one agency: its operating vehicles, the
+		tables it is stored in and the next ids to assign. Any number of
+		agencies may be collected at once, each in its own tables. Vehicle
+		locations come from a source, either 'nextbus' or 'gtfs-rt'."""
+
+	def __init__(self,tag,tables,source='nextbus',url=None):
+		self.tag = tag				# Nextbus agency tag, or any name for other sources
+		self.tables = tables		# table names, as in conf['db']['tables']
+		self.source = source		# feed providing vehicle locations
+		self.url = url				# address of a GTFS-realtime VehiclePositions feed
+		self.last_update = 0		# last update from server, removed results already reported
+		# operating vehicles and the ids to give their trips
+		self.fleet = FleetTracker( IdBlock('trip_id',tables), IdBlock('block_id',tables) )
+
+	def metric(self,name):
+		"""a metric name labelled with this agency"""
+		return timing.labelled(name,agency=self.tag)
+
+
+def configured_agencies():
+	"""The agencies listed in conf['agencies'], or else the single Nextbus
+		agency and tables given in conf.py"""
+	if 'agencies' in conf:
+		return [
+			Agency( a['tag'], a['tables'], a.get('source','nextbus'), a.get('url') )
+			for a in conf['agencies']
+		]
+	return [ Agency(conf['agency'],conf['db']['tables']) ]
+
+
+def release_trips(agency):
+	"""Trips matched while in progress stay marked as such until finished, so
+		those left by a collector which stopped are released here, for
+		process.py to process from the start as any other. Only those of
+		routes collected by this collector are touched. Returns how many."""
+	with db.using_tables(agency.tables):
+		trip_ids = [ trip_id for trip_id, route_id in db.get_trips_in_progress()
+			if in_shard(route_id) ]
+		if trip_ids:
+			db.scrub_trips(trip_ids)
+	return len(trip_ids)
+
+
+def update_fleet(agency,reports,server_time,num_vehicles):
+	"""Associate each vehicle report, a ( vehicle_id, route_id, direction_id,
+		lon, lat, report_time ) tuple, with a trip, and return the trips which
+		have ended. num_vehicles is the number of vehicles in the feed, of
+		which those without a report were dropped by its parser."""
+	ending_trips, skipped, compacted = agency.fleet.update(reports,server_time)
+	# vehicles dropped by the parser or by the fleet, counted once here
+	timing.count(agency.metric('vehicles_seen'),num_vehicles)
+	timing.count(agency.metric('vehicles_filtered'),num_vehicles-len(reports)+skipped)
+	timing.count(agency.metric('vehicles_compacted'),compacted)
+	timing.count(agency.metric('trips_ended'),len(ending_trips))
+	timing.set_gauge(agency.metric('fleet_size'),len(agency.fleet))
+	print ( agency.tag+':',len(agency.fleet),'in fleet,',len(ending_trips),'ending trips at',time.strftime("%b %d %Y %H:%M:%S") )
+	# match the latest reports of trips still in progress
+	for some_trip in agency.fleet.due_windows():
+		thread = threading.Thread(target=match_window,args=(agency,some_trip))
+		thread.start()
+	return ending_trips
+
+
+def end_trips(agency,ending_trips):
+	"""store the trips which are ending and send them for processing"""
+	with db.using_tables(agency.tables):
+		for some_trip in ending_trips:
+			# trips matched in progress are saved as they are finished
+			if len(some_trip.vehicles) > 1 and some_trip.stream is None:
+				with timing.stage('save'):
+					some_trip.save()
+	# process the trips that are ending?
+	if doMatching or streamMatching:
+		for some_trip in ending_trips:
+			# a trip of one report was never stored, so has nothing to process
+			if len(some_trip.vehicles) < 2:
+				continue
+			# start each in it's own process
+			thread = threading.Thread(target=process_trip,args=(agency,some_trip))
+			thread.start()
+
+
+def process_trip(agency,some_trip):
+	"""process an ended trip of the given agency"""
+	with db.using_tables(agency.tables):
+		if some_trip.stream is not None:
+			some_trip.stream.finish()
+		else:
+			some_trip.process()
+
+
+def match_window(agency,some_trip):
+	"""match the latest window of a trip of the given agency in progress"""
+	with db.using_tables(agency.tables):
+		some_trip.stream.advance()
@@ -0,0 +1,79 @@
+# functions for collecting vehicle locations from GTFS-realtime
+# VehiclePositions feeds, an alternative to the Nextbus API. Agencies using
+# one are listed in conf['agencies'] with 'source':'gtfs-rt' and the 'url' of
+# the feed. Decoding requires gtfs-realtime-bindings. Direction ids are the
+# route_id and GTFS direction_id, e.g. '504_0'; directions and stops for them
+# must be loaded separately, e.g. from the agency's static GTFS.
+# A recorded feed can be checked by decoding it, e.g.:
+#	python3 gtfsrt_api.py recorded-vehicle-positions.pb
+
+import time, sys, timing
+from fleet import session, update_fleet, end_trips
+
+def parse_feed(content):
+	"""Decode a serialized VehiclePositions FeedMessage into vehicle reports,
+		( vehicle_id, route_id, direction_id, lon, lat, report_time ) tuples
+		as used by fleet.update_fleet(). Also returns the number of vehicles
+		in the feed and the feed's own timestamp."""
+	try:
+		from google.transit import gtfs_realtime_pb2
+	except ImportError:
+		raise ImportError('GTFS-realtime feeds require gtfs-realtime-bindings '
+			'(pip install gtfs-realtime-bindings)')
+	feed = gtfs_realtime_pb2.FeedMessage()
+	feed.ParseFromString(content)
+	reports = []
+	num_vehicles = 0
+	for entity in feed.entity:
+		if not entity.HasField('vehicle'):
+			continue
+		num_vehicles += 1
+		v = entity.vehicle
+		# without a position, route and direction it can't be part of a trip
+		if not ( v.HasField('position') and v.trip.route_id and v.trip.HasField('direction_id') ):
+			continue
+		reports.append( (
+			v.vehicle.id or entity.id,
+			v.trip.route_id,
+			'{}_{}'.format(v.trip.route_id,v.trip.direction_id),
+			v.position.longitude,
+			v.position.latitude,
+			v.timestamp or feed.header.timestamp
+		) )
+	return reports, num_vehicles, feed.header.timestamp
+
+
+def get_new_vehicles(agency):
+	"""Fetch the agency's VehiclePositions feed, associate each vehicle with
+		a trip and send the trips for processing when it is determined that
+		they have ended"""
+	timing.count(agency.metric('polls'))
+	# UNIX time the request was sent
+	request_time = time.time()
+	try:
+		with timing.stage('request'):
+			response = session.get( agency.url, timeout=3 )
+			response.raise_for_status()
+	except:
+		timing.count(agency.metric('connection_errors'))
+		print ('connection problem for',agency.tag,'at',time.strftime("%b %d %Y %H:%M:%S") )
+		return
+	# UNIX time the response was received
+	response_time = time.time()
+	timing.count(agency.metric('response_bytes'),len(response.content))
+	with timing.stage('parse'):
+		reports, num_vehicles, feed_time = parse_feed(response.content)
+	# vehicle times are from the server's clock, so judge their age by it too
+	server_time = feed_time or (request_time + response_time) / 2
+	ending_trips = update_fleet(agency,reports,server_time,num_vehicles)
+	timing.set_gauge(agency.metric('last_poll_time'),response_time)
+	end_trips(agency,ending_trips)
+
+
+if __name__ == '__main__':
+	for filename in sys.argv[1:]:
+		with open(filename,'rb') as f:
+			reports, num_vehicles, feed_time = parse_feed(f.read())
+		print( filename+':',num_vehicles,'vehicles,',len(reports),'usable, feed time',feed_time )
+		for report in reports:
+			print( '\t', report )
@@ -1,7 +1,7 @@
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-import json, db
+import json, db, timing
 from conf import conf
 from numpy import mean
 from shapely.geometry import MultiLineString, asShape
@@ -33,23 +33,29 @@ class match(object):
 		self.error_radius = conf['error_radius']
 		self.default_route_used = False;
 		# fire off a query to OSRM with the default parameters
-		self.query_OSRM()
+		with timing.stage('OSRM query'):
+			self.query_OSRM()
 		if not self.OSRM_match_is_sufficient:
 			# try again with a larger error radius
 			self.error_radius *= 1.5
-			self.query_OSRM()
+			with timing.stage('OSRM radius retry'):
+				self.query_OSRM()
 		# still no good? 
 		if not self.OSRM_match_is_sufficient:
 			# Try a default geometry
-			if self.get_default_route():
-				self.locate_vehicles_on_default_route()
-			else: 
-				return # bad match, no default
+			with timing.stage('default route'):
+				if self.get_default_route():
+					self.locate_vehicles_on_default_route()
+				else: 
+					return # bad match, no default
 		else: # have a workable OSRM match geometry
-			self.parse_OSRM_geometry()
-			self.locate_vehicles_on_OSRM_route()
+			with timing.stage('parse OSRM geometry'):
+				self.parse_OSRM_geometry()
+			with timing.stage('locate vehicles'):
+				self.locate_vehicles_on_OSRM_route()
 		if len(self.trip.vehicles) > 2:
-			self.locate_stops_on_route()
+			with timing.stage('locate stops'):
+				self.locate_stops_on_route()
 		# report on what happened
 		self.print_outcome()
 
@@ -104,7 +110,11 @@ class match(object):
 					timeout=conf['OSRMserver']['timeout']
 					)
 			except:
-				return db.ignore_trip(self.trip.trip_id,'connection issue')
+				# windows of a trip in progress (see stream.py) have no trip_id
+				# and leave the trip itself alone
+				if self.trip.trip_id is not None:
+					db.ignore_trip(self.trip.trip_id,'connection issue')
+				return
 		# parse the result to a python object
 		self.OSRM_response = json.loads(raw_response.text)
 		# how confident should we be in this response?
@@ -0,0 +1,185 @@
+# Call this file to bring the trips of an archive collected before vehicle
+# reports were stored as one track value (see track.py) up to date, e.g.:
+#	python3 migrate_tracks.py
+#	python3 migrate_tracks.py --prefix mbta_
+# Without it, trips stored in the old orig_geom and times columns can't be
+# read. Columns added to the trips and stop_times tables since are added if
+# missing, then the reports of each trip not yet converted are encoded into
+# its track, with the first and last report times, number of reports and
+# length used to estimate the cost of processing it. Trips are converted in
+# batches which each commit, so an interrupted migration can be run again.
+# The old columns are left in place; drop them once satisfied, e.g.:
+#	ALTER TABLE ttc_trips DROP COLUMN orig_geom, DROP COLUMN times;
+# Tables added since, e.g. for the work queue, can be created with the parts
+# of etc/create-agency-tables.sql for them; SQLite creates them itself.
+
+import argparse, json, time, numpy, pyproj, track
+from shapely.wkb import loads as loadWKB
+from conf import conf
+
+# trips converted in each transaction
+batch_size = 1000
+
+# columns of the trips table which may be missing, with their PostgreSQL types
+trip_columns = [
+	('track','bytea'),
+	('start_time','double precision'),
+	('end_time','double precision'),
+	('num_points','integer'),
+	('track_length','real'),
+	('start_day','smallint'),
+	('version','varchar')
+]
+
+postgres_columns_query = """
+	ALTER TABLE {trips} """ + ', '.join(
+		'ADD COLUMN IF NOT EXISTS {} {}'.format(*column) for column in trip_columns
+	) + """;
+	-- tracks are already compressed, so don't try again
+	ALTER TABLE {trips} ALTER COLUMN track SET STORAGE EXTERNAL;
+	ALTER TABLE {stop_times} ADD COLUMN IF NOT EXISTS start_day smallint;
+	CREATE INDEX IF NOT EXISTS {trips}_start_time ON {trips} (start_time);
+"""
+
+postgres_batch_query = """
+	SELECT trip_id, ST_AsBinary(ST_Transform(orig_geom,4326)), times
+	FROM {trips}
+	WHERE track IS NULL AND orig_geom IS NOT NULL
+	ORDER BY trip_id
+	LIMIT %(limit)s;
+"""
+
+postgres_update_query = """
+	UPDATE {trips} SET
+		track = %(track)s,
+		start_time = %(start_time)s,
+		end_time = %(end_time)s,
+		num_points = %(num_points)s,
+		track_length = %(track_length)s,
+		start_day = ( to_timestamp(%(start_time)s) AT TIME ZONE %(tz)s )::date - 'epoch'::date
+	WHERE trip_id = %(trip_id)s;
+"""
+
+# stop times take the start_day of their trip, as in store_timepoints()
+postgres_stop_times_query = """
+	UPDATE {stop_times} AS st SET start_day = t.start_day
+	FROM {trips} AS t
+	WHERE st.trip_id = t.trip_id AND t.trip_id = ANY(%(trip_ids)s);
+"""
+
+
+def get_tables(prefix=None):
+	"""table names to use in queries, from the prefix or from conf.py"""
+	if prefix is None:
+		return dict(conf['db']['tables'])
+	return { t: prefix+t for t in conf['db']['tables'] }
+
+
+def encode(trip_id,times,lons,lats):
+	"""the values stored for a trip's reports, as db.insert_trip() stores
+		them, with the reports rounded as Vehicle rounds them"""
+	values = track.quantize(times,lons,lats)
+	times = values[0] / 10**track.time_digits
+	x, y = conf['projection']( values[1] / 10**track.coord_digits,
+		values[2] / 10**track.coord_digits )
+	return {
+		'trip_id':trip_id,
+		'track':track.pack(values),
+		'start_time':float(times[0]),
+		'end_time':float(times[-1]),
+		'num_points':len(times),
+		'track_length':float( numpy.hypot( numpy.diff(x), numpy.diff(y) ).sum() )
+	}
+
+
+def migrate_postgres(tables):
+	"""migrate PostgreSQL tables, returning the number of trips converted"""
+	import db_postgres, psycopg2
+	conn = db_postgres.new_connection()
+	conn.autocommit = False
+	converted = 0
+	try:
+		c = conn.cursor()
+		c.execute( postgres_columns_query.format(**tables) )
+		conn.commit()
+		while True:
+			c.execute( postgres_batch_query.format(**tables), { 'limit':batch_size } )
+			rows = c.fetchall()
+			if len(rows) == 0:
+				return converted
+			trips = []
+			for trip_id, geom, times in rows:
+				lons, lats = zip( *loadWKB(bytes(geom)).coords )
+				trip = encode(trip_id,times,lons,lats)
+				trip['track'] = psycopg2.Binary(trip['track'])
+				trip['tz'] = conf['timezone']
+				trips.append(trip)
+			c.executemany( postgres_update_query.format(**tables), trips )
+			c.execute( postgres_stop_times_query.format(**tables),
+				{ 'trip_ids':[ row[0] for row in rows ] } )
+			conn.commit()
+			converted += len(rows)
+			print( '\t{} trips converted'.format(converted) )
+	finally:
+		conn.close()
+
+
+def migrate_sqlite(tables):
+	"""Migrate SQLite tables, returning the number of trips converted. These
+		were only ever collected with the orig_geom in the local projection
+		and times as JSON, and with start_day and version."""
+	import db_sqlite
+	conn = db_sqlite.new_connection()
+	columns = [ row[1] for row in conn.execute('PRAGMA table_info({trips})'.format(**tables)) ]
+	for name in ('track','start_time','end_time','num_points','track_length'):
+		if name not in columns:
+			conn.execute( 'ALTER TABLE {} ADD COLUMN {} {}'.format( tables['trips'], name,
+				{ 'track':'BLOB', 'num_points':'INTEGER' }.get(name,'REAL') ) )
+	local_projection = pyproj.Proj('EPSG:{}'.format(conf['localEPSG']))
+	converted = 0
+	try:
+		while True:
+			rows = conn.execute(
+				"""
+					SELECT trip_id, orig_geom, times FROM {trips}
+					WHERE track IS NULL AND orig_geom IS NOT NULL
+					ORDER BY trip_id LIMIT :limit;
+				""".format(**tables),
+				{ 'limit':batch_size }
+			).fetchall()
+			if len(rows) == 0:
+				return converted
+			trips = []
+			for trip_id, geom, times in rows:
+				xs, ys = zip( *loadWKB(geom).coords )
+				lons, lats = local_projection( list(xs), list(ys), inverse=True )
+				trips.append( encode(trip_id,json.loads(times),lons,lats) )
+			conn.execute('BEGIN IMMEDIATE')
+			conn.executemany(
+				"""
+					UPDATE {trips} SET track = :track, start_time = :start_time,
+						end_time = :end_time, num_points = :num_points,
+						track_length = :track_length
+					WHERE trip_id = :trip_id;
+				""".format(**tables),
+				trips
+			)
+			conn.execute('COMMIT')
+			converted += len(rows)
+			print( '\t{} trips converted'.format(converted) )
+	finally:
+		conn.close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Convert stored trips to tracks.')
+	parser.add_argument('--prefix',
+		help='table name prefix, if not the tables given in conf.py')
+	args = parser.parse_args()
+	tables = get_tables(args.prefix)
+	start = time.monotonic()
+	if conf['db'].get('backend','postgres') == 'sqlite':
+		converted = migrate_sqlite(tables)
+	else:
+		converted = migrate_postgres(tables)
+	print( 'converted {} trips in {:.1f}s'.format( converted, time.monotonic() - start ) )
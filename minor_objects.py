@@ -1,5 +1,6 @@
 from shapely.wkb import loads as loadWKB
 from conf import conf
+from track import time_digits, coord_digits
 from shapely.geometry import Point
 from shapely.ops import transform as reproject
 
@@ -8,12 +9,16 @@ class Vehicle(object):
 	"""A transit vehicle GPS/space-time point record
 		geometries provided straight from PostGIS"""
 
-	def __init__( self, epoch_time, longitude, latitude ):
-		# set now
-		self.time = epoch_time
-		self.longitude = longitude
-		self.latitude = latitude
-		self.local_geom = reproject( conf['projection'], Point(longitude,latitude) )
+	def __init__( self, epoch_time, longitude, latitude, local_xy=None ):
+		# set now, to the precision the track is stored with
+		self.time = round( epoch_time, time_digits )
+		self.longitude = round( longitude, coord_digits )
+		self.latitude = round( latitude, coord_digits )
+		# the projected position may be given if it is already known
+		if local_xy is None:
+			self.local_geom = reproject( conf['projection'], Point(self.longitude,self.latitude) )
+		else:
+			self.local_geom = Point(local_xy)
 		# set later
 		self.measure = None	# measure in meters along the matched route geometry
 
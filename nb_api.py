@@ -1,147 +1,103 @@
 # functions involving requests to the nextbus APIs
 
-import requests, time, db, random, sys
+import requests, time, db, random, sys, timing
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 import threading, multiprocessing
 import xml.etree.ElementTree as ET
-from trip import Trip
-from os import remove, path
+from fleet import session, update_fleet, end_trips
 from conf import conf # configuration
 
-# should we process trips (or simply store the vehicles)? default False
-doMatching = True if 'doMatching' in sys.argv else False
+# should we get route information for ending trips? default False
 getRoutes = True if 'getRoutes' in sys.argv else False
 
-# GLOBALS
-fleet = {} 			# operating vehicles in the ( fleet vid -> trip_obj )
-next_trip_id = db.new_trip_id()	# next trip_id to be assigned 
-next_bid = db.new_block_id()		# next block_id to be assigned
-last_update = 0	# last update from server, removed results already reported
+# HTTP connections shared by all agencies for fetching route information, 
+# retried in case of errors
+route_session = requests.Session()
+route_session.mount( 'http://', HTTPAdapter(
+	pool_maxsize=20, max_retries=Retry( total=3, backoff_factor=1 ) ) )
 
-fleet_lock = threading.Lock()
 print_lock = threading.Lock()
 record_check_lock = threading.Lock()
 
-def get_new_vehicles():
+def get_new_vehicles(agency):
 	"""hit the vehicleLocations API and get all vehicles that have updated 
 		since the last check. Associate each vehicle with a trip_id (tid)
 		and send the trips for processing when it is determined that they 
 		have ended"""
-	global fleet
-	global next_trip_id
-	global next_bid
-	global last_update
+	timing.count(agency.metric('polls'))
 	# UNIX time the request was sent
 	request_time = time.time()
 	try: 
-		response = requests.get(
-			'http://webservices.nextbus.com/service/publicXMLFeed',
-			params={'command':'vehicleLocations','a':conf['agency'],'t':last_update},
-			headers={'Accept-Encoding':'gzip, deflate'},
-			timeout=3
-		)
+		with timing.stage('request'):
+			response = session.get(
+				'http://webservices.nextbus.com/service/publicXMLFeed',
+				params={'command':'vehicleLocations','a':agency.tag,'t':agency.last_update},
+				headers={'Accept-Encoding':'gzip, deflate'},
+				timeout=3
+			)
 	except:
-		print ('connection problem at',time.strftime("%b %d %Y %H:%M:%S") )
+		timing.count(agency.metric('connection_errors'))
+		print ('connection problem for',agency.tag,'at',time.strftime("%b %d %Y %H:%M:%S") )
 		return
 	# UNIX time the response was received
 	response_time = time.time()
+	timing.count(agency.metric('response_bytes'),len(response.content))
 	# estimated UNIX time the server generated it's report
 	# (halfway between send and reply times)
 	server_time = (request_time + response_time) / 2
-	# list of trips to send for processing
-	ending_trips = []
-	# this is the whole big ol' parsed XML document
-	XML = ET.fromstring(response.text)
-	# get values from the XML
-	last_update = int(XML.find('./lastTime').attrib['time'])
-	vehicles = XML.findall('.//vehicle')
-	# prevent simulataneous editing
-	with fleet_lock:
-		# check to see if there's anything we just haven't heard from at all lately
-		for vid in list(fleet.keys()):
-			# if it's been more than 3 minutes
-			if server_time - fleet[vid].last_seen > 180:
-				# it has ended
-				ending_trips.append(fleet[vid])
-				del fleet[vid]
-		# Now, for each reported vehicle
+	with timing.stage('parse'):
+		# this is the whole big ol' parsed XML document
+		XML = ET.fromstring(response.text)
+		# get values from the XML
+		agency.last_update = int(XML.find('./lastTime').attrib['time'])
+		vehicles = XML.findall('.//vehicle')
+		reports = []
 		for v in vehicles:
 			# if it's not predictable, it's not operating a route
 			if v.attrib['predictable'] == 'false': 
 				continue
-			try: # if it has no direction, it's invalid
-				v.attrib['dirTag']
-			except: 
+			# if it has no direction, it's invalid
+			if 'dirTag' not in v.attrib:
 				continue
-			# get values from XML
-			vid, rid, did = int(v.attrib['id']),v.attrib['routeTag'],v.attrib['dirTag']
-			lon, lat = float(v.attrib['lon']), float(v.attrib['lat'])
-			report_time = server_time - int(v.attrib['secsSinceReport'])
-			try: # have we seen this vehicle recently?
-				fleet[vid]
-			except: # haven't seen it! create a new trip
-				fleet[vid] = Trip.new(next_trip_id,next_bid,did,rid,vid,report_time)
-				# add this vehicle to the trip
-				fleet[vid].add_point(lon,lat,report_time)
-				# increment the trip and block counters
-				next_trip_id += 1
-				next_bid += 1
-				# done with this vehicle
-				continue
-			# we have a record for this vehicle, and it's been heard from recently
-			# see if anything else has changed that makes this a new trip
-			if ( fleet[vid].route_id != rid or fleet[vid].direction_id != did ):
-				# get the block_id from the previous trip
-				last_bid = fleet[vid].block_id
-				# this trip is ending
-				ending_trips.append( fleet[vid] )
-				# create the new trip in it's place
-				fleet[vid] = Trip.new(next_trip_id,last_bid,did,rid,vid,report_time)
-				# add this vehicle to it
-				fleet[vid].add_point(lon,lat,report_time)
-				# increment the trip counter
-				next_trip_id += 1
-			else: # not a new trip, just add the vehicle
-				fleet[vid].add_point(lon,lat,report_time)
-				# then update the time and sequence
-				fleet[vid].last_seen = report_time
-				fleet[vid].seq += 1
-	# release the fleet lock
-	print ( len(fleet),'in fleet,',len(ending_trips),'ending trips at',time.strftime("%b %d %Y %H:%M:%S") )
-	# store the trips which are ending
-	for some_trip in ending_trips:
-		if len(some_trip.vehicles) > 1:
-			some_trip.save()
-			# look for new route information with 10% probability
-			if getRoutes and random.random() < 0.1: 
-				fetch_route(some_trip.route_id)
-	# process the trips that are ending?
-	if doMatching:
+			reports.append( (
+				int(v.attrib['id']), v.attrib['routeTag'], v.attrib['dirTag'],
+				float(v.attrib['lon']), float(v.attrib['lat']),
+				server_time - int(v.attrib['secsSinceReport'])
+			) )
+	ending_trips = update_fleet(agency,reports,server_time,len(vehicles))
+	timing.set_gauge(agency.metric('last_poll_time'),response_time)
+	end_trips(agency,ending_trips)
+	# look for new route information with 10% probability
+	if getRoutes:
 		for some_trip in ending_trips:
-			# start each in it's own process
-			thread = threading.Thread(target=some_trip.process)
-			thread.start()
+			if len(some_trip.vehicles) > 1 and random.random() < 0.1: 
+				fetch_route(agency,some_trip.route_id)
 
-def fetch_route(route_id):
+def fetch_route(agency,route_id):
 	"""function for requesting and storing all relevant information 
 		about a given route. Hits the routeConfig command, parses the
 		results, and checks them against available information."""
 	# request routeConfig for this route
-	with requests.Session() as session:
-		retries = Retry( total=3, backoff_factor=1 )
-		session.mount( 'http://', HTTPAdapter(max_retries=retries) )
-		try: 
-			response = session.get(
-				'http://webservices.nextbus.com/service/publicXMLFeed', 
-				params={'command':'routeConfig','a':conf['agency'],'r':route_id,'verbose':''}, 
-				headers={'Accept-Encoding':'gzip, deflate'}, 
-				timeout=conf['OSRMserver']['timeout']
-			)
-		except:
-			print( 'connection error fetching route',route_id,'at',
-				time.strftime("%b %d %Y %H:%M:%S") )
-			return
+	try: 
+		response = route_session.get(
+			'http://webservices.nextbus.com/service/publicXMLFeed', 
+			params={'command':'routeConfig','a':agency.tag,'r':route_id,'verbose':''}, 
+			headers={'Accept-Encoding':'gzip, deflate'}, 
+			timeout=conf['OSRMserver']['timeout']
+		)
+	except:
+		timing.count(agency.metric('connection_errors'))
+		print( 'connection error fetching route',route_id,'of',agency.tag,'at',
+			time.strftime("%b %d %Y %H:%M:%S") )
+		return
+	with db.using_tables(agency.tables):
+		store_route(route_id,response)
+	with print_lock:
+		print( 'fetched route',route_id,'of',agency.tag )
+
+def store_route(route_id,response):
+	"""store the stops and directions of a routeConfig response"""
 	# this is the whole big ol' parsed XML document
 	XML = ET.fromstring(response.text)
 	# get a list of all stops with locations and iterate over them
@@ -183,15 +139,13 @@ def fetch_route(route_id):
 				d.attrib['useForUI'],	# useforui
 				ordered_stop_tags			# stops
 			)
-	with print_lock:
-		print( 'fetched route',route_id )
 
-def all_routes():
+def all_routes(agency):
 	"""return a list of all available route tags"""
 	try:
-		response = requests.get(
+		response = route_session.get(
 			'http://webservices.nextbus.com/service/publicXMLFeed', 
-			params={'command':'routeList','a':conf['agency']}, 
+			params={'command':'routeList','a':agency.tag}, 
 			headers={'Accept-Encoding':'gzip, deflate'}, 
 			timeout=5
 		)
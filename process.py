@@ -1,62 +1,452 @@
-# call this file to begin processing a set of trips from 
-# stored vehicle locations. It will ask which trips from 
-# the db to process. You can either process individual 
-# trips or a range of trips given sequential trip_ids 
+# call this file to begin processing a set of trips from
+# stored vehicle locations. Which trips to process is given on the command
+# line, so runs can be scheduled, e.g.:
+#	python3 process.py all --procs 8
+#	python3 process.py range --min 1000 --max 2000 --dry-run
+#	python3 process.py route 504 --start 2018-01-01 --end 2018-01-31
+#	python3 process.py unfinished --procs 4 --chunksize 10
+#	python3 process.py incremental
+#	python3 process.py single 1234 1235
+# 'single' with no trip_ids will ask for them one at a time.
+# To spread a run over several hosts, queue the trips once and then start
+# any number of workers, on any host, pointed at the same database:
+#	python3 process.py route 504 --queue
+#	python3 process.py work --procs 8
+# With --metrics, the time spent in each stage of processing is written to
+# the given directory as Prometheus histograms, along with profiles of the
+# slowest trips if --profile-slowest is given.
+# With --track-cache, vehicle reports are read from a local cache of ended
+# trips (see trackcache.py), which is brought up to date before the run:
+#	python3 process.py all --procs 8 --track-cache cache/ttc
 
 import multiprocessing as mp
-from time import sleep
-from trip import Trip
-import db
-from random import shuffle
+from multiprocessing.util import Finalize
+import argparse, json, time, traceback, threading, socket, os
+from trip import Trip, processing_version
+import db, timing, trackcache
 
-# let mode be one of ('single','range?')
-mode = input('Processing mode (single, all, route, or unfinished) --> ')
+# outcomes reported by Trip.process(), plus any unexpected failure
+outcomes = ('ignored','match problem','success','error')
 
-def process_trip(valid_trip_id):
-	"""worker process called when using multiprocessing"""
+# Weights for the estimated cost of processing a trip. Error cleaning can 
+# take time quadratic in the number of vehicle reports, while the OSRM 
+# request and stop location grow with the points and length of the track.
+point_cost = 1
+squared_point_cost = 1/200
+km_cost = 2
+# Chunks of trips are sized so that each is roughly this fraction of the 
+# remaining work per process; they shrink as the run goes on so that the 
+# workers finish together.
+chunks_per_proc = 4
+
+# Leases on queued trips expire unless renewed by their worker's heartbeat, 
+# after which the trips are handed out to other workers.
+lease_seconds = 300
+# trips which fail this many times are left in the queue unfinished
+max_attempts = 3
+
+# number of trips reset at once before bulk processing
+scrub_batch_size = 10000
+
+def init_worker(metrics_dir=None,profile_slowest=0,track_cache=None):
+	"""Start a worker process with its own connection, writing its stage 
+		timings out when it exits if they are being kept."""
+	db.worker_init()
+	if track_cache and trackcache.cache is None:
+		trackcache.open_cache(track_cache)
+	timing.configure(metrics_dir,profile_slowest)
+	if metrics_dir:
+		Finalize(None,timing.flush,exitpriority=10)
+
+def process_trip(valid_trip_id,scrub=True):
+	"""worker process called when using multiprocessing. Trips in bulk runs 
+		have already been scrubbed together and need not be scrubbed again."""
 	print( 'starting trip:',valid_trip_id )
-	db.reconnect()
-	t = Trip.fromDB(valid_trip_id)
-	t.process()
-
-def process_trips(trip_ids):
-	shuffle(trip_ids)
-	print( len(trip_ids),'trips in that range' )
-	# how many parallel processes to use?
-	max_procs = int(input('max processes --> '))
-	# create a pool of workers and pass them the data
-	p = mp.Pool(max_procs)
-	p.map(process_trip,trip_ids,chunksize=3)
-	print( 'COMPLETED!' )
-
-# single mode enters one trip at a time and stops when 
-# a non-integer is entered
-if mode in ['single','s']:
-	trip_id = input('trip_id to process--> ')
-	while trip_id.isdigit():
+	with timing.trip(valid_trip_id):
+		return attempt_trip(valid_trip_id,scrub)
+
+def attempt_trip(valid_trip_id,scrub):
+	"""process a trip, trying again once if the connection fails"""
+	try:
+		try:
+			t = Trip.fromDB(valid_trip_id)
+			return t.process(scrub)
+		except db.connection_errors:
+			# the worker's connection went bad; processing starts by scrubbing
+			# the trip so it is safe to simply try once more on a new connection
+			db.reconnect()
+			t = Trip.fromDB(valid_trip_id)
+			return t.process()
+	except Exception:
+		# don't let one bad trip bring down the whole run
+		print( 'error processing trip',valid_trip_id )
+		traceback.print_exc()
+		return 'error'
+
+def process_chunk(trip_ids):
+	"""worker process called for a chunk of already scrubbed trips, 
+		returning (trip_id, outcome) tuples"""
+	# a connection dropped while the worker sat idle is replaced up front, 
+	# rather than failing the chunk's first trip
+	if not db.is_healthy():
+		db.reconnect()
+	return [ (trip_id, process_trip(trip_id,scrub=False)) for trip_id in trip_ids ]
+
+def scrub_trips(trip_ids):
+	"""Reset the trips about to be processed with a few set-based 
+		operations rather than one update per trip. Each is marked with the 
+		processing version only when it finishes."""
+	for i in range(0,len(trip_ids),scrub_batch_size):
+		db.scrub_trips(trip_ids[i:i+scrub_batch_size])
+
+def trip_cost(num_points,length):
+	"""relative cost of processing a trip of a given number of vehicle 
+		reports and length in meters"""
+	return ( 
+		point_cost * num_points + 
+		squared_point_cost * num_points**2 + 
+		km_cost * length / 1000 
+	)
+
+def make_chunks(costs,procs,chunksize=None):
+	"""Group trips into chunks to be sent to workers, longest first. 
+		costs is a dict of trip_id -> estimated cost. A fixed chunksize may 
+		be given; otherwise each chunk holds about 1/chunks_per_proc of the 
+		remaining work per process so that long trips go out first and alone 
+		while the short ones at the end are batched in ever smaller chunks."""
+	trip_ids = sorted(costs,key=lambda trip_id: costs[trip_id],reverse=True)
+	if chunksize:
+		return [ trip_ids[i:i+chunksize] for i in range(0,len(trip_ids),chunksize) ]
+	remaining = sum(costs.values())
+	chunks = []
+	chunk, chunk_cost, target = [], 0, 0
+	for trip_id in trip_ids:
+		if len(chunk) == 0:
+			target = remaining / (procs * chunks_per_proc)
+		chunk.append(trip_id)
+		chunk_cost += costs[trip_id]
+		if chunk_cost >= target:
+			chunks.append(chunk)
+			remaining -= chunk_cost
+			chunk, chunk_cost = [], 0
+	if len(chunk) > 0:
+		chunks.append(chunk)
+	return chunks
+
+class Progress(object):
+	"""Keeps count of finished trips by outcome and reports on the rate
+		of processing."""
+
+	def __init__(self,total,report_interval=10,total_cost=None):
+		self.total = total
+		self.report_interval = report_interval	# seconds between reports
+		self.start_time = time.monotonic()
+		self.last_report = self.start_time
+		self.counts = { outcome:0 for outcome in outcomes }
+		# estimated cost of all trips and of those done so far
+		self.total_cost = total_cost
+		self.done_cost = 0
+
+	@property
+	def done(self):
+		return sum(self.counts.values())
+
+	@property
+	def elapsed(self):
+		return time.monotonic() - self.start_time
+
+	@property
+	def rate(self):
+		"""trips per second so far"""
+		return self.done / self.elapsed if self.elapsed > 0 else 0
+
+	def add(self,outcome,cost=0):
+		"""count one finished trip and report if it's time to"""
+		self.counts[outcome if outcome in self.counts else 'error'] += 1
+		self.done_cost += cost
+		if time.monotonic() - self.last_report >= self.report_interval:
+			self.report()
+
+	def report(self):
+		"""print a single line of progress"""
+		self.last_report = time.monotonic()
+		if self.total_cost and self.done_cost > 0:
+			# trips are not all equal, so extrapolate from the work done
+			remaining = self.total_cost - self.done_cost
+			eta = remaining * self.elapsed / self.done_cost
+		else:
+			remaining = self.total - self.done
+			eta = remaining / self.rate if self.rate > 0 else float('inf')
+		print( '{}/{} trips, {:.2f} trips/s, ETA {}, {}'.format(
+			self.done, self.total, self.rate, format_seconds(eta),
+			', '.join( [ '{} {}'.format(o,n) for o,n in self.counts.items() ] )
+		) )
+
+	def summary(self):
+		"""a dict describing the completed run"""
+		return {
+			'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+			'trips': self.done,
+			'seconds': round(self.elapsed,2),
+			'trips_per_second': round(self.rate,4),
+			'outcomes': self.counts
+		}
+
+def format_seconds(seconds):
+	"""format a duration as H:MM:SS"""
+	if seconds == float('inf'):
+		return '?'
+	seconds = int(round(seconds))
+	return '{}:{:02d}:{:02d}'.format(seconds//3600, seconds%3600//60, seconds%60)
+
+def last_summary(summary_file):
+	"""Return the most recent run summary with a known points per second
+		rate, or None."""
+	try:
+		with open(summary_file) as f:
+			summaries = [ json.loads(line) for line in f if line.strip() ]
+	except (IOError, ValueError):
+		return None
+	summaries = [ s for s in summaries if s.get('points_per_second') ]
+	return summaries[-1] if len(summaries) > 0 else None
+
+def estimate(filters,args):
+	"""Report how much work a run would involve without processing anything."""
+	num_trips, num_points = db.get_trip_set_size(**filters)
+	print( num_trips,'trips with',num_points,'vehicle reports' )
+	previous = last_summary(args.summary)
+	if previous:
+		# scale the rate of the last run to this number of processes
+		rate = previous['points_per_second'] * args.procs / previous['procs']
+		print( 'estimated time with',args.procs,'processes:',
+			format_seconds(num_points/rate), '(based on the run finished',
+			previous['finished']+')' )
+	else:
+		print( 'no previous run in',args.summary,'to base a time estimate on' )
+
+def start_pool(args):
+	"""Create a pool of workers, each of which opens a single connection 
+		when it starts and keeps it. Any timings from an earlier run are 
+		cleared first."""
+	if args.metrics:
+		timing.clear(args.metrics)
+	return mp.Pool(args.procs,initializer=init_worker,
+		initargs=(args.metrics,args.profile_slowest,args.track_cache))
+
+def stop_pool(p,args):
+	"""wait for the workers to finish and combine their timings"""
+	p.close()
+	p.join()
+	if args.metrics:
+		histograms = timing.combine(args.metrics,args.profile_slowest)
+		print( 'time by stage:' )
+		print( timing.summary(histograms) )
+
+def process_trips(trip_sizes,args):
+	"""Process trips in parallel, reporting on progress. trip_sizes is a 
+		list of (trip_id, number of points, length) tuples."""
+	print( len(trip_sizes),'trips in that range' )
+	scrub_trips( [ trip_id for trip_id, n, length in trip_sizes ] )
+	costs = { trip_id: trip_cost(n,length) for trip_id, n, length in trip_sizes }
+	num_points = sum( [ n for trip_id, n, length in trip_sizes ] )
+	chunks = make_chunks(costs,args.procs,args.chunksize)
+	progress = Progress(len(trip_sizes),args.report_interval,sum(costs.values()))
+	# create a pool of workers and pass them the data, longest trips first
+	p = start_pool(args)
+	for results in p.imap_unordered(process_chunk,chunks,chunksize=1):
+		for trip_id, outcome in results:
+			progress.add(outcome,costs[trip_id])
+	stop_pool(p,args)
+	record_summary(progress,args,num_points,chunks=len(chunks))
+
+def record_summary(progress,args,num_points=None,**extra):
+	"""report on and record the throughput of a finished run"""
+	progress.report()
+	summary = progress.summary()
+	summary['procs'] = args.procs
+	summary['chunksize'] = args.chunksize
+	summary.update(extra)
+	if num_points:
+		summary['points'] = num_points
+		summary['points_per_second'] = round(num_points/progress.elapsed,2)
+	with open(args.summary,'a') as f:
+		f.write(json.dumps(summary)+'\n')
+	print( 'COMPLETED!',json.dumps(summary) )
+
+def heartbeat(worker,stop):
+	"""renew this worker's leases until told to stop"""
+	while not stop.wait(lease_seconds/3):
+		try:
+			db.renew_claims(worker,lease_seconds)
+		except db.connection_errors:
+			db.reconnect()
+
+def work_queue(args):
+	"""Process trips leased from the shared work queue until it is empty. 
+		Leases are held by this process on behalf of its pool of workers, and 
+		only a few chunks per worker are leased at a time so that other hosts 
+		get their share."""
+	worker = socket.gethostname()+':'+str(os.getpid())
+	progress = Progress(db.count_open_claims(max_attempts),args.report_interval)
+	stop = threading.Event()
+	threading.Thread(target=heartbeat,args=(worker,stop),daemon=True).start()
+	p = start_pool(args)
+	pending = []
+	num_chunks = 0
+	next_claim = 0	# when to next look for trips to lease
+	while True:
+		# keep about two chunks per process outstanding
+		if len(pending) < 2 * args.procs and time.monotonic() >= next_claim:
+			leased = db.claim_trips(worker,lease_seconds,args.procs,max_attempts)
+			if len(leased) > 0:
+				costs = dict(leased)
+				scrub_trips(list(costs))
+				for chunk in make_chunks(costs,args.procs,args.chunksize):
+					pending.append( p.apply_async(process_chunk,(chunk,)) )
+					num_chunks += 1
+				continue
+			# nothing to lease right now; other hosts may hold leases which 
+			# could yet be abandoned, so look again in a while
+			if len(pending) == 0 and db.count_open_claims(max_attempts) == 0:
+				break
+			next_claim = time.monotonic() + lease_seconds/10
+		# collect finished chunks
+		finished = [ r for r in pending if r.ready() ]
+		if len(finished) == 0:
+			time.sleep(0.1)
+			continue
+		for r in finished:
+			pending.remove(r)
+			results = r.get()
+			db.release_claims(worker,
+				[ trip_id for trip_id, outcome in results if outcome != 'error' ] )
+			db.release_claims(worker,
+				[ trip_id for trip_id, outcome in results if outcome == 'error' ], 
+				done=False )
+			for trip_id, outcome in results:
+				progress.add(outcome)
+	stop.set()
+	stop_pool(p,args)
+	record_summary(progress,args,worker=worker,chunks=num_chunks)
+
+def process_single(trip_ids):
+	"""Process trips one at a time in this process, asking for trip_ids
+		until a non-integer is entered if none were given."""
+	interactive = len(trip_ids) == 0
+	if interactive:
+		trip_ids = [ input('trip_id to process--> ') ]
+	while len(trip_ids) > 0:
+		trip_id = trip_ids.pop(0)
+		if not trip_id.isdigit():
+			break
+		# as stored, and as the trackcache keys its trips
+		trip_id = int(trip_id)
 		if db.trip_exists(trip_id):
 			# create a trip object
 			this_trip = Trip.fromDB(trip_id)
 			# process
-			this_trip.process()
+			print( this_trip.process() )
 		else:
 			print( 'no such trip' )
 		# ask for another trip and continue
-		trip_id = input('trip_id to process --> ')
-# 'range' mode does all valid ids in the given range
-elif mode in ['all','a']:
-	# get a list of all trip id's in the range
-	trip_ids = db.get_trip_ids_by_range(-float('inf'),float('inf'))
-	process_trips(trip_ids)
-# process only a certain route
-elif mode in ['route','r']:
-	route_id = input('route_id --> ')
-	trip_ids = db.get_trip_ids_by_route(route_id)
-	process_trips(trip_ids)
-# process only trips that haven't been processed sucessfully yet
-elif mode in ['unfinished','u']:
-	trip_ids = db.get_trip_ids_unfinished()
-	process_trips(trip_ids)
-else:
-	print( 'Invalid mode given.' )
+		if interactive:
+			trip_ids = [ input('trip_id to process --> ') ]
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Process stored trips.')
+	parser.add_argument('mode',
+		choices=['single','s','all','a','range','route','r','unfinished','u',
+			'incremental','i','work','w'])
+	parser.add_argument('ids',nargs='*',
+		help='trip_ids in single mode or a route_id in route mode')
+	parser.add_argument('--min',type=int,dest='min_id',help='lowest trip_id')
+	parser.add_argument('--max',type=int,dest='max_id',help='highest trip_id')
+	parser.add_argument('--start',dest='start_date',
+		help='first local date of trips to process, YYYY-MM-DD')
+	parser.add_argument('--end',dest='end_date',
+		help='last local date of trips to process, YYYY-MM-DD')
+	parser.add_argument('--procs',type=int,default=mp.cpu_count(),
+		help='number of worker processes')
+	parser.add_argument('--chunksize',type=int,default=None,
+		help='trips sent to a worker at a time; sized by estimated cost if not given')
+	parser.add_argument('--queue',action='store_true',
+		help='add the trips to the shared work queue instead of processing them')
+	parser.add_argument('--dry-run',action='store_true',dest='dry_run',
+		help='only estimate the size and duration of the run')
+	parser.add_argument('--report-interval',type=float,default=10,
+		dest='report_interval',help='seconds between progress reports')
+	parser.add_argument('--summary',default='process-summary.jsonl',
+		help='file to which run throughput summaries are appended')
+	parser.add_argument('--metrics',default=None,
+		help='directory in which to write the time spent in each stage')
+	parser.add_argument('--profile-slowest',type=int,default=0,
+		dest='profile_slowest',help='keep cProfile output for this many of the slowest trips')
+	parser.add_argument('--track-cache',default=None,dest='track_cache',
+		help='directory of a local cache of trip tracks to read from and update')
+	return parser.parse_args()
+
+def main():
+	args = parse_args()
+	mode = args.mode
+	if args.track_cache:
+		start = time.monotonic()
+		added = trackcache.open_cache(args.track_cache).update()
+		print( 'added {} trips to the track cache in {:.1f}s'.format(
+			added, time.monotonic() - start ) )
+	# single mode processes trips one at a time in this process
+	if mode in ['single','s']:
+		return process_single(args.ids)
+	# work mode processes trips queued by any host
+	if mode in ['work','w']:
+		return work_queue(args)
+	filters = {
+		'min_id': args.min_id,
+		'max_id': args.max_id,
+		'start_date': args.start_date,
+		'end_date': args.end_date
+	}
+	# 'all' and 'range' mode do all valid ids, optionally in the given range
+	if mode in ['all','a','range']:
+		pass
+	# process only a certain route
+	elif mode in ['route','r']:
+		if len(args.ids) != 1:
+			print( 'route mode needs exactly one route_id' )
+			return
+		filters['route_id'] = args.ids[0]
+	# process only trips that haven't been processed sucessfully yet
+	elif mode in ['unfinished','u']:
+		filters['unfinished'] = True
+	# process trips which are new since the last incremental run or which 
+	# were processed with different code or configuration
+	elif mode in ['incremental','i']:
+		filters['version'] = processing_version
+		watermark, watermark_version = db.get_watermark('incremental')
+		if watermark is not None and watermark_version == processing_version:
+			filters['new_since'] = watermark
+		else:
+			print( 'processing version is now',processing_version,
+				'; looking for trips processed with any other' )
+	if args.dry_run:
+		return estimate(filters,args)
+	if args.queue:
+		weights = (point_cost,squared_point_cost,km_cost)
+		print( db.enqueue_trips(weights,**filters),'trips queued' )
+		# queued trips may never be worked, so the watermark stays put and 
+		# the next incremental run will select any left unprocessed
+		return
+	trip_sizes = db.get_trip_sizes(**filters)
+	process_trips(trip_sizes,args)
+	# everything up to here is now processed, unless the run was narrowed to 
+	# some of the trips
+	narrowed = any( filters[f] is not None for f in
+		('min_id','max_id','start_date','end_date') )
+	if mode in ['incremental','i'] and not narrowed:
+		trip_ids = [ trip_id for trip_id, n, length in trip_sizes ]
+		if watermark is not None and watermark_version == processing_version:
+			trip_ids.append(watermark)
+		if len(trip_ids) > 0:
+			db.set_watermark('incremental',max(trip_ids),processing_version)
 
+if __name__ == '__main__':
+	main()
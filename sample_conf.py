@@ -14,6 +14,10 @@ conf = {
 	# PostgreSQL database connnection
 	'db':
 		{
+			# 'postgres' for PostgreSQL with PostGIS, or 'sqlite' to keep 
+			# everything in a local file at 'path' with no database server
+			'backend':'postgres',
+			'path':'retro-gtfs.sqlite',
 			'host':'localhost',
 			'name':'', # database name
 			'user':'',
@@ -25,12 +29,35 @@ conf = {
 				'trips':'prefix_trips',
 				'stops':'prefix_stops',
 				'stop_times':'prefix_stop_times',
-				'directions':'prefix_directions'
+				'directions':'prefix_directions',
+				# shared work queue for processing on several hosts
+				'claims':'prefix_claims',
+				# progress of incremental processing runs
+				'watermarks':'prefix_watermarks',
+				# ids reserved in blocks by collectors
+				'id_blocks':'prefix_id_blocks',
+				# match quality measures by trip and by route and day
+				'trip_quality':'prefix_trip_quality',
+				'route_quality':'prefix_route_quality'
 			}
 		},
 	# agency tag for the Nextbus API, which can be found at
 	# http://webservices.nextbus.com/service/publicXMLFeed?command=agencyList
 	'agency':'ttc',
+	# To collect several agencies in one process, list them here instead, 
+	# each with its own set of tables named as above. 'agency' and the 
+	# tables above are then used only for processing and export. Agencies 
+	# with a GTFS-realtime VehiclePositions feed give its url instead.
+	#'agencies':[
+	#	{ 'tag':'ttc', 'tables':{ 'trips':'ttc_trips', 'stops':'ttc_stops', ... } },
+	#	{ 'tag':'sf-muni', 'tables':{ 'trips':'muni_trips', 'stops':'muni_stops', ... } },
+	#	{ 'tag':'mbta', 'source':'gtfs-rt', 
+	#		'url':'https://cdn.mbta.com/realtime/VehiclePositions.pb',
+	#		'tables':{ 'trips':'mbta_trips', 'stops':'mbta_stops', ... } }
+	#],
+	# local port on which the collector serves its health metrics in the 
+	# Prometheus format; set to None to turn this off
+	'metrics_port':9180,
 	# Where is the ORSM server? Give the root url
 	'OSRMserver':{
 		'url':'http://localhost:5000',
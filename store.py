@@ -1,8 +1,12 @@
 # main file, called to start the process of pulling vehicle locations
 
-import threading
-from nb_api import get_new_vehicles, fetch_route, all_routes
-import db
+import threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+from nb_api import fetch_route, all_routes
+from fleet import configured_agencies, release_trips
+import nb_api, gtfsrt_api
+import db, timing
+from conf import conf
 from time import sleep
 import random
 import sys
@@ -13,6 +17,21 @@ getRoutes = True if 'getRoutes' in sys.argv else False
 # should existing data be truncated? default False;
 truncateData = True if 'truncateData' in sys.argv else False
 
+# every agency is polled at once from a shared pool of threads
+agencies = configured_agencies()
+pollers = ThreadPoolExecutor( max_workers=len(agencies) )
+# module providing get_new_vehicles() for each source of vehicle locations
+sources = { 'nextbus':nb_api, 'gtfs-rt':gtfsrt_api }
+
+
+def poll(agency):
+	"""request new vehicles for one agency and store them, reporting
+		rather than losing any error"""
+	try:
+		sources[agency.source].get_new_vehicles(agency)
+	except:
+		traceback.print_exc()
+
 
 def time_loop():
 	"""timer function whose purpose is to call itself every N seconds 
@@ -20,26 +39,41 @@ def time_loop():
 		itself to go off again"""
 	threading.Timer( 10, time_loop ).start() # int is delay in seconds
 	# request new vehicles and store them
-	get_new_vehicles()
+	for agency in agencies:
+		pollers.submit(poll,agency)
 
 if truncateData:
-	db.empty_tables()
+	for agency in agencies:
+		with db.using_tables(agency.tables):
+			db.empty_tables()
+
+# trips left in progress when the collector last stopped will never end
+for agency in agencies:
+	released = release_trips(agency)
+	if released > 0:
+		print( agency.tag+':',released,'trips left in progress released' )
+
+# serve health metrics for each poll, e.g. at http://localhost:9180/metrics
+if conf.get('metrics_port'):
+	timing.serve(conf['metrics_port'],'retro_collector')
 
 if getRoutes:
 	# get all the route data, afresh
 	# threading this makes it faster
 	#print 'requesting all route data'
-	routes = all_routes()
-	for route_id in routes:
-		t = threading.Thread(target=fetch_route,args=(route_id,))
-		t.start()
-		if threading.active_count() >= 10:
-			sleep(3)
+	# only Nextbus provides route information
+	for agency in [ a for a in agencies if a.source == 'nextbus' ]:
+		routes = all_routes(agency)
+		for route_id in routes:
+			t = threading.Thread(target=fetch_route,args=(agency,route_id))
+			t.start()
+			if threading.active_count() >= 10:
+				sleep(3)
 
 	sleep(10)
 
 # call the big function. This takes longer to run the first time, 
-get_new_vehicles()
+list( pollers.map(poll,agencies) )
 
 # so wait a bit longer than usual to call the timer function 10secs later
 threading.Timer( 10, time_loop ).start()
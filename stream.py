@@ -0,0 +1,178 @@
+# matching of trips while they are still in progress, so that stop times are
+# stored soon after a vehicle passes a stop rather than all at once after the
+# trip has ended. Windows of recent vehicle reports are matched on their own,
+# each overlapping its neighbours by a few reports. Stop times and geometry
+# are kept only up to a few reports before the end of a window, where the
+# match has reports on both sides. When the trip ends only the tail needs
+# matching. Stop times are provisional until then: the trip is stored marked
+# as in progress, which keeps process.py from selecting it, and stays ignored
+# until it is finished. A trip left in progress by a collector which stopped
+# is released when the collector next starts, see fleet.release_trips(). If a
+# window can't be matched, the whole trip is processed as usual once it has
+# ended.
+
+import threading, db, map_api, timing
+from copy import copy
+from numpy import mean
+from shapely.geometry import LineString, MultiLineString
+from shapely.wkb import dumps as dumpWKB
+from geom import cut
+from trip import Trip, processing_version
+
+# new vehicle reports needed before another window is matched
+window_size = 30
+# reports matched again at either end of a window, for context
+overlap = 10
+
+class StreamingMatch(object):
+	"""The progress of matching one trip in windows as it is collected. Once
+		the trip is finished this stands in for its match when recording
+		quality measures."""
+
+	def __init__(self,trip,fleet_lock):
+		self.trip = trip
+		self.lock = threading.Lock()	# held while matching a window
+		self.fleet_lock = fleet_lock	# held while the fleet adds reports
+		self.scheduled = False			# is a window waiting to be matched?
+		self.failed = False				# a window couldn't be matched
+		self.finished = False			# the trip has ended
+		self.settled = 0					# index of the first unsettled report
+		self.settled_time = None		# time of the last settled report
+		self.stops = None					# Stop objects for the trip's direction
+		self.timepoints = []				# stop times stored so far
+		self.clean_vehicles = []		# settled reports kept by error cleaning
+		self.lines = []					# matched geometry of the settled reports
+		self.confidences = []			# of the match of each window
+		self.default_route_used = False
+
+	@property
+	def confidence(self):
+		return mean(self.confidences) if self.confidences else 0
+
+	@property
+	def is_due(self):
+		"""Are there enough new reports to match another window?"""
+		return (
+			not (self.scheduled or self.failed or self.finished) and
+			len(self.trip.vehicles) - self.settled >= window_size + overlap
+		)
+
+	def advance(self):
+		"""match the latest window of the trip, unless it has ended meanwhile"""
+		with self.lock:
+			self.scheduled = False
+			if self.finished or self.failed:
+				return
+			# the fleet may be adding or replacing reports meanwhile
+			with self.fleet_lock:
+				vehicles = self.trip.vehicles[:]
+			try:
+				with timing.stage('match window'):
+					self.failed = not self.match_window(vehicles)
+			except:
+				self.failed = True
+				raise
+
+	def finish(self):
+		"""Process the trip once it has ended, matching only the reports since
+			the last window. Returns the outcome, as Trip.process() does."""
+		with self.lock:
+			self.finished = True
+			try:
+				return self.settle()
+			except:
+				# leave no trip marked as in progress, but unprocessed
+				if self.settled > 0:
+					db.scrub_trip(self.trip.trip_id)
+				raise
+
+	def settle(self):
+		"""finish() the trip, holding the lock"""
+		trip = self.trip
+		if len(trip.vehicles) > 1:
+			trip.save()
+		if self.failed or self.settled == 0:
+			return trip.process()
+		with timing.stage('match window'):
+			if not self.match_window( trip.vehicles, final=True ):
+				return trip.process()
+		with timing.stage('store match'):
+			db.set_trip_clean_geom(
+				trip.trip_id,
+				dumpWKB( LineString([ v.geom for v in self.clean_vehicles ]), hex=True )
+			)
+			db.add_trip_match(
+				trip.trip_id,
+				self.confidence,
+				dumpWKB( MultiLineString(self.lines), hex=True )
+			)
+			db.accept_trip(trip.trip_id,processing_version)
+		# quality measures are taken from the trip, as for any other
+		trip.start_time = trip.vehicles[0].time
+		trip.stops = self.stops
+		trip.timepoints = self.timepoints
+		trip.match = self
+		return trip.finish('success')
+
+	def match_window(self,vehicles,final=False):
+		"""Match the reports from a little before the last settled one to the
+			latest, then store the stop times and keep the geometry up to a
+			few reports from the end, or to the end if final. Returns False
+			if the window couldn't be matched."""
+		if self.stops is None:
+			with timing.stage('read stops'):
+				self.stops = db.get_stops(self.trip.direction_id,self.trip.last_seen)
+		if not self.stops:
+			return False
+		# the last window of a trip may have few new reports, so it reaches
+		# back further to be as long as any other
+		start = max( 0, min( self.settled - overlap, len(vehicles) - window_size - overlap ) )
+		end = len(vehicles) if final else len(vehicles) - overlap
+		after_time = self.settled_time if self.settled_time is not None else float('-inf')
+		until_time = float('inf') if final else vehicles[end-1].time
+		# a trip of its own, with copies as matching sets measures and drops
+		# points, and without a trip_id so that a failed match stores nothing;
+		# finish() decides what becomes of the trip
+		window = Trip.new( None, self.trip.block_id,
+			self.trip.direction_id, self.trip.route_id, self.trip.vehicle_id,
+			vehicles[-1].time )
+		window.vehicles = [ copy(v) for v in vehicles[start:] ]
+		window.stops = self.stops
+		if len(window.vehicles) < 5 or window.clean():
+			return False
+		window.match = map_api.match(window)
+		if not window.match.is_useable:
+			return False
+		# keep the stop times of the settled part of the window
+		timepoints = []
+		for timepoint in window.timepoints:
+			timepoint.set_time( window.interpolate_time(timepoint.measure) )
+			if after_time < timepoint.arrival_time <= until_time:
+				timepoints.append(timepoint)
+		timepoints = sorted(timepoints,key=lambda tp: tp.arrival_time)
+		# a stop near the end of the last window may have been kept already
+		if timepoints and self.timepoints and timepoints[0].stop_id == self.timepoints[-1].stop_id:
+			timepoints.pop(0)
+		# stop times can only be stored with the trip; the reports are those of
+		# the window, as more may be arriving meanwhile
+		if not self.trip.stored:
+			self.trip.save(vehicles,in_progress=True)
+		if timepoints:
+			with timing.stage('store stop times'):
+				db.store_timepoints( self.trip.trip_id, timepoints, len(self.timepoints)+1 )
+			self.timepoints += timepoints
+		# and the matched geometry between the last settled report and the new one
+		before = [ v.measure for v in window.vehicles if v.time <= after_time ]
+		upto = [ v.measure for v in window.vehicles if v.time <= until_time ]
+		m1 = before[-1] if before else 0
+		m2 = upto[-1] if upto else m1
+		if m2 > m1:
+			part, rest = cut( cut(window.match.geometry,m1)[1], m2-m1 )
+			self.lines.extend( part.geoms )
+		self.clean_vehicles += [ v for v in window.vehicles if after_time < v.time <= until_time ]
+		self.confidences.append( window.match.confidence )
+		self.default_route_used |= window.match.default_route_used
+		self.settled = end
+		self.settled_time = vehicles[end-1].time
+		return True
+
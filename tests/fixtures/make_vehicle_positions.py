@@ -0,0 +1,63 @@
+# Writes the VehiclePositions feeds used by test_gtfsrt_api.py, in the form
+# published by a typical agency, with one entity for each case parse_feed()
+# must handle. Run from this directory to regenerate them:
+#	python3 make_vehicle_positions.py
+
+from google.transit import gtfs_realtime_pb2
+
+def new_feed(timestamp=None):
+	feed = gtfs_realtime_pb2.FeedMessage()
+	feed.header.gtfs_realtime_version = '2.0'
+	feed.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+	if timestamp is not None:
+		feed.header.timestamp = timestamp
+	return feed
+
+def add_vehicle(feed,entity_id,vehicle_id=None,route_id=None,direction_id=None,
+	position=None,timestamp=None,trip=True):
+	"""add a vehicle entity, leaving out any field given as None"""
+	entity = feed.entity.add()
+	entity.id = entity_id
+	v = entity.vehicle
+	if vehicle_id is not None:
+		v.vehicle.id = vehicle_id
+	if trip:
+		v.trip.trip_id = 'trip_'+entity_id
+		if route_id is not None:
+			v.trip.route_id = route_id
+		if direction_id is not None:
+			v.trip.direction_id = direction_id
+	if position is not None:
+		v.position.longitude, v.position.latitude = position
+	if timestamp is not None:
+		v.timestamp = timestamp
+	return entity
+
+# a feed with its own timestamp
+feed = new_feed(1546351200)
+add_vehicle(feed,'1','4001','504',0,(-79.3871,43.6487),1546351190)
+# no timestamp of its own
+add_vehicle(feed,'2','4002','504',1,(-79.4012,43.6441))
+# no trip at all
+add_vehicle(feed,'3','4003',position=(-79.3605,43.6532),timestamp=1546351195,trip=False)
+# a trip without a route
+add_vehicle(feed,'4','4004',None,0,(-79.3720,43.6500),1546351195)
+# a trip without a direction
+add_vehicle(feed,'5','4005','505',None,(-79.3950,43.6570),1546351195)
+# no position
+add_vehicle(feed,'6','4006','505',1,None,1546351195)
+# no vehicle descriptor, so known only by its entity id
+add_vehicle(feed,'7',None,'505',1,(-79.4100,43.6560),1546351180)
+# not a vehicle
+alert = feed.entity.add()
+alert.id = 'alert'
+alert.alert.header_text.translation.add().text = 'Detour'
+with open('vehicle_positions.pb','wb') as f:
+	f.write( feed.SerializeToString() )
+
+# a feed without a timestamp in its header
+feed = new_feed()
+add_vehicle(feed,'1','4001','504',0,(-79.3871,43.6487),1546351190)
+add_vehicle(feed,'2','4002','504',1,(-79.4012,43.6441))
+with open('vehicle_positions_no_header_time.pb','wb') as f:
+	f.write( feed.SerializeToString() )
@@ -0,0 +1,68 @@
+# Tests of the recovery of trips left marked as in progress by matching in
+# windows, see stream.py. Run from the main directory, with a conf.py, e.g.:
+#	python3 -m pytest tests
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import fleet, stream
+
+
+class ReleaseTripsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.agency = SimpleNamespace( tag='test', tables={} )
+
+	def release(self,in_progress,shard=(1,1)):
+		"""release the agency's trips with those given as in progress in the
+			database, returning the mocked db module"""
+		with mock.patch.object(fleet,'db') as db, \
+			mock.patch.object(fleet,'shard',shard[0]), \
+			mock.patch.object(fleet,'num_shards',shard[1]):
+			db.get_trips_in_progress.return_value = in_progress
+			self.released = fleet.release_trips(self.agency)
+		return db
+
+	def test_trips_in_progress_scrubbed(self):
+		db = self.release([ (4,'504'), (9,'505') ])
+		db.scrub_trips.assert_called_once_with([4,9])
+		self.assertEqual( self.released, 2 )
+
+	def test_nothing_in_progress(self):
+		db = self.release([])
+		db.scrub_trips.assert_not_called()
+		self.assertEqual( self.released, 0 )
+
+	def test_only_routes_of_this_shard(self):
+		with mock.patch.object(fleet,'num_shards',2):
+			shard = 1 if fleet.in_shard('504') else 2
+		db = self.release( [ (4,'504'), (9,'505') ], (shard,2) )
+		trip_ids = db.scrub_trips.call_args[0][0]
+		self.assertIn( 4, trip_ids )
+		self.assertEqual( len(trip_ids), self.released )
+
+
+class FinishFailureTest(unittest.TestCase):
+
+	def finish(self,settled):
+		"""finish a streamed trip whose storing fails, returning the mocked
+			db module"""
+		trip = mock.Mock( trip_id=7, vehicles=[1,2] )
+		trip.save.side_effect = OSError
+		match = stream.StreamingMatch( trip, mock.MagicMock() )
+		match.settled = settled
+		with mock.patch.object(stream,'db') as db:
+			with self.assertRaises(OSError):
+				match.finish()
+		return db
+
+	def test_trip_in_progress_scrubbed(self):
+		self.finish(40).scrub_trip.assert_called_once_with(7)
+
+	def test_trip_never_stored_in_progress(self):
+		self.finish(0).scrub_trip.assert_not_called()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,107 @@
+# Tests of the GTFS-realtime source against recorded VehiclePositions feeds
+# in tests/fixtures, written by make_vehicle_positions.py. Run from the main
+# directory, with a conf.py, e.g.:
+#	python3 -m pytest tests
+
+import os, unittest
+from types import SimpleNamespace
+from unittest import mock
+
+try:
+	from google.transit import gtfs_realtime_pb2
+except ImportError:
+	gtfs_realtime_pb2 = None
+
+import gtfsrt_api
+
+fixtures = os.path.join( os.path.dirname(__file__), 'fixtures' )
+
+def read_fixture(name):
+	with open( os.path.join(fixtures,name), 'rb' ) as f:
+		return f.read()
+
+
+@unittest.skipIf(gtfs_realtime_pb2 is None,'requires gtfs-realtime-bindings')
+class ParseFeedTest(unittest.TestCase):
+
+	def setUp(self):
+		self.reports, self.num_vehicles, self.feed_time = gtfsrt_api.parse_feed(
+			read_fixture('vehicle_positions.pb') )
+		self.by_vehicle = { report[0]: report for report in self.reports }
+
+	def test_counts_only_vehicle_entities(self):
+		self.assertEqual( self.num_vehicles, 7 )
+		self.assertEqual( self.feed_time, 1546351200 )
+
+	def test_complete_report(self):
+		vid, rid, did, lon, lat, report_time = self.by_vehicle['4001']
+		self.assertEqual( (rid,did,report_time), ('504','504_0',1546351190) )
+		self.assertAlmostEqual( lon, -79.3871, places=5 )
+		self.assertAlmostEqual( lat, 43.6487, places=5 )
+
+	def test_missing_timestamp_takes_header_time(self):
+		self.assertEqual( self.by_vehicle['4002'][5], 1546351200 )
+
+	def test_direction_id_includes_route(self):
+		self.assertEqual( self.by_vehicle['4002'][2], '504_1' )
+		self.assertEqual( self.by_vehicle['7'][1:3], ('505','505_1') )
+
+	def test_missing_vehicle_id_takes_entity_id(self):
+		self.assertIn( '7', self.by_vehicle )
+
+	def test_unusable_vehicles_dropped(self):
+		# no trip, no route, no direction and no position, respectively
+		for vid in ('4003','4004','4005','4006'):
+			self.assertNotIn( vid, self.by_vehicle )
+		self.assertEqual( len(self.reports), 3 )
+
+	def test_no_header_time(self):
+		reports, num_vehicles, feed_time = gtfsrt_api.parse_feed(
+			read_fixture('vehicle_positions_no_header_time.pb') )
+		self.assertEqual( feed_time, 0 )
+		self.assertEqual( [ report[5] for report in reports ], [1546351190,0] )
+
+
+@unittest.skipIf(gtfs_realtime_pb2 is None,'requires gtfs-realtime-bindings')
+class GetNewVehiclesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.agency = SimpleNamespace( tag='test', url='http://feed.invalid/vp.pb',
+			metric=lambda name: 'test_'+name )
+
+	def poll(self,fixture):
+		"""poll the agency with the fixture as the feed's response, returning
+			the calls made to update_fleet() and end_trips()"""
+		response = mock.Mock( content=read_fixture(fixture) )
+		with mock.patch.object(gtfsrt_api.session,'get',return_value=response), \
+			mock.patch.object(gtfsrt_api,'update_fleet',return_value=['ending']) as update, \
+			mock.patch.object(gtfsrt_api,'end_trips') as end:
+			gtfsrt_api.get_new_vehicles(self.agency)
+		return update, end
+
+	def test_reports_sent_to_fleet(self):
+		update, end = self.poll('vehicle_positions.pb')
+		agency, reports, server_time, num_vehicles = update.call_args[0]
+		self.assertIs( agency, self.agency )
+		self.assertEqual( [ report[0] for report in reports ], ['4001','4002','7'] )
+		self.assertEqual( num_vehicles, 7 )
+		# vehicle times are judged by the feed's own clock
+		self.assertEqual( server_time, 1546351200 )
+		end.assert_called_once_with(self.agency,['ending'])
+
+	def test_server_time_without_header_time(self):
+		with mock.patch.object(gtfsrt_api.time,'time',side_effect=[1000.0,1002.0]):
+			update, end = self.poll('vehicle_positions_no_header_time.pb')
+		self.assertEqual( update.call_args[0][2], 1001.0 )
+
+	def test_connection_problem(self):
+		with mock.patch.object(gtfsrt_api.session,'get',side_effect=OSError), \
+			mock.patch.object(gtfsrt_api,'update_fleet') as update, \
+			mock.patch.object(gtfsrt_api,'end_trips') as end:
+			gtfsrt_api.get_new_vehicles(self.agency)
+		update.assert_not_called()
+		end.assert_not_called()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,246 @@
+# low-overhead timing of the stages of processing a trip
+# Each process keeps a histogram of the time spent in each stage. Workers
+# write theirs to a directory, where they are combined into a single file in
+# the Prometheus text format once processing is done. Optionally the slowest
+# trips of each worker are profiled with cProfile.
+# Long-running processes like the collector can instead keep counters and
+# gauges alongside their stage timings and serve them all over HTTP.
+
+import time, os, json, heapq, cProfile, threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# upper bounds of the histogram buckets, in seconds
+buckets = (
+	0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+	1, 2.5, 5, 10, 30, 60, float('inf')
+)
+
+# stage name -> Histogram, for this process
+histograms = {}
+# name -> running total, and name -> latest value
+counters = {}
+gauges = {}
+# held while updating any of the above, which threads may do at once
+lock = threading.Lock()
+# where this process writes its histograms, if anywhere
+metrics_dir = None
+# how many of the slowest trips to keep profiles of
+profile_slowest = 0
+# heap of ( seconds, trip_id, cProfile.Profile ) of the slowest trips
+slowest = []
+
+
+class Histogram(object):
+	"""Counts of durations by bucket, plus their sum."""
+
+	def __init__(self,counts=None,total=0):
+		self.counts = counts or [0] * len(buckets)
+		self.sum = total
+
+	@property
+	def count(self):
+		return sum(self.counts)
+
+	def observe(self,seconds):
+		self.counts[ bisect_left(buckets,seconds) ] += 1
+		self.sum += seconds
+
+	def add(self,other):
+		self.counts = [ a+b for a,b in zip(self.counts,other.counts) ]
+		self.sum += other.sum
+
+
+def observe(name,seconds):
+	"""record a duration for the named stage"""
+	with lock:
+		if name not in histograms:
+			histograms[name] = Histogram()
+		histograms[name].observe(seconds)
+
+
+def count(name,n=1):
+	"""add to the named counter"""
+	with lock:
+		counters[name] = counters.get(name,0) + n
+
+
+def set_gauge(name,value):
+	"""set the current value of the named gauge"""
+	with lock:
+		gauges[name] = value
+
+
+@contextmanager
+def stage(name):
+	"""time the enclosed block as the named stage"""
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		observe( name, time.perf_counter() - start )
+
+
+@contextmanager
+def trip(trip_id):
+	"""Time the processing of a whole trip, profiling it if the slowest
+		trips are being kept."""
+	profile = cProfile.Profile() if profile_slowest > 0 else None
+	start = time.perf_counter()
+	if profile:
+		profile.enable()
+	try:
+		yield
+	finally:
+		if profile:
+			profile.disable()
+		seconds = time.perf_counter() - start
+		observe( 'trip', seconds )
+		if profile:
+			keep_profile(seconds,trip_id,profile)
+
+
+def keep_profile(seconds,trip_id,profile):
+	"""keep the profile if it is among the slowest"""
+	if len(slowest) < profile_slowest:
+		heapq.heappush( slowest, (seconds,trip_id,profile) )
+	elif seconds > slowest[0][0]:
+		heapq.heapreplace( slowest, (seconds,trip_id,profile) )
+
+
+def configure(directory,slowest_trips=0):
+	"""Have this process write its timings to a directory when flush() is
+		called, keeping profiles of its slowest trips."""
+	global metrics_dir, profile_slowest
+	metrics_dir = directory
+	profile_slowest = slowest_trips
+	if metrics_dir:
+		os.makedirs( os.path.join(metrics_dir,'profiles'), exist_ok=True )
+
+
+def flush():
+	"""write this process's histograms and profiles to the metrics
+		directory, if there is one"""
+	if not metrics_dir:
+		return
+	state = { name: [h.counts,h.sum] for name, h in histograms.items() }
+	path = os.path.join(metrics_dir,'worker-{}.json'.format(os.getpid()))
+	with open(path+'.tmp','w') as f:
+		json.dump(state,f)
+	os.replace(path+'.tmp',path)
+	for seconds, trip_id, profile in slowest:
+		profile.dump_stats( os.path.join( metrics_dir, 'profiles',
+			'trip-{}-{:.0f}ms.prof'.format(trip_id,seconds*1000) ) )
+
+
+def clear(directory):
+	"""remove the timings and profiles of any earlier run from a directory"""
+	for sub in [directory, os.path.join(directory,'profiles')]:
+		if not os.path.isdir(sub):
+			continue
+		for name in os.listdir(sub):
+			if name.startswith('worker-') or name.endswith('.prof'):
+				os.remove( os.path.join(sub,name) )
+
+
+def combine(directory,keep_profiles=0):
+	"""Combine the histograms written by each worker into one Prometheus
+		text file, keeping only the given number of the slowest trip
+		profiles. Returns the combined histograms."""
+	combined = {}
+	for name in os.listdir(directory):
+		if not (name.startswith('worker-') and name.endswith('.json')):
+			continue
+		with open(os.path.join(directory,name)) as f:
+			for stage_name, (counts,total) in json.load(f).items():
+				if stage_name not in combined:
+					combined[stage_name] = Histogram()
+				combined[stage_name].add( Histogram(counts,total) )
+	with open(os.path.join(directory,'process.prom'),'w') as f:
+		f.write( prometheus_text(combined) )
+	# prune all but the slowest profiles across all workers
+	profile_dir = os.path.join(directory,'profiles')
+	if os.path.isdir(profile_dir):
+		profiles = sorted( os.listdir(profile_dir), reverse=True,
+			key=lambda name: float(name.split('-')[-1][:-len('ms.prof')]) )
+		for name in profiles[keep_profiles:]:
+			os.remove( os.path.join(profile_dir,name) )
+	return combined
+
+
+def prometheus_text(histograms,metric='retro_process_stage_seconds',
+	description='Time spent in each stage of processing a trip.'):
+	"""format histograms by stage in the Prometheus text exposition format"""
+	lines = [
+		'# HELP {} {}'.format(metric,description),
+		'# TYPE {} histogram'.format(metric)
+	]
+	for name in sorted(histograms):
+		h = histograms[name]
+		cumulative = 0
+		for bound, count in zip(buckets,h.counts):
+			cumulative += count
+			le = '+Inf' if bound == float('inf') else repr(bound)
+			lines.append( '{}_bucket{{stage="{}",le="{}"}} {}'.format(
+				metric, name, le, cumulative ) )
+		lines.append( '{}_sum{{stage="{}"}} {}'.format(metric,name,h.sum) )
+		lines.append( '{}_count{{stage="{}"}} {}'.format(metric,name,h.count) )
+	return '\n'.join(lines)+'\n'
+
+
+def summary(histograms):
+	"""a few lines comparing the total and mean time of each stage"""
+	lines = []
+	for name in sorted( histograms, key=lambda n: histograms[n].sum, reverse=True ):
+		h = histograms[name]
+		lines.append( '\t{:<20} {:>10.1f}s total {:>9.4f}s mean {:>9} times'.format(
+			name, h.sum, h.sum/h.count if h.count else 0, h.count ) )
+	return '\n'.join(lines)
+
+
+def labelled(name,**labels):
+	"""a counter or gauge name with labels, e.g. fleet_size{agency="ttc"}"""
+	return name + '{' + ','.join( [ 
+		'{}="{}"'.format(key,value) for key, value in sorted(labels.items()) 
+	] ) + '}'
+
+
+def current_text(prefix):
+	"""All of this process's stage timings, counters and gauges in the 
+		Prometheus text format, with metric names starting with prefix."""
+	with lock:
+		text = prometheus_text( histograms, prefix+'_stage_seconds',
+			'Time spent in each timed stage.' )
+		lines = []
+		for values, kind, suffix in [(counters,'counter','_total'),(gauges,'gauge','')]:
+			typed = set()
+			for name in sorted(values):
+				base, brace, labels = name.partition('{')
+				metric = '{}_{}{}'.format(prefix,base,suffix)
+				if metric not in typed:
+					lines.append( '# TYPE {} {}'.format(metric,kind) )
+					typed.add(metric)
+				lines.append( '{}{}{} {}'.format(metric,brace,labels,values[name]) )
+	return text + '\n'.join(lines)+'\n'
+
+
+def serve(port,prefix):
+	"""Serve current_text(prefix) at /metrics on a local port from a 
+		background thread."""
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path != '/metrics':
+				self.send_error(404)
+				return
+			body = current_text(prefix).encode()
+			self.send_response(200)
+			self.send_header('Content-Type','text/plain; version=0.0.4')
+			self.send_header('Content-Length',str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		def log_message(self,*args):
+			pass # scrapes would otherwise flood the collector's output
+	server = HTTPServer( ('127.0.0.1',port), Handler )
+	threading.Thread(target=server.serve_forever,daemon=True).start()
+	return server
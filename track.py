@@ -0,0 +1,73 @@
+# compact encoding of the vehicle reports of a trip, stored as a single
+# binary value in the track column of the trips table. Times (milliseconds)
+# and WGS84 coordinates (1e-7 degrees) are stored as integers, the first
+# report in full and the rest as differences from the previous report,
+# which are small and compress well. Points are projected by the client
+# when read, rather than by the database.
+
+import struct, zlib, numpy
+from math import hypot
+
+# decimal places kept; Vehicle rounds to these so that a trip read back
+# from the database is the same as when it was collected
+time_digits = 3
+coord_digits = 7
+
+# format version, number of reports, bytes per difference, then the first
+# time and coordinates
+header = struct.Struct('<BIBqqq')
+version = 1
+
+def encode(vehicles):
+	"""encode a sequence of Vehicles as bytes"""
+	return pack( quantize(
+		[ v.time for v in vehicles ],
+		[ v.lon for v in vehicles ],
+		[ v.lat for v in vehicles ]
+	) )
+
+
+def quantize(times,lons,lats):
+	"""the integers stored for sequences of times and coordinates, as an 
+		array of three rows"""
+	return numpy.array( [
+		numpy.round( numpy.asarray(times,dtype=float) * 10**time_digits ),
+		numpy.round( numpy.asarray(lons,dtype=float) * 10**coord_digits ),
+		numpy.round( numpy.asarray(lats,dtype=float) * 10**coord_digits )
+	] ).astype(numpy.int64).reshape(3,-1)
+
+
+def pack(values):
+	"""encode integers from quantize() as bytes"""
+	# differences are stored by row, which compresses better than by report
+	deltas = numpy.diff(values,axis=1)
+	# differences fit in 32 bits unless a point has jumped half the world
+	width = 4 if numpy.abs(deltas).max(initial=0) < 2**31 else 8
+	first = values[:,0] if values.shape[1] > 0 else (0,0,0)
+	return header.pack( version, values.shape[1], width, *first ) + zlib.compress(
+		deltas.astype('<i{}'.format(width)).tobytes() )
+
+
+def decode(track):
+	"""Decode bytes from encode() into lists of times, longitudes and
+		latitudes"""
+	track = bytes(track)
+	v, n, width, t0, x0, y0 = header.unpack_from(track)
+	assert v == version, 'unknown track format version {}'.format(v)
+	if n == 0:
+		return [], [], []
+	deltas = numpy.frombuffer( zlib.decompress(track[header.size:]),
+		dtype='<i{}'.format(width) ).reshape(3,n-1).astype(numpy.int64)
+	values = numpy.cumsum( numpy.hstack(
+		( numpy.array([[t0],[x0],[y0]],dtype=numpy.int64), deltas ) ), axis=1 )
+	times = ( values[0] / 10**time_digits ).tolist()
+	lons = ( values[1] / 10**coord_digits ).tolist()
+	lats = ( values[2] / 10**coord_digits ).tolist()
+	return times, lons, lats
+
+
+def length(vehicles):
+	"""length in meters of the track in the local projection"""
+	points = [ v.geom.coords[0] for v in vehicles ]
+	return sum( hypot(x2-x1,y2-y1) for (x1,y1), (x2,y2) in zip(points,points[1:]) )
+
@@ -0,0 +1,150 @@
+# A local cache of the vehicle reports of stored trips, so that reprocessing
+# reads them from disk rather than from the database. Only trips which have
+# ended are cached: a trip matched while in progress is stored early and its
+# reports replaced when it ends, but until then it is marked as in progress
+# and never selected by db.trip_filter(). The reports of an ended trip don't
+# change, so the cache is only ever added to. Times and WGS84 and projected
+# coordinates are kept in flat files of float64, one per column, which are
+# memory-mapped when read; an index gives the first report and number of
+# reports of each trip along with its other attributes.
+# Call this file to build a cache or to add newly ended trips to it, e.g.:
+#	python3 trackcache.py cache/ttc
+#	python3 trackcache.py cache/mbta --prefix mbta_
+# process.py takes the same directory with --track-cache, bringing the cache
+# up to date before a run and reading trips from it.
+
+import argparse, json, os, time, numpy, track, db
+from minor_objects import Vehicle
+from conf import conf
+
+# one file of float64 per column
+columns = ['times','lons','lats','xs','ys']
+
+# trips fetched from the database at once
+fetch_batch_size = 1000
+
+# the cache opened in this process, if any
+cache = None
+
+class TrackCache(object):
+	"""The tracks cached in a directory, with their index loaded."""
+
+	def __init__(self,directory):
+		self.directory = directory
+		os.makedirs(directory,exist_ok=True)
+		# trip_id -> [ offset, count, block_id, direction_id, route_id, vehicle_id ]
+		self.index = {}
+		self.size = 0		# reports in the indexed part of the column files
+		if os.path.exists(self.path('index.jsonl')):
+			with open(self.path('index.jsonl')) as f:
+				for line in f:
+					trip_id, *entry = json.loads(line)
+					self.index[trip_id] = entry
+					self.size = max( self.size, entry[0] + entry[1] )
+		self.arrays = None
+
+	def path(self,name):
+		return os.path.join(self.directory,name)
+
+	def __len__(self):
+		return len(self.index)
+
+	def __contains__(self,trip_id):
+		return trip_id in self.index
+
+	def map(self):
+		"""memory-map the columns, which are shared with any other process
+			reading the same files"""
+		if self.size == 0:
+			self.arrays = { name: numpy.zeros(0) for name in columns }
+		else:
+			self.arrays = { name: numpy.memmap( self.path(name+'.f8'),
+				dtype='<f8', mode='r', shape=(self.size,) ) for name in columns }
+
+	def get_trip_attributes(self,trip_id):
+		"""The attributes of a cached trip as given by db.get_trip_attributes(),
+			or None if the trip isn't cached."""
+		entry = self.index.get(trip_id)
+		if entry is None:
+			return None
+		if self.arrays is None:
+			self.map()
+		offset, count, bid, did, rid, vid = entry
+		t, lon, lat, x, y = [ self.arrays[name][offset:offset+count].tolist()
+			for name in columns ]
+		return {
+			'block_id': bid,
+			'direction_id': did,
+			'route_id': rid,
+			'vehicle_id': vid,
+			'points': [ Vehicle(*point[:3],local_xy=point[3:])
+				for point in zip(t,lon,lat,x,y) ]
+		}
+
+	def add(self,rows):
+		"""Append ( trip_id, block_id, direction_id, route_id, vehicle_id,
+			track ) rows from db.get_tracks() to the cache. Reports are
+			projected here all at once, as Vehicle would project each."""
+		if len(rows) == 0:
+			return
+		# anything written past the index by an interrupted update is dropped
+		for name in columns:
+			with open(self.path(name+'.f8'),'ab') as f:
+				f.truncate(self.size*8)
+		decoded = [ track.decode(row[5]) for row in rows ]
+		t, lon, lat = [ numpy.concatenate( [ numpy.asarray(d[i],dtype='<f8')
+			for d in decoded ] ) for i in range(3) ]
+		x, y = conf['projection'](lon,lat)
+		for name, values in zip( columns, (t,lon,lat,x,y) ):
+			with open(self.path(name+'.f8'),'ab') as f:
+				f.write( numpy.asarray(values,dtype='<f8').tobytes() )
+		# the index is written last, so only complete tracks are ever indexed
+		with open(self.path('index.jsonl'),'a') as f:
+			for row, d in zip(rows,decoded):
+				trip_id, bid, did, rid, vid = row[:5]
+				entry = [ self.size, len(d[0]), bid, did, rid, vid ]
+				f.write( json.dumps( [trip_id] + entry ) + '\n' )
+				self.index[trip_id] = entry
+				self.size += len(d[0])
+		self.arrays = None
+
+	def update(self):
+		"""Add the trips ended since the cache was last updated, returning
+			how many were added."""
+		# trips still in progress aren't selected
+		ended = db.get_trip_ids()
+		missing = [ trip_id for trip_id in ended if trip_id not in self.index ]
+		for i in range(0,len(missing),fetch_batch_size):
+			self.add( db.get_tracks(missing[i:i+fetch_batch_size]) )
+		return len(missing)
+
+
+def open_cache(directory):
+	"""use the cache in the directory for trips read in this process"""
+	global cache
+	cache = TrackCache(directory)
+	return cache
+
+
+def get_trip_attributes(trip_id):
+	"""the attributes of a trip from the open cache, or None if it isn't there"""
+	if cache is None:
+		return None
+	return cache.get_trip_attributes(trip_id)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Build or update a track cache.')
+	parser.add_argument('directory',help='directory holding the cache')
+	parser.add_argument('--prefix',
+		help='table name prefix, if not the tables given in conf.py')
+	args = parser.parse_args()
+	tables = conf['db']['tables']
+	if args.prefix is not None:
+		tables = { t: args.prefix+t for t in conf['db']['tables'] }
+	start = time.monotonic()
+	with db.using_tables(tables):
+		c = TrackCache(args.directory)
+		added = c.update()
+	print( 'added {} trips in {:.1f}s; {} trips of {} reports cached'.format(
+		added, time.monotonic() - start, len(c), c.size ) )
@@ -1,8 +1,8 @@
 # documentation on the nextbus feed:
 # http://www.nextbus.com/xmlFeedDocs/NextBusXMLFeed.pdf
 
-import re, db, math, random 
-import map_api
+import re, db, math, random, json, hashlib
+import map_api, timing, trackcache
 from geom import cut
 from numpy import mean
 from conf import conf
@@ -11,6 +11,33 @@ from shapely.ops import transform as reproject
 from shapely.geometry import Point, asShape, LineString, MultiLineString
 from minor_objects import Vehicle
 
+# Bump this when a change to the processing code should cause incremental 
+# runs to reprocess trips done with an earlier version.
+code_version = 1
+
+def get_processing_version():
+	"""A short stamp identifying the code and the configuration that trips 
+		are processed with. Trips are stamped with it when processed."""
+	settings = json.dumps( {
+		'error_radius': conf['error_radius'],
+		'stop_dist': conf['stop_dist'],
+		'min_OSRM_match_quality': conf['min_OSRM_match_quality'],
+		'localEPSG': conf['localEPSG'],
+		'OSRMserver': conf['OSRMserver']['url']
+	}, sort_keys=True )
+	return '{}-{}'.format( code_version, hashlib.md5(settings.encode()).hexdigest()[:8] )
+
+processing_version = get_processing_version()
+
+# segment speeds (kmph) classed as errors when cleaning: faster than this is 
+# a positional error, slower is no motion at all
+max_speed = 120
+stationary_speed = 0.1
+
+def segment_speed(v1,v2):
+	"""speed (kmph) between two vehicle reports"""
+	return ( v1.geom.distance(v2.geom) / 1000 ) / ( (v2.time-v1.time) / 3600 )
+
 class Trip(object):
 	"""The trip class provides all the methods needed for dealing
 		with one observed trip/track. Classmethods provide two 
@@ -25,6 +52,7 @@ class Trip(object):
 		self.route_id = ''			# str
 		self.vehicle_id = -1			# int
 		self.last_seen = -1			# last vehicle report (epoch time)
+		self.start_time = -1			# first vehicle report as processed (epoch time)
 		# initialize sequence
 		self.seq = 1					# sequence which increments at each vehicle report
 		# declare several vars for later in the matching process
@@ -37,6 +65,8 @@ class Trip(object):
 		self.timepoints = []			# Timepoint objects for this trip
 		self.waypoints = []			# points on the finallized trip only
 		self.match = None				# match object created during processing
+		self.stored = False			# has a record been saved in the DB?
+		self.stream = None			# StreamingMatch, if matched while in progress
 
 
 	@classmethod
@@ -59,7 +89,10 @@ class Trip(object):
 	def fromDB(clss,trip_id):
 		"""Construct a trip object from an existing record in the database."""
 		# construct the trip object from info in the DB
-		dbta = db.get_trip_attributes(trip_id)
+		with timing.stage('read trip'):
+			dbta = trackcache.get_trip_attributes(trip_id)
+			if dbta is None:
+				dbta = db.get_trip_attributes(trip_id)
 		# create the object
 		Trip = clss()
 		# set the inital attributes
@@ -70,6 +103,7 @@ class Trip(object):
 		Trip.vehicle_id = dbta['vehicle_id']
 		Trip.vehicles = dbta['points']
 		Trip.last_seen = Trip.vehicles[-1].time
+		Trip.stored = True
 		return Trip
 
 
@@ -79,57 +113,125 @@ class Trip(object):
 		self.vehicles.append( Vehicle( etime, lon, lat ) )
 
 
-	def save(self):
+	def add_vehicle(self,vehicle,compact=False):
+		"""Add an already constructed Vehicle to the end of this trip. If 
+			compact, a report continuing a dwell replaces the last one, so 
+			that only the first and last reports of a stationary vehicle are 
+			kept, as error cleaning would do. Returns True if a report was 
+			replaced."""
+		if compact and len(self.vehicles) > 1 and all( 
+			segment_speed(v1,v2) < stationary_speed for v1, v2 in 
+			[ (self.vehicles[-2],self.vehicles[-1]), (self.vehicles[-1],vehicle) ] 
+		):
+			self.vehicles[-1] = vehicle
+			return True
+		self.vehicles.append( vehicle )
+		return False
+
+
+	def save(self,vehicles=None,in_progress=False):
 		"""Store a record of this trip in the DB. This allows us to 
 			reprocess as from the beginning with different parameters, 
-			data, etc. GPS points are stored as an array of times and 
-			a linestring. This function is to be called just before 
-			process() as data is being collected."""
+			data, etc. GPS points are stored as one compact binary value, 
+			see track.py. This function is to be called just before 
+			process() as data is being collected. A trip already stored 
+			while in progress has its vehicles replaced. A copy of the 
+			vehicles may be given to store instead of the trip's own, if 
+			they may be added to meanwhile. A trip first stored while in 
+			progress isn't selected for processing until it has ended."""
+		if vehicles is None:
+			vehicles = self.vehicles
+		if self.stored:
+			db.update_trip_track(self.trip_id,vehicles)
+			return
 		db.insert_trip(
 			self.trip_id,
 			self.block_id,
 			self.route_id, 
 			self.direction_id,
 			self.vehicle_id,
-			[ v.time for v in self.vehicles ],
-			dumpWKB( self.get_geom(), hex=True )
+			vehicles,
+			in_progress
 		)
+		self.stored = True
 
 
-	def process(self):
-		"""A trip has just ended. What do we do with it?"""
+	def process(self,scrub=True):
+		"""A trip has just ended. What do we do with it? Returns a short 
+			outcome string: 'ignored', 'match problem' or 'success'. Bulk 
+			reprocessing may scrub all its trips at once beforehand and pass 
+			scrub=False."""
 		# As this may be being REprocessed we need to clean up any traces of the 
 		# result of earlier processing so that we have a fresh start
-		db.scrub_trip(self.trip_id)
+		if scrub:
+			with timing.stage('scrub'):
+				db.scrub_trip(self.trip_id)
+		# note the start time before any vehicles are cleaned away
+		self.start_time = self.vehicles[0].time if len(self.vehicles) > 0 else self.last_seen
 		# see if we have enough stuff to bother with
 		if len(self.vehicles) < 5: # km
-			return db.ignore_trip(self.trip_id,'too few vehicles')
+			db.ignore_trip(self.trip_id,'too few vehicles')
+			return self.finish('ignored')
+		with timing.stage('clean'):
+			problem = self.clean()
+		if problem:
+			db.ignore_trip(self.trip_id,problem)
+			return self.finish('ignored')
+		# trip is clean, so store the cleaned line 
+		with timing.stage('store clean geom'):
+			db.set_trip_clean_geom(
+				self.trip_id,
+				dumpWKB( self.get_geom(), hex=True )
+			)
+		# get the stops (as a list of Stop objects)
+		with timing.stage('read stops'):
+			self.stops = db.get_stops(self.direction_id,self.last_seen)
+		# and begin matching
+		with timing.stage('match'):
+			self.map_match_trip()
+		if not self.match.is_useable:
+			db.ignore_trip(self.trip_id,'match problem')
+			return self.finish('match problem')
+		self.interpolate_stop_times()
+		return self.finish('success')
+
+
+	def clean(self):
+		"""Remove redundant and erroneous vehicle reports until none are left 
+			to fix. Returns the reason the trip can't be used, if it can't."""
 		# calculate vector of segment speeds
 		self.segment_speeds = self.get_segment_speeds()
 		# check for very short trips
 		if self.length < 0.8: # km
-			return db.ignore_trip(self.trip_id,'too short')
+			return 'too short'
 		# check for errors and attempt to correct them
 		while self.has_errors():
 			# make sure it's still long enough to bother with
 			if len(self.vehicles) < 5:
-				return db.ignore_trip(self.trip_id,'processing made too short')
+				return 'processing made too short'
 			# still long enough to try fixing
 			self.fix_error()
 			# update the segment speeds for the next iteration
 			self.segment_speeds = self.get_segment_speeds()
-		# trip is clean, so store the cleaned line 
-		db.set_trip_clean_geom(
-			self.trip_id,
-			dumpWKB( self.get_geom(), hex=True )
-		)
-		# get the stops (as a list of Stop objects)
-		self.stops = db.get_stops(self.direction_id,self.last_seen)
-		# and begin matching
-		self.map_match_trip()
-		if not self.match.is_useable:
-			return db.ignore_trip(self.trip_id,'match problem')
-		self.interpolate_stop_times()
+
+
+	def finish(self,outcome):
+		"""Record quality measures of the processed trip, which are rolled 
+			up by route and day as they are stored, and return the outcome. 
+			Only now is the trip marked as processed with this version."""
+		with timing.stage('store quality'):
+			db.set_trip_version(self.trip_id,processing_version)
+			db.store_trip_quality(
+				self.trip_id,
+				self.route_id,
+				self.start_time,
+				outcome,
+				len(self.stops) if self.stops else 0,
+				len(self.timepoints) if outcome == 'success' else 0,
+				self.match.confidence if self.match else None,
+				self.match.default_route_used if self.match else False
+			)
+		return outcome
 
 
 	def get_geom(self):
@@ -165,20 +267,23 @@ class Trip(object):
 		if not self.match.is_useable:
 			return db.ignore_trip(self.trip_id,'match problem')
 		# store the match info and geom in the DB
-		db.add_trip_match(
-			self.trip_id,
-			self.match.confidence,
-			dumpWKB(self.match.geometry,hex=True)
-		)
+		with timing.stage('store match'):
+			db.add_trip_match(
+				self.trip_id,
+				self.match.confidence,
+				dumpWKB(self.match.geometry,hex=True)
+			)
 
 
 	def interpolate_stop_times(self):
 		"""Interpolates stop times after map matching."""
 		# interpolate/extrapolate times for each timepoint
-		for timepoint in self.timepoints:
-			timepoint.set_time( self.interpolate_time(timepoint.measure) )
+		with timing.stage('interpolate'):
+			for timepoint in self.timepoints:
+				timepoint.set_time( self.interpolate_time(timepoint.measure) )
 		# store the stop times
-		db.store_timepoints(self.trip_id,self.timepoints)
+		with timing.stage('store stop times'):
+			db.store_timepoints(self.trip_id,self.timepoints)
 
 
 	def ignore_vehicle(self,var):
@@ -208,7 +313,7 @@ class Trip(object):
 		# '-' indicates moderate speed
 		# e.g. 'oo---o----xx----------' and so pn
 		self.speed_string = ''.join([ 
-			'x' if seg > 120 else 'o' if seg < 0.1 else '-'
+			'x' if seg > max_speed else 'o' if seg < stationary_speed else '-'
 			for seg in self.segment_speeds ])
 		# check for slow segments that can be fixed
 		match_oo = re.search('oo|^o|o$',self.speed_string)